@@ -1,5 +1,5 @@
 from channels.auth import AuthMiddlewareStack
-from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.routing import ProtocolTypeRouter, URLRouter, ChannelNameRouter
 import contest.routing
 
 application = ProtocolTypeRouter({
@@ -7,5 +7,6 @@ application = ProtocolTypeRouter({
         URLRouter(
             contest.routing.websocket_urlpatterns
         )
-    )
+    ),
+    'channel': ChannelNameRouter(contest.routing.channel_routes),
 })
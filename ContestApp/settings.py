@@ -62,6 +62,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'contest.metrics.DatabaseTimeMiddleware',
 ]
 
 ROOT_URLCONF = 'ContestApp.urls'
@@ -97,21 +98,104 @@ DATABASES = {
     }
 }
 
-CHANNEL_LAYERS = {
-    'default': {
+# SQLite tuned for the concurrent consumers: the pragmas below on every
+# connection, and the game state writes committed in batches by a single
+# writer thread (see contest/sqlite.py)
+SQLITE_PRODUCTION = os.environ.get('CONTEST_SQLITE_PRODUCTION', '0') == '1'
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'busy_timeout': 5000,
+}
+
+# Most writes the writer thread commits in one transaction
+SQLITE_WRITE_BATCH = 100
+
+CHANNEL_CAPACITY = {
+    "players": 2000,
+    "game_master": 500
+}
+
+# "pipelined" sends the layer calls of a handler turn in two round trips
+# to Redis, "inprocess" skips Redis: one daphne process and no
+# GAME_WORKERS only (see contest/layers.py)
+CHANNEL_LAYER_BACKENDS = {
+    'redis': {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
         'CONFIG': {
             'hosts': [('localhost', 6379)],
-            'channel_capacity': {
-                "players": 2000,
-                "game_master": 500
-            }
+            'channel_capacity': CHANNEL_CAPACITY,
+        },
+    },
+    'pipelined': {
+        'BACKEND': 'contest.redis_layer.PipelinedRedisChannelLayer',
+        'CONFIG': {
+            'hosts': [('localhost', 6379)],
+            'channel_capacity': CHANNEL_CAPACITY,
         },
     },
+    'inprocess': {
+        'BACKEND': 'contest.layers.InProcessChannelLayer',
+        'CONFIG': {
+            'channel_capacity': CHANNEL_CAPACITY,
+        },
+    },
+}
+
+CHANNEL_LAYERS = {
+    'default': CHANNEL_LAYER_BACKENDS[os.environ.get('CONTEST_CHANNEL_LAYER', 'redis')],
 }
 
 ASGI_APPLICATION = 'ContestApp.routing.application'
 
+# Serve the websockets with the event loop based consumers instead of the
+# thread pool based ones (same protocol, used to A/B the two)
+ASYNC_CONSUMERS = os.environ.get('CONTEST_ASYNC_CONSUMERS', '0') == '1'
+
+# Seconds to wait for a game master consumer or acking client before the
+# player half of a category/question push is sent anyway (see
+# contest/delivery.py)
+DELIVERY_ACK_TIMEOUT = 1.0
+
+# Frames to the devices kept per session, for the devices that reconnect
+# with the last one they got (see contest/delivery.py)
+DEVICE_REPLAY_FRAMES = 50
+
+# Live game state is kept in memory (contest/engine.py) and written back to
+# the database this often, which bounds what a crash can lose
+GAME_STATE_FLUSH_INTERVAL = 0.5
+
+# Every game transition is logged (contest/events.py); the whole state of a
+# session is snapshotted every this many events, which bounds the replay
+GAME_SNAPSHOT_EVERY = 100
+
+# Names of the game workers owning the sessions, each run with
+# "manage.py runworker gameworker.<name>" (see contest/sharding.py). Empty,
+# every process plays the messages of its own websockets
+GAME_WORKERS = [name for name in os.environ.get('CONTEST_GAME_WORKERS', '').split(',') if name]
+
+# Websocket messages slower than this many seconds are logged and sampled,
+# with their queries (see contest/instrumentation.py)
+INSTRUMENTATION_SLOW_MESSAGE = 0.25
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'contest': {
+            'handlers': ['console'],
+            'level': os.environ.get('CONTEST_LOG_LEVEL', 'INFO'),
+        },
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
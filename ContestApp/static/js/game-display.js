@@ -1,5 +1,5 @@
 $(document).ready(function(){
-    var gameSocket = new WebSocket('ws://192.168.0.172:80/ws/gamemaster/');
+    var gameSocket = new WebSocket('ws://192.168.0.172:80/ws/gamemaster/?ack=1');
     $("#containerCategories").hide();
     $("#containerQuestion").hide();
     $("#containerInfo").hide();
@@ -8,6 +8,12 @@ $(document).ready(function(){
 
     gameSocket.onmessage = function(event) {
         let msg = JSON.parse(event.data);
+        if (msg.seq !== undefined){
+            // Shown on the big screen, the devices can get it now
+            setTimeout(function(){
+                gameSocket.send(JSON.stringify({type: "ack", game: msg.game, seq: msg.seq}));
+            }, 0);
+        }
         switch(msg.type){
             case "send.categories":
                 clearInterval(intervalID);
@@ -10,7 +10,9 @@ urlpatterns = [
     path('questions/<int:pk>/', api_views.QuestionDetail.as_view(), name='question-detail'),
     path('answers/', api_views.AnswersList.as_view()),
     path('answers/<int:pk>/', api_views.AnswerDetail.as_view(), name='answer-detail'),
-    path('start-game/', api_views.start_game_session, name='start-game')
+    path('start-game/', api_views.start_game_session, name='start-game'),
+    path('sessions/<int:pk>/latency/', api_views.session_latency, name='session-latency'),
+    path('metrics/', api_views.metrics, name='metrics')
 ]
 
 urlpatterns = format_suffix_patterns(urlpatterns)
@@ -1,5 +1,3 @@
-import json
-
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 from rest_framework.decorators import api_view
@@ -10,9 +8,11 @@ from contest.serializers import QuestionSerializer, AnswerSerializer, QuizSerial
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from django.http import Http404, JsonResponse
+from django.http import Http404, JsonResponse, HttpResponse
 
-from contest.utils import create_duel_games, register_teams
+from contest import metrics as process_metrics
+from contest.tracing import tracer
+from contest.utils import create_duel_games, register_teams, build_question_deck
 
 
 class QuizzesList(APIView):
@@ -192,10 +192,8 @@ def start_game_session(request):
         raise Http404
 
     # Create a game session with the selected quiz
-    gs = GameSession(
-        quiz=quiz,
-        questions_removed=json.dumps([]),
-    )
+    gs = GameSession(quiz=quiz)
+    build_question_deck(gs)
     gs.save()
 
     registered_teams = register_teams(teams, gs)
@@ -213,3 +211,15 @@ def start_game_session(request):
     )
 
     return Response({"status": "ok", "first_game": game1.id})
+
+
+def session_latency(request, pk):
+    # Question latencies of the session, as seen by this process
+    report = tracer.session_report(pk)
+    if report is None:
+        raise Http404
+    return JsonResponse(report)
+
+
+def metrics(request):
+    return HttpResponse(process_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
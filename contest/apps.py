@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class ContestConfig(AppConfig):
     name = 'contest'
+
+    def ready(self):
+        # Connects the signals that keep the quiz content snapshots fresh
+        import contest.content  # noqa: F401
+        # And the one that sets the pragmas of the SQLite production mode
+        import contest.sqlite  # noqa: F401
@@ -0,0 +1,138 @@
+"""
+Helpers shared by the benchmark management commands: a throw-away
+database, an in-memory channel layer and seeded quiz content.
+"""
+import os
+import tempfile
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+from django.test.utils import override_settings
+
+from contest.content import content
+from contest.engine import engine
+from contest.models import Quiz, Question, Answer, Team, GameSession
+from contest.sharding import router
+from contest.sqlite import writer
+from contest.tracing import tracer
+from contest.utils import register_teams, create_duel_games, build_question_deck
+
+
+IN_MEMORY_CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'CONFIG': {
+            'capacity': 10000,
+        },
+    },
+}
+
+
+@contextmanager
+def test_database():
+    old_name = connection.settings_dict['NAME']
+    old_test_name = connection.settings_dict['TEST'].get('NAME')
+    test_name = os.path.join(tempfile.gettempdir(), 'contest-bench.sqlite3')
+    if connection.vendor == 'sqlite':
+        # A file, like the real database. The in-memory test database fails
+        # concurrent writes from several threads instead of waiting on the lock
+        connection.settings_dict['TEST']['NAME'] = test_name
+        remove_wal(test_name)
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        engine.reset()
+        content.invalidate()
+        writer.stop()
+        # Ids start over in the next test database
+        router.reset()
+        tracer.reset()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        connection.settings_dict['TEST']['NAME'] = old_test_name
+
+
+def remove_wal(name):
+    # A write-ahead log left by a previous run must not meet the new file
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(name + suffix):
+            os.remove(name + suffix)
+
+
+@contextmanager
+def in_memory_layer():
+    with override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS):
+        yield
+
+
+@contextmanager
+def channel_layer(name):
+    """
+    "memory" for the in-memory layer of channels, or one of the layers of
+    settings.CHANNEL_LAYER_BACKENDS.
+    """
+    if name == 'memory':
+        layers = IN_MEMORY_CHANNEL_LAYERS
+    else:
+        layers = {'default': settings.CHANNEL_LAYER_BACKENDS[name]}
+    with override_settings(CHANNEL_LAYERS=layers):
+        yield
+
+
+def seed_quiz(categories=7, questions_per_category=5, name='Benchmark quiz'):
+    quiz = Quiz.objects.create(name=name)
+    Question.objects.bulk_create([
+        Question(quiz=quiz,
+                 category='Category {}'.format(c),
+                 question_text='Question {} of category {}?'.format(q, c))
+        for c in range(categories) for q in range(questions_per_category)
+    ])
+    Answer.objects.bulk_create([
+        Answer(question=question,
+               number=number,
+               answer_text='Answer {}'.format(number),
+               is_correct=True if number == 1 else None)
+        for question in Question.objects.filter(quiz=quiz) for number in range(1, 5)
+    ])
+    return quiz
+
+
+def start_session(quiz, team_names):
+    """
+    Same steps as the start-game API call, without the game master broadcast.
+    """
+    teams = [Team.objects.get_or_create(name=name)[0] for name in team_names]
+    session = GameSession(quiz=quiz)
+    build_question_deck(session)
+    session.save()
+    registered_teams = register_teams(teams, session)
+    first_game = create_duel_games(registered_teams, session)
+    return session, first_game
+
+
+def skip_to_final(session_id):
+    """
+    Ends the duels of a started session (their first teams win), so that
+    the final is up next. Returns its GameState.
+    """
+    session = engine.session(session_id)
+    with session.lock:
+        for game in session.games.values():
+            if not game.is_final:
+                game.winner_id = game.first_team_id
+                game.state = 5
+        final = [game for game in session.games.values() if game.is_final][0]
+        final.first_team_id, final.second_team_id, final.third_team_id = [
+            game.winner_id for game in session.games.values() if not game.is_final]
+        final.state = 1
+        session.games_order = final.game_order
+    return final
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
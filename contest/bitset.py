@@ -0,0 +1,67 @@
+class PackedSet:
+    """
+    A set over a fixed, ordered universe (the questions or the categories of
+    a quiz), kept as one bit per item: bit i is set when universe[i] is in
+    the set. It is stored as little endian bytes.
+    """
+
+    def __init__(self, universe, index, bits=0):
+        # Ordered items, and item -> position in universe
+        self.universe = universe
+        self.index = index
+        self.bits = bits & ((1 << len(universe)) - 1)
+
+    @classmethod
+    def from_bytes(cls, universe, index, data):
+        return cls(universe, index, int.from_bytes(bytes(data or b''), 'little'))
+
+    @classmethod
+    def from_items(cls, universe, index, items):
+        """
+        The set of the items that are in the universe, the others are left out.
+        """
+        bits = 0
+        for item in items:
+            position = index.get(item)
+            if position is not None:
+                bits |= 1 << position
+        return cls(universe, index, bits)
+
+    def to_bytes(self):
+        return bits_to_bytes(self.bits)
+
+    def add(self, item):
+        self.bits |= 1 << self.index[item]
+
+    def __contains__(self, item):
+        position = self.index.get(item)
+        return position is not None and bool(self.bits >> position & 1)
+
+    def __iter__(self):
+        return (item for position, item in enumerate(self.universe) if self.bits >> position & 1)
+
+    def __len__(self):
+        return bin(self.bits).count('1')
+
+    def remaining(self):
+        """
+        How many items of the universe are not in the set.
+        """
+        return len(self.universe) - len(self)
+
+    def missing(self):
+        return [item for position, item in enumerate(self.universe) if not self.bits >> position & 1]
+
+    def __repr__(self):
+        return 'PackedSet({})'.format(list(self))
+
+
+def bits_to_bytes(bits):
+    return bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+
+
+def positions(universe):
+    """
+    Item -> position in the universe, the index of a PackedSet.
+    """
+    return {item: position for position, item in enumerate(universe)}
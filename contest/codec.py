@@ -0,0 +1,86 @@
+"""
+Websocket frame encodings.
+
+JSON text frames are the default. A client can ask for msgpack binary
+frames when it connects, with ?encoding=msgpack or the "msgpack"
+subprotocol; both consumers then encode every frame with the codec picked
+here. Incoming frames are read as msgpack when binary and as JSON when
+text, whatever was negotiated.
+"""
+import json
+import struct
+from urllib.parse import parse_qs
+
+import msgpack
+
+
+def msgpack_map_header(size):
+    if size < 16:
+        return struct.pack('B', 0x80 | size)
+    if size < 2 ** 16:
+        return struct.pack('>BH', 0xde, size)
+    return struct.pack('>BI', 0xdf, size)
+
+
+def pre_encode(**members):
+    """
+    Encodes the members of a frame once, for every codec, so that sending
+    them only needs the few fields that change per frame. The result is a
+    plain dict, so it can travel in channel layer events.
+    """
+    return {
+        'json': json.dumps(members)[1:-1],
+        'msgpack': msgpack.packb(members, use_bin_type=True)[len(msgpack_map_header(len(members))):],
+        'size': len(members),
+    }
+
+
+class JsonCodec:
+    name = 'json'
+
+    def encode(self, payload):
+        # Plain strings are sent as they are
+        return {'text_data': payload if isinstance(payload, str) else json.dumps(payload)}
+
+    def encode_with(self, pre_encoded, **fields):
+        return {'text_data': '{{{}, {}}}'.format(json.dumps(fields)[1:-1], pre_encoded['json'])}
+
+
+class MsgpackCodec:
+    name = 'msgpack'
+
+    def encode(self, payload):
+        return {'bytes_data': msgpack.packb(payload, use_bin_type=True)}
+
+    def encode_with(self, pre_encoded, **fields):
+        # Packs the fields as a map, and swaps its header for one that also
+        # counts the pre-encoded members appended after them
+        packed = msgpack.packb(fields, use_bin_type=True)
+        return {'bytes_data': b''.join([
+            msgpack_map_header(len(fields) + pre_encoded['size']),
+            packed[len(msgpack_map_header(len(fields))):],
+            pre_encoded['msgpack'],
+        ])}
+
+
+JSON = JsonCodec()
+MSGPACK = MsgpackCodec()
+CODECS = {codec.name: codec for codec in (JSON, MSGPACK)}
+
+
+def negotiate(scope):
+    """
+    Returns the codec the client asked for, and the subprotocol to accept
+    the connection with (None unless it asked through a subprotocol).
+    """
+    for subprotocol in scope.get('subprotocols') or []:
+        if subprotocol in CODECS:
+            return CODECS[subprotocol], subprotocol
+    query = parse_qs(scope.get('query_string', b'').decode())
+    return CODECS.get(query.get('encoding', ['json'])[0], JSON), None
+
+
+def decode(text_data=None, bytes_data=None):
+    if bytes_data is not None:
+        return msgpack.unpackb(bytes_data, raw=False)
+    return json.loads(text_data)
@@ -1,698 +1,616 @@
+import asyncio
+import logging
 import time
-from random import randint
+from urllib.parse import parse_qs
 
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
-import json
+from asgiref.sync import async_to_sync, SyncToAsync
+from channels.consumer import SyncConsumer, get_handler_name
+from channels.db import database_sync_to_async
+from channels.exceptions import ChannelFull
+from channels.generic.websocket import WebsocketConsumer, AsyncJsonWebsocketConsumer
 
-from contest.models import GameTeam, DuelGame, Question, Answer
+from contest.codec import JSON, negotiate, decode
+from contest.content import content
+from contest.delivery import tracker, ack_timeout, release_after
+from contest.engine import engine
+from contest.game import QuizHandler, GameMasterHandler
+from contest.instrumentation import MessageTrace
+from contest.layers import batches
+from contest.metrics import channel_full, channel_failures, group_members, group_kind
+from contest.sharding import router
+from contest.tracing import tracer
 
 
-class QuizConsumer(WebsocketConsumer):
+logger = logging.getLogger(__name__)
 
-    def _send_error(self, message):
-        async_to_sync(self.channel_layer.group_send)(
-            'game_master',
-            {
-                'type': 'error',
-                'message': message
-            }
-        )
 
-        self.send(json.dumps({"type": "info",
-                              "message": message}))
+def wants_acks(scope):
+    query = parse_qs(scope.get('query_string', b'').decode())
+    return query.get('ack', ['0'])[0] == '1'
 
-    def _send_info(self, message):
-        async_to_sync(self.channel_layer.group_send)(
-            'game_master',
-            {
-                'type': 'info',
-                'message': message
-            }
-        )
 
-    def connect(self):
-        self.accept()
-        async_to_sync(self.channel_layer.group_add)("players", self.channel_name)
+class TracingMixin:
+    """
+    Traces every dispatched message (see contest.instrumentation), and
+    counts the consumer's groups and failed channel layer calls.
+    """
+    trace = None
 
-    def disconnect(self, code):
-        async_to_sync(self.channel_layer.group_discard)("players", self.channel_name)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.joined_groups = set()
 
-    def receive(self, text_data):
+    async def dispatch(self, message):
+        self.trace = MessageTrace(message)
         try:
-            data = json.loads(text_data)
+            await super().dispatch(message)
+        finally:
+            self.trace.finish()
+
+    def delivered_trace(self, event):
+        # Stamps the question's trace as it goes out to this device
+        if event.get('trace') is None:
+            return None
+        return tracer.delivered(event['trace'], self.handler.device_id or event.get('team'))
+
+    def channel_layer_failed(self, method, group, exc):
+        if isinstance(exc, ChannelFull):
+            channel_full.labels(group_kind(method, group)).inc()
+        else:
+            channel_failures.labels(group_kind(method, group)).inc()
+
+    def channel_layer_called(self, method, group, start):
+        self.trace.channel_call(start)
+        self.track_group(method, group)
+
+    def channel_layer_batched(self, calls, start):
+        # One layer call for the whole batch
+        self.trace.channel_call(start)
+        for call in calls:
+            self.track_group(call[0], call[1])
+
+    def track_group(self, method, group):
+        if method == 'group_add' and group not in self.joined_groups:
+            self.joined_groups.add(group)
+            group_members.labels(group_kind(method, group)).inc()
+        elif method == 'group_discard' and group in self.joined_groups:
+            self.joined_groups.discard(group)
+            group_members.labels(group_kind(method, group)).dec()
+
+
+class RoutingMixin:
+    """
+    Plays the game messages of the connection here, or forwards them to the
+    worker owning their session when sharding is on (see contest.sharding).
+    """
+
+    def play_here(self, data):
+        # Runs in the database thread, finding the owner may take a query
+        owner = router.owner_channel(data, self.handler.team)
+        if owner is not None:
+            return None, owner
+        return self.handler.receive(data), None
+
+    def forwarded(self, data):
+        return {
+            'type': 'game.message',
+            'role': self.handler.role,
+            'reply_channel': self.channel_name,
+            'state': self.handler.state(),
+            'data': data,
+        }
+
+    def restore_state(self, state):
+        # Devices without team groups listen to "players" (see QuizHandler)
+        before = set(self.handler.groups) or {'players'}
+        self.handler.restore(state)
+        after = set(self.handler.groups) or {'players'}
+        for group in after - before:
+            self.track_group('group_add', group)
+        for group in before - after:
+            self.track_group('group_discard', group)
+
+    def connection_channel(self):
+        # The channel the handler's connection is reached at
+        return self.channel_name
+
+    def holder_channel(self):
+        # The channel the frames held back here are released at
+        return self.channel_name
+
+    def ordered_event(self, event):
+        # Where the game master consumers ask for the held frame
+        return dict(event, owner=self.holder_channel(), holder=tracker.holder)
+
+    def layer_call(self, message):
+        # Outbox message -> (method, group, *args) of the channel layer
+        if message[0] == 'ordered_send':
+            return 'group_send', message[1], self.ordered_event(message[2])
+        if message[0] in ('group_add', 'group_discard'):
+            return message[0], message[1], self.connection_channel()
+        return message
+
+    def release_request(self, event):
+        # The held frame is released by the consumer or worker that holds it
+        return {'type': 'ordered.release', 'game': event['game'], 'seq': event['seq']}
+
+
+class OutboxMixin(TracingMixin, RoutingMixin):
+    """
+    Delivers the messages collected by a game handler, in order.
+    """
+    codec = JSON
+
+    def channel_layer_call(self, method, group, *args):
+        start = time.perf_counter()
+        try:
+            async_to_sync(getattr(self.channel_layer, method))(group, *args)
         except Exception as exc:
-            self.send("message received: \"{}\" is not valid json".format(text_data))
-            self._send_error('Invalid request {}'.format(exc))
-            return
-
-        request_type = data.get('type')
+            self.channel_layer_failed(method, group, exc)
+            raise
+        self.channel_layer_called(method, group, start)
 
-        if request_type == 'category':
-            category = data.get('category')
-            game_id = data.get('game')
-            team_name = data.get('team')
+    def channel_layer_batch(self, calls):
+        if len(calls) > 1 and batches(self.channel_layer):
+            start = time.perf_counter()
             try:
-                game = DuelGame.objects.get(id=game_id)
-            except DuelGame.DoesNotExist:
-                self._send_error('Category selected for wrong game id {}'.format(game_id))
-                return
-            try:
-                team = GameTeam.objects.get(team__name=team_name, game_session=game.session)
-            except GameTeam.DoesNotExist:
-                self._send_error('Category selected by non existing team')
-                return
-            removed_categories = json.loads(game.categories_removed)
-            if category in removed_categories:
-                self.send(json.dumps({'type': 'error', 'message': 'category not available'}))
-                self._send_error('Category no longer available for this game {}'.format(category))
-                return
-            category_exists = game.session.quiz.question_set.filter(category=category).count() > 0
-            if category_exists < 1:
-                self.send(json.dumps({'type': 'error', 'message': 'category not available'}))
-                self._send_error('Category not found: {}'.format(category))
-                return
-            if ((game.first_player_turn and (team.id != game.first_team.id))
-               or (not game.first_player_turn and (team.id != game.second_team_id))):
-                self.send(json.dumps({'type': 'error', 'message': 'Wrong team selected category'}))
-                self._send_error('Wrong team selected category')
-                return
-
-            removed_categories.append(category)
-            game.categories_removed = json.dumps(removed_categories)
-            game.selected_category = category
-            game.state = 2
-            game.save()
-            async_to_sync(self.channel_layer.group_send)(
-                'game_master',
-                {
-                    'type': 'category.receive',
-                    'team': data.get('team'),
-                    'category': category,
-                    'game': game.id
-                }
-            )
-
-        elif request_type == 'answer':
-            answer_number = data.get('answer')  # is 1,2,3,4 corresponding to a,b,c,d
-            question_id = data.get('question')
-            game_id = data.get('game')
-            team_name = data.get('team')
-
-            try:
-                question = Question.objects.get(id=question_id)
-                if answer_number:
-                    the_answer = Answer.objects.get(number=answer_number, question=question)
+                async_to_sync(self.channel_layer.send_batch)(calls)
+            except Exception as exc:
+                self.channel_layer_failed('send_batch', 'batch', exc)
+                raise
+            self.channel_layer_batched(calls, start)
+        else:
+            for call in calls:
+                self.channel_layer_call(*call)
+
+    def deliver(self, messages):
+        # The layer calls between two replies go out as one batch
+        calls = []
+        for message in messages:
+            if message[0] in ('reply', 'replay'):
+                self.channel_layer_batch(calls)
+                calls = []
+                if message[0] == 'reply':
+                    self.send_json(message[1])
                 else:
-                    the_answer = None
-                game = DuelGame.objects.get(id=game_id)
-                team = GameTeam.objects.get(team__name=team_name, game_session=game.session)
-            except Exception:
-                self.send("Error reading answer data from {}".format(data))
-                self._send_error("Error reading answer data from {}".format(data))
-                return
-
-            # See if the player who guessed is on his turn
-            if game.state == 5:
-                # If the game is finished, answers will not work
-                self._send_error("Game finished, cannot get any more answers")
-                return
-            if game.is_final is False:
-                if game.first_player_turn and (game.state != 3):
-                    if team.team.name != game.first_team.team.name:
-                        self._send_error("Wrong team ({}) answered for game{}".format(team.team.name, str(game_id)))
-                        return
-                elif team.team.name != game.second_team.team.name and (game.state != 3):
-                    self._send_error("Wrong team ({}) answered for game{}".format(team.team.name, str(game_id)))
-                    return
-
-                # See if next question
-                removed_categories = json.loads(game.categories_removed)
-
-                async_to_sync(self.channel_layer.group_send)(
-                    "game_master",
-                    {
-                        "type": "answer.receive",
-                        "team": team_name,
-                        "answer": answer_number
-                    }
+                    self.replay_frame(message[1])
+                continue
+            calls.append(self.layer_call(message))
+            if message[0] == 'ordered_send':
+                # Sent anyway if no game master releases it
+                event = message[2]
+                asyncio.run_coroutine_threadsafe(
+                    release_after(self.channel_layer, event['game'], event['seq'], ack_timeout()),
+                    SyncToAsync.threadlocal.main_event_loop
                 )
+        self.channel_layer_batch(calls)
 
-                # First, update score
-                if the_answer is None:
-                    pass
-                elif the_answer.is_correct:
-                    if game.first_player_turn:
-                        game.first_team_score = game.first_team_score + 1
-                    else:
-                        game.second_team_score = game.second_team_score + 1
-                else:
-                    if game.state == 3:
-                        # Someone rushed and answered incorrectly
-                        # He will lose
-                        if team_name == game.first_team.team.name:
-                            game.second_team_score += 1
-                        else:
-                            game.first_team_score += 1
-
-                if the_answer is None:
-                    self._send_info('Answer was null')
-                else:
-                    self._send_info('Team {} answered "{}. {}" and {} correct'.format(
-                        team.team.name,
-                        answer_number,
-                        the_answer.answer_text if the_answer else "did not answer",
-                        "is" if the_answer.is_correct else "isn't"
-                    ))
-                game.correct_answer = Answer.objects.get(question=question, is_correct=True).number
-                categories_left_count = len({q.category for q in Question.objects.filter(
-                    quiz__gamesession=game.session
-                ).exclude(
-                    category__in=removed_categories
-                )})
-                if categories_left_count > 1:
-                    # We continue the game as categories are available
-                    game.state = 1
-                    game.first_player_turn = not game.first_player_turn
-                    game.save()
-                    self._send_info('Game {} continues'.format(game_id))
+    def play(self, data):
+        messages, owner = self.trace.run(self.play_here, data)
+        if owner is None:
+            self.deliver(messages)
+        else:
+            self.channel_layer_call('send', owner, self.forwarded(data))
 
-                else:
-                    # See if we have a tie
-                    if game.first_team_score == game.second_team_score:
-                        # We have a tie, we need to send another question
-                        game.state = 3
-                        game.save()
-                        self._send_info('Game {} is a tie, sending last question'.format(game_id))
-                        return
-
-                    winner = game.first_team if game.first_team_score > game.second_team_score else game.second_team
-                    game.winner = winner
-                    game.state = 5
-                    # Go to next game
-                    session = game.session
-                    session.games_order = session.games_order + 1
-                    session.save()
-                    game.save()
-
-                    event = {"type": "unregistered",
-                             "device_id": "all"}
-
-                    async_to_sync(self.channel_layer.group_send)('players', event)
-
-                    # Reset device status
-                    GameTeam.objects.filter(game_session=session).update(
-                        device_registered=False,
-                        device_unique_id=None
-                    )
-
-                    # See if we are starting the final, to select the players
-                    if DuelGame.objects.get(session=session, game_order=session.games_order).is_final:
-                        # We have a final, let's find the winners of the previous rounds
-                        # First let's get the games
-                        normal_games = DuelGame.objects.filter(session=session, is_final=False)
-                        winners = [game.winner for game in normal_games]
-                        print(winners)
-                        if len(winners) != 3:
-                            self._send_error("Winners are not 3! (It's {})".format(len(winners)))
-                            return
-                        final = DuelGame.objects.get(session=session, is_final=True)
-                        final.first_team = winners[0]
-                        final.second_team = winners[1]
-                        final.third_team = winners[2]
-                        final.save()
-
-                    self._send_info('Game {} finished, winner is {}'.format(game_id, winner.team.name))
-
-            else:
-                if ((team_name != game.first_team.team.name) and
-                   (team_name != game.second_team.team.name) and
-                   (team_name != game.third_team.team.name)):
-                    self._send_error("Wrong team answered: {}".format(team_name))
-                    return
-
-                async_to_sync(self.channel_layer.group_send)(
-                    "game_master",
-                    {
-                        "type": "answer.receive",
-                        "team": team_name,
-                        "answer": answer_number
-                    }
-                )
+    def outbox_reply(self, event):
+        self.send_json(event['payload'])
+
+    def replay_frame(self, event):
+        # Sent the way it was the first time, minus its effects on the groups
+        getattr(self, get_handler_name(event))(dict(event, replayed=True))
+
+    def connection_state(self, event):
+        self.restore_state(event['state'])
+
+    def negotiate_codec(self):
+        # Returns the subprotocol to accept the connection with
+        self.codec, subprotocol = negotiate(self.scope)
+        return subprotocol
+
+    def send_frame(self, frame):
+        self.trace.frame_sent(frame)
+        self.send(**frame)
+
+    def send_json(self, payload):
+        self.send_frame(self.codec.encode(payload))
 
-                game.answer_count = game.answer_count + 1
-
-                if the_answer is None:
-                    game.round_log = json.dumps(
-                        json.loads(game.round_log).append('Team {} ran out of time'.format(team_name)))
-                elif the_answer.is_correct:
-                    if team == game.first_team:
-                        game.first_team_score = game.first_team_score + 1
-                    elif team == game.second_team:
-                        game.second_team_score = game.second_team_score + 1
-                    else:
-                        game.third_team_score = game.third_team_score + 1
-
-                    # Set the round winner so we can
-                    game.round_log = json.dumps(
-                        json.loads(game.round_log).append('Team {} answered correctly!'.format(team_name)))
-                    game.correct_answer = the_answer.number
-                    if not game.round_winner:
-                        game.round_winner = team.team.name
-                game.save()
-                print("Number of answers: {}".format(game.answer_count))
-                if game.answer_count >= 3:
-                    removed_categories = json.loads(game.categories_removed)
-                    game.correct_answer = Answer.objects.get(question=question, is_correct=True).number
-                    # Next round
-                    if Question.objects.filter(quiz__gamesession=game.session).exclude(category__in=removed_categories).count() > 0:
-                        # We continue the game as categories are available
-                        game.state = 1
-                        self._send_info("Round won by {}".format(game.round_winner))
-                        self._send_info(game.round_log)
-                        self._send_info("Starting next round")
-                        game.answer_count = 0
-                        game.round_winner = None
-                        game.round_log = json.dumps([])
-                        game.selected_category = None
-                        game.save()
-                    else:
-                        # Game finished announce the winner
-                        ranking = [{'team': game.first_team.team.name,
-                                    'score': game.first_team_score},
-                                   {'team': game.second_team.team.name,
-                                    'score': game.second_team_score},
-                                   {'team': game.third_team.team.name,
-                                    'score': game.third_team_score}]
-
-                        ranking_final = sorted(ranking, key=lambda k: k['score'], reverse=True)
-                        self.send(json.dumps(
-                            {"type": "game_over",
-                             "ranking": ranking_final}
-                        ))
-
-                        async_to_sync(self.channel_layer.group_send)(
-                            'game_master',
-                            {'type': 'game.over',
-                             'ranking': ranking_final}
-                        )
-                        game.save()
-        elif request_type == 'register':
-            name = data.get('team')
-            game_id = data.get('game')
-            device_id = data.get('device')
+    def send_pre_encoded(self, pre_encoded, **fields):
+        self.send_frame(self.codec.encode_with(pre_encoded, **fields))
 
+    def frame_written(self, event):
+        # Our copy of an ordered frame is out, let the held one follow,
+        # unless game master clients acknowledge the frames they render
+        if 'seq' not in event or tracker.waits_for_ack():
+            return
+        if event.get('holder') == tracker.holder:
+            self.ordered_release(event)
+        elif 'owner' in event:
+            self.channel_layer_call('send', event['owner'], self.release_request(event))
+
+    def ordered_release(self, event):
+        held = tracker.release(event['game'], event['seq'])
+        if held is not None:
+            self.channel_layer_call('group_send', *held)
+
+
+class AsyncOutboxMixin(TracingMixin, RoutingMixin):
+    codec = JSON
+
+    async def channel_layer_call(self, method, group, *args):
+        start = time.perf_counter()
+        try:
+            await getattr(self.channel_layer, method)(group, *args)
+        except Exception as exc:
+            self.channel_layer_failed(method, group, exc)
+            raise
+        self.channel_layer_called(method, group, start)
+
+    async def channel_layer_batch(self, calls):
+        if len(calls) > 1 and batches(self.channel_layer):
+            start = time.perf_counter()
             try:
-                game = DuelGame.objects.get(id=game_id)
-                team = GameTeam.objects.get(team__name=name, game_session=game.session)
+                await self.channel_layer.send_batch(calls)
             except Exception as exc:
-                async_to_sync(self.channel_layer.group_send)(
-                    'game_master',
-                    {
-                        'type': 'error',
-                        'message': 'Team or game not found {}'.format(exc)
-                    }
-                )
-                self.send('Team or game not found')
-                return
-
-            if team == game.first_team or team == game.second_team or team == game.third_team:
-                if team.device_registered is True:
-                    event = {"type": "unregistered",
-                             "device_id": team.device_unique_id}
-                    async_to_sync(self.channel_layer.group_send)(
-                        'game_master',
-                        {
-                            'type': 'device.unregistered',
-                            'message': 'Device {} removed from game {}'.format(team.device_unique_id,
-                                                                               game_id)
-                        }
-                    )
-                    async_to_sync(self.channel_layer.group_send)(
-                        'players',
-                        event
-                    )
-                team.device_registered = True
-                team.device_unique_id = device_id
-                team.save()
-                game.refresh_from_db()
-                self.send(json.dumps({
-                    'type': 'device_registered',
-                    'team': name,
-                    'device': device_id
-                }))
-                async_to_sync(self.channel_layer.group_send)(
-                    'game_master',
-                    {
-                        'type': 'info',
-                        'message': 'Device {} registered for team {}'.format(device_id, name)
-                    }
-                )
-                if game.first_team.device_registered and game.second_team.device_registered and not game.is_final:
-                    game.state = 1
-                    game.save()
-                    async_to_sync(self.channel_layer.group_send)(
-                        'game_master',
-                        {
-                            'type': 'info',
-                            'message': 'All devices registered, proceed to game start'
-                        }
-                    )
-                elif game.first_team.device_registered and game.second_team.device_registered and game.third_team.device_registered:
-                    game.state = 1
-                    game.save()
-                    async_to_sync(self.channel_layer.group_send)(
-                        'game_master',
-                        {
-                            'type': 'info',
-                            'message': 'All devices registered, proceed to game start'
-                        }
-                    )
-            else:
-                async_to_sync(self.channel_layer.group_send)(
-                    'game_master',
-                    {
-                        'type': 'error',
-                        'message': 'Unknown team attemped register'
-                    }
-                )
-        elif request_type == 'connected':
-            device_id = data.get('device')
+                self.channel_layer_failed('send_batch', 'batch', exc)
+                raise
+            self.channel_layer_batched(calls, start)
+        else:
+            for call in calls:
+                await self.channel_layer_call(*call)
+
+    async def deliver(self, messages):
+        calls = []
+        for message in messages:
+            if message[0] in ('reply', 'replay'):
+                await self.channel_layer_batch(calls)
+                calls = []
+                if message[0] == 'reply':
+                    await self.send_json(message[1])
+                else:
+                    await self.replay_frame(message[1])
+                continue
+            calls.append(self.layer_call(message))
+            if message[0] == 'ordered_send':
+                event = message[2]
+                asyncio.ensure_future(
+                    release_after(self.channel_layer, event['game'], event['seq'], ack_timeout()))
+        await self.channel_layer_batch(calls)
+
+    async def play(self, data):
+        messages, owner = await database_sync_to_async(self.trace.run)(self.play_here, data)
+        if owner is None:
+            await self.deliver(messages)
+        else:
+            await self.channel_layer_call('send', owner, self.forwarded(data))
+
+    async def outbox_reply(self, event):
+        await self.send_json(event['payload'])
+
+    async def replay_frame(self, event):
+        await getattr(self, get_handler_name(event))(dict(event, replayed=True))
+
+    async def connection_state(self, event):
+        self.restore_state(event['state'])
+
+    def negotiate_codec(self):
+        self.codec, subprotocol = negotiate(self.scope)
+        return subprotocol
+
+    async def send_frame(self, frame, close=False):
+        self.trace.frame_sent(frame)
+        await self.send(close=close, **frame)
+
+    async def send_json(self, payload, close=False):
+        await self.send_frame(self.codec.encode(payload), close=close)
+
+    async def send_pre_encoded(self, pre_encoded, **fields):
+        await self.send_frame(self.codec.encode_with(pre_encoded, **fields))
+
+    async def frame_written(self, event):
+        if 'seq' not in event or tracker.waits_for_ack():
+            return
+        if event.get('holder') == tracker.holder:
+            await self.ordered_release(event)
+        elif 'owner' in event:
+            await self.channel_layer_call('send', event['owner'], self.release_request(event))
 
-            try:
-                gt = GameTeam.objects.filter(device_unique_id=device_id).order_by("id").last()
-            except GameTeam.DoesNotExist:
-                return  # This means no game is started
+    async def ordered_release(self, event):
+        held = tracker.release(event['game'], event['seq'])
+        if held is not None:
+            await self.channel_layer_call('group_send', *held)
 
-            if gt is None:
-                return
 
-            # Restore the game state of the device
-            try:
-                self.send(json.dumps({
-                    'type': 'device_reconnect',
-                    'device': device_id,
-                    'team': gt.team.name,
-                    'game': DuelGame.objects.get(session=gt.game_session, game_order=gt.game_session.games_order).id
-                }))
-            except DuelGame.DoesNotExist:
-                return  # Something might've changed
+class QuizConsumer(OutboxMixin, WebsocketConsumer):
+
+    def connect(self):
+        self.handler = QuizHandler()
+        self.accept(self.negotiate_codec())
+        self.channel_layer_call('group_add', "players", self.channel_name)
+
+    def disconnect(self, code):
+        self.channel_layer_batch([('group_discard', group, self.channel_name)
+                                  for group in ['players'] + list(self.handler.groups)])
+
+    def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = decode(text_data, bytes_data)
+        except Exception as exc:
+            self.trace.received(None, text_data, bytes_data)
+            self.deliver(self.handler.invalid_json(text_data or bytes_data, exc))
+            return
+
+        self.trace.received(data, text_data, bytes_data)
+        self.play(data)
 
     def register_devices(self, event):
-        self.send(json.dumps({
+        self.send_json({
             'type': 'register_device',
             'teams': event.get('teams'),
             'game': event.get('game')
-        }))
+        })
 
     def question_send(self, event):
-        print("Sending question!")
-        self.send(json.dumps({
-            'type': 'question_send',
-            'question': event.get('question'),
-            'questionID': event.get('questionID'),
-            'answers': event.get('answers'),
-            'team': event.get('team')
-        }))
+        logger.debug('Sending question to %s', event.get('team'))
+        self.send_pre_encoded(event['payload'], type='question_send', team=event.get('team'),
+                              game=event.get('game'), seq=event.get('seq'), session_seq=event.get('session_seq'),
+                              trace=self.delivered_trace(event))
 
     def category_send(self, event):
-        print("Sending category!")
-        self.send(json.dumps(event))
+        logger.debug('Sending categories to %s', event.get('to'))
+        self.send_json(event)
 
     def unregistered(self, event):
-        self.send(json.dumps(event))
+        self.send_json(event)
+        if event.get('device_id') in ('all', self.handler.device_id) and not event.get('replayed'):
+            self.deliver(self.handler.leave_team_groups())
 
 
-class GameMasterConsumer(WebsocketConsumer):
+class GameMasterConsumer(OutboxMixin, WebsocketConsumer):
 
     def connect(self):
-        async_to_sync(self.channel_layer.group_add)("game_master", self.channel_name)
-        self.accept()
+        self.handler = GameMasterHandler()
+        self.channel_layer_call('group_add', "game_master", self.channel_name)
+        if wants_acks(self.scope):
+            tracker.add_ack_channel(self.channel_name)
+        self.accept(self.negotiate_codec())
 
     def disconnect(self, code):
-        async_to_sync(self.channel_layer.group_discard)("game_master", self.channel_name)
+        self.channel_layer_call('group_discard', "game_master", self.channel_name)
+        tracker.discard_ack_channel(self.channel_name)
 
     def answer_reveal(self, event):
-        self.send(json.dumps(event))
+        self.send_json(event)
+
+    def game_master_batch(self, event):
+        # Notifications coalesced by the handler's Outbox, one frame each
+        for inner in event['events']:
+            getattr(self, get_handler_name(inner))(inner)
 
-    def receive(self, text_data):
+    def receive(self, text_data=None, bytes_data=None):
         try:
-            data = json.loads(text_data)
+            data = decode(text_data, bytes_data)
         except Exception as exc:
-            self.send("message received: \"{}\" is not valid json. Error: {}".format(
-                text_data, exc))
+            self.trace.received(None, text_data, bytes_data)
+            self.deliver(self.handler.invalid_json(text_data or bytes_data, exc))
             return
 
-        action_type = data.get('type')
-
-        if action_type == 'reveal_answer':
-            game_id = data.get('game')
-            try:
-                game = DuelGame.objects.get(id=game_id)
-
-            except DuelGame.DoesNotExist:
-                self.send(json.dumps({
-                    'error': 'Game with id {} does not exist'.format(game_id)
-                }))
-                return
-
-            async_to_sync(self.channel_layer.group_send)(
-                'game_master',
-                {
-                    'type': 'answer.reveal',
-                    'answer': game.correct_answer,
-                }
-            )
-        elif action_type == 'duel_game_continue':
-            game_id = data.get('game')
-            try:
-                game = DuelGame.objects.get(id=game_id)
-
-            except DuelGame.DoesNotExist:
-                self.send(json.dumps({
-                    'error': 'Game with id {} does not exist'.format(game_id)
-                }))
-                return
-            print (game.state)
-            # See the state of the game
-            game_state = game.state
-            if game_state == 0:
-                if game.is_final:
-                    teams = [game.winner.team.name for game in DuelGame.objects.filter(session=game.session, is_final=False)]
-                else:
-                    teams = [game.first_team.team.name, game.second_team.team.name]
-                async_to_sync(self.channel_layer.group_send)(
-                    'players',
-                    {
-                        'type': 'register.devices',
-                        'teams': teams,
-                        'game': game.id
-                    }
-                )
-            elif game.state == 1:
-                categories_removed = json.loads(game.categories_removed)
-                categories = dict()
-
-                if game.is_final is False:
-                    for q in game.session.quiz.question_set.all():
-                        if q.category not in categories.keys():
-                            categories[q.category] = not q.category in categories_removed
-                    send_team = game.first_team.team.name if game.first_player_turn else game.second_team.team.name
-                    async_to_sync(self.channel_layer.group_send)(
-                        'game_master',
-                        {
-                            'type': 'send.categories',
-                            'categories': categories,
-                            'team': send_team,
-                            'first_team_score': game.first_team_score,
-                            'first_team_name': game.first_team.team.name,
-                            'second_team_score': game.second_team_score,
-                            'second_team_name': game.second_team.team.name
-                        }
-                    )
-                    time.sleep(0.2)
-                    async_to_sync(self.channel_layer.group_send)(
-                        'players',
-                        {
-                            'type': 'category.send',
-                            'categories': categories,
-                            'to': send_team
-                        }
-                    )
-                else:
-                    print(categories_removed)
-                    if game.selected_category is None:
-                        categories = list({q.category for q in game.session.quiz.question_set.exclude(
-                                           category__in=categories_removed)})
-
-                        category_idx = randint(0, len(categories) - 1)
-                        game.selected_category = categories[category_idx]
-                        game.state = 2
-                        game.save()
-
-                    self.send(json.dumps({'type': "category.chosen",
-                                          'category': game.selected_category}))
-
-            elif game.state == 2:
-                # Must send the question
-                # First get the available questions
-                questions_removed = json.loads(game.session.questions_removed)
-                category = game.selected_category
-                q = Question.objects\
-                    .exclude(id__in=questions_removed)\
-                    .filter(category=category)
-                # See how many questions we can use
-                count = q.count()
-                # Get a random question we can use
-                try:
-                    random_question_index = randint(0, count-1)
-                except ValueError:
-                    self.send(json.dumps({'type': 'error',
-                                          'message': 'no questions'}))
-                    return
-                selected_question = q.all()[random_question_index]
-                session = game.session
-                questions_removed.append(selected_question.id)
-                session.questions_removed = json.dumps(questions_removed)
-                session.save()
-                # Send the data
-                if game.is_final:
-                    async_to_sync(self.channel_layer.group_send)(
-                        'game_master',
-                        {
-                            'type': 'send.question',
-                            'question_text': selected_question.question_text,
-                            'question_id': selected_question.id,
-                            'answers': {answer.number: answer.answer_text for answer in
-                                        Answer.objects.filter(question=selected_question)},
-                            'team': 'all'
-                        }
-                    )
-                    time.sleep(0.2)
-                    async_to_sync(self.channel_layer.group_send)(
-                        'players',
-                        {
-                            'type': 'question.send',
-                            'question': selected_question.question_text,
-                            'questionID': selected_question.id,
-                            'answers': {answer.number: answer.answer_text for answer in
-                                        Answer.objects.filter(question=selected_question)},
-                            'team': 'all'
-                        }
-                    )
-                    print("Sending question to all (final)")
-                    return
-
-                async_to_sync(self.channel_layer.group_send)(
-                    'game_master',
-                    {
-                        'type': 'send.question',
-                        'question_text': selected_question.question_text,
-                        'question_id': selected_question.id,
-                        'answers': {answer.number: answer.answer_text for answer in Answer.objects.filter(question=selected_question)},
-                        'team': game.first_team.team.name if game.first_player_turn else game.second_team.team.name
-                    }
-                )
-                time.sleep(0.2)
-                async_to_sync(self.channel_layer.group_send)(
-                    'players',
-                    {
-                        'type': 'question.send',
-                        'question': selected_question.question_text,
-                        'questionID': selected_question.id,
-                        'answers': {answer.number: answer.answer_text for answer in Answer.objects.filter(question=selected_question)},
-                        'team': game.first_team.team.name if game.first_player_turn else game.second_team.team.name
-                    }
-                )
-
-            elif game.state == 3:
-                # Must send the question
-                # First get the available questions
-                questions_removed = json.loads(game.session.questions_removed)
-                categories_removed = list({q.category for q in Question.objects.filter(id__in=questions_removed)})
-
-                category = Question.objects.exclude(id__in=questions_removed).exclude(category__in=categories_removed).first().category
-
-                q = Question.objects\
-                    .exclude(id__in=questions_removed)\
-                    .filter(category=category)
-                # See how many questions we can use
-                count = q.count()
-                # Get a random question we can use
-                try:
-                    random_question_index = randint(0, count-1)
-                except ValueError:
-                    self.send(json.dumps({'type': 'error',
-                                          'message': 'no questions'}))
-                    return
-                selected_question = q.all()[random_question_index]
-                # Send the data
-                async_to_sync(self.channel_layer.group_send)(
-                    'game_master',
-                    {
-                        'type': 'send.question',
-                        'question_text': selected_question.question_text,
-                        'question_id': selected_question.id,
-                        'answers': {answer.number: answer.answer_text for answer in Answer.objects.filter(question=selected_question)},
-                        'team': 'all'
-                    }
-                )
-                time.sleep(0.2)
-                async_to_sync(self.channel_layer.group_send)(
-                    'players',
-                    {
-                        'type': 'question.send',
-                        'question': selected_question.question_text,
-                        'questionID': selected_question.id,
-                        'answers': {answer.number: answer.answer_text for answer in Answer.objects.filter(question=selected_question)},
-                        'team': 'all'
-                    }
-                )
-            elif game.state == 5:
-                event = {"type": "unregistered",
-                         "device_id": "all"}
-
-                async_to_sync(self.channel_layer.group_send)('players', event)
-
-                event2 = {"type": "ranking",
-                          "first_team_score": game.first_team_score,
-                          "first_team_name": game.first_team.team.name,
-                          "second_team_score": game.second_team_score,
-                          "second_team_name": game.second_team.team.name}
-                async_to_sync(self.channel_layer.group_send)('game_master', event2)
+        self.trace.received(data, text_data, bytes_data)
+        self.play(data)
 
     def ranking(self, event):
-        self.send(json.dumps(event))
+        self.send_json(event)
+
+    def game_over(self, event):
+        self.send_json(event)
 
     def answer_receive(self, event):
-        self.send(json.dumps(event))
+        self.send_json(event)
+        tracer.notified(event.get('trace'))
 
     def category_receive(self, event):
-        self.send(json.dumps(event))
+        self.send_json(event)
 
     def register_devices(self, event):
-        self.send(
-            json.dumps(
-                {'type': 'info',
-                 'message': "Must register {} to {}".format(event.get('teams'),
-                                                            event.get('game'))}
-                ))
+        self.send_json(
+            {'type': 'info',
+             'message': "Must register {} to {}".format(event.get('teams'),
+                                                        event.get('game'))}
+        )
 
     def send_question(self, event):
-        self.send(json.dumps(event))
+        self.send_pre_encoded(event['payload'], type=event['type'], team=event.get('team'),
+                              game=event.get('game'), seq=event.get('seq'))
+        self.frame_written(event)
 
     def send_categories(self, event):
-        self.send(json.dumps(event))
+        self.send_json(event)
+        self.frame_written(event)
 
     def device_unregistered(self, event):
-        self.send(json.dumps(event))
+        self.send_json(event)
 
     def error(self, event):
-        self.send(json.dumps({
+        self.send_json({
             'error': event.get('message')
-        }))
+        })
 
     def info(self, event):
-        self.send(json.dumps({
+        self.send_json({
+            'info': event.get('message')
+        })
+
+
+class AsyncQuizConsumer(AsyncOutboxMixin, AsyncJsonWebsocketConsumer):
+    """
+    Same protocol as QuizConsumer, but runs on the event loop. All the DB work
+    of one message happens in a single database_sync_to_async call.
+    """
+
+    async def connect(self):
+        self.handler = QuizHandler()
+        await self.accept(self.negotiate_codec())
+        await self.channel_layer_call('group_add', "players", self.channel_name)
+
+    async def disconnect(self, code):
+        await self.channel_layer_batch([('group_discard', group, self.channel_name)
+                                        for group in ['players'] + list(self.handler.groups)])
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        try:
+            data = decode(text_data, bytes_data)
+        except Exception as exc:
+            self.trace.received(None, text_data, bytes_data)
+            await self.deliver(self.handler.invalid_json(text_data or bytes_data, exc))
+            return
+
+        self.trace.received(data, text_data, bytes_data)
+        await self.receive_json(data)
+
+    async def receive_json(self, content, **kwargs):
+        await self.play(content)
+
+    async def register_devices(self, event):
+        await self.send_json({
+            'type': 'register_device',
+            'teams': event.get('teams'),
+            'game': event.get('game')
+        })
+
+    async def question_send(self, event):
+        await self.send_pre_encoded(event['payload'], type='question_send', team=event.get('team'),
+                                    game=event.get('game'), seq=event.get('seq'),
+                                    session_seq=event.get('session_seq'), trace=self.delivered_trace(event))
+
+    async def category_send(self, event):
+        await self.send_json(event)
+
+    async def unregistered(self, event):
+        await self.send_json(event)
+        if event.get('device_id') in ('all', self.handler.device_id) and not event.get('replayed'):
+            await self.deliver(self.handler.leave_team_groups())
+
+
+class AsyncGameMasterConsumer(AsyncOutboxMixin, AsyncJsonWebsocketConsumer):
+
+    async def connect(self):
+        self.handler = GameMasterHandler()
+        await self.channel_layer_call('group_add', "game_master", self.channel_name)
+        if wants_acks(self.scope):
+            tracker.add_ack_channel(self.channel_name)
+        await self.accept(self.negotiate_codec())
+
+    async def disconnect(self, code):
+        await self.channel_layer_call('group_discard', "game_master", self.channel_name)
+        tracker.discard_ack_channel(self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        try:
+            data = decode(text_data, bytes_data)
+        except Exception as exc:
+            self.trace.received(None, text_data, bytes_data)
+            await self.deliver(self.handler.invalid_json(text_data or bytes_data, exc))
+            return
+
+        self.trace.received(data, text_data, bytes_data)
+        await self.receive_json(data)
+
+    async def receive_json(self, content, **kwargs):
+        await self.play(content)
+
+    async def answer_reveal(self, event):
+        await self.send_json(event)
+
+    async def game_master_batch(self, event):
+        for inner in event['events']:
+            await getattr(self, get_handler_name(inner))(inner)
+
+    async def ranking(self, event):
+        await self.send_json(event)
+
+    async def game_over(self, event):
+        await self.send_json(event)
+
+    async def answer_receive(self, event):
+        await self.send_json(event)
+        tracer.notified(event.get('trace'))
+
+    async def category_receive(self, event):
+        await self.send_json(event)
+
+    async def register_devices(self, event):
+        await self.send_json(
+            {'type': 'info',
+             'message': "Must register {} to {}".format(event.get('teams'),
+                                                        event.get('game'))}
+        )
+
+    async def send_question(self, event):
+        await self.send_pre_encoded(event['payload'], type=event['type'], team=event.get('team'),
+                                    game=event.get('game'), seq=event.get('seq'))
+        await self.frame_written(event)
+
+    async def send_categories(self, event):
+        await self.send_json(event)
+        await self.frame_written(event)
+
+    async def device_unregistered(self, event):
+        await self.send_json(event)
+
+    async def error(self, event):
+        await self.send_json({
+            'error': event.get('message')
+        })
+
+    async def info(self, event):
+        await self.send_json({
             'info': event.get('message')
-        }))
+        })
+
+
+class GameWorkerConsumer(OutboxMixin, SyncConsumer):
+    """
+    Worker owning the sessions hashed to its channel (see contest.sharding).
+    Plays the messages the websocket consumers forward, and delivers the
+    handler's outbox on behalf of their connection.
+    """
+    connection = None
+
+    def connection_channel(self):
+        return self.connection
+
+    def holder_channel(self):
+        return self.scope['channel']
+
+    def track_group(self, method, group):
+        # The groups are the connections', counted by their consumers
+        pass
+
+    def send_json(self, payload):
+        self.channel_layer_call('send', self.connection, {'type': 'outbox.reply', 'payload': payload})
+
+    def replay_frame(self, event):
+        # Played by the connection's consumer, after the replies before it
+        self.channel_layer_call('send', self.connection, dict(event, replayed=True))
+
+    def game_handler(self, role):
+        return QuizHandler() if role == QuizHandler.role else GameMasterHandler()
+
+    def game_message(self, event):
+        handler = self.game_handler(event['role'])
+        handler.restore(event['state'])
+        self.connection = event['reply_channel']
+        self.trace.received(event['data'])
+        self.deliver(self.trace.run(handler.receive, event['data']))
+        state = handler.state()
+        if state != event['state']:
+            self.channel_layer_call('send', self.connection, {'type': 'connection.state', 'state': state})
+
+    def quiz_content_changed(self, event):
+        # Sent by the process that changed it (see contest.content)
+        content.invalidate(event['quiz'])
+
+    def quiz_questions_changed(self, event):
+        # Sent by the process that changed them (see contest.content)
+        content.invalidate(event['quiz'])
+        engine.rebuild_sets(event['quiz'], event['question_ids'], event['categories'],
+                            owns=lambda session_id: router.owner(session_id) == self.scope['channel'])
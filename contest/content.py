@@ -0,0 +1,244 @@
+"""
+Read-only snapshots of quiz content.
+
+Questions and answers do not change while a quiz is played, so each process
+loads a quiz once (two queries) and the consumers read it from memory. The
+snapshot of a quiz is dropped whenever one of its Quiz, Question or Answer
+rows is saved or deleted through the ORM (the REST API and the admin), and
+reloaded on the next use. The game workers (see contest.sharding) are told
+over the channel layer once the change commits, and drop theirs too. Writes
+made with queryset update() or bulk_create() do not send signals and are
+not seen until a restart.
+
+A snapshot also keeps every question already encoded the way it is pushed
+to the game master and to the players, in every frame encoding, so a
+question is serialized once and only the small per-push fields (team,
+game, seq) are added to it.
+
+The questions and categories used by a session are PackedSets, whose bits
+are positions in the snapshot: questions by id, categories by their first
+question. Adding a question keeps every position, but deleting one or
+moving it to another category or quiz can shift the others, so when a
+change to the questions of a quiz commits, the sets of its sessions are
+rebuilt from their items, in memory and in the rows (see
+GameEngine.rebuild_sets), and so are their question decks. With game
+workers, each of them rebuilds the sessions it owns (see contest.sharding).
+"""
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from django.dispatch import receiver
+
+from contest.bitset import PackedSet, positions
+from contest.codec import pre_encode
+from contest.models import Quiz, Question, Answer
+from contest.sharding import send_to_workers, workers
+
+
+QuestionContent = namedtuple('QuestionContent', ['id', 'text', 'category', 'answers', 'correct_answer'])
+AnswerContent = namedtuple('AnswerContent', ['number', 'text', 'is_correct'])
+# Pre-encoded members of a question push (see contest.codec.pre_encode)
+QuestionPayload = namedtuple('QuestionPayload', ['game_master', 'player'])
+
+
+class QuizSnapshot:
+
+    def __init__(self, quiz_id, questions, answers):
+        self.quiz_id = quiz_id
+        by_question = {}
+        for answer in answers:
+            by_question.setdefault(answer.question_id, {})[answer.number] = AnswerContent(
+                answer.number, answer.answer_text, bool(answer.is_correct))
+        self.questions = MappingProxyType({
+            question.id: QuestionContent(
+                question.id,
+                question.question_text,
+                question.category,
+                MappingProxyType(by_question.get(question.id, {})),
+                next((a.number for a in by_question.get(question.id, {}).values() if a.is_correct), None)
+            )
+            for question in questions
+        })
+        # (id, category) of every question, in id order
+        self.question_categories = tuple((question.id, question.category) for question in self.questions.values())
+        # Positions of the questions (by id) and categories, for PackedSet
+        self.question_ids, self.categories = universes(self.question_categories)
+        self.question_positions = positions(self.question_ids)
+        self.category_positions = positions(self.categories)
+        self.payloads = MappingProxyType({
+            question.id: QuestionPayload(
+                pre_encode(question_text=question.text,
+                           question_id=question.id,
+                           answers=self._answer_texts(question)),
+                pre_encode(question=question.text,
+                           questionID=question.id,
+                           answers=self._answer_texts(question))
+            )
+            for question in self.questions.values()
+        })
+
+    @staticmethod
+    def _answer_texts(question):
+        return {answer.number: answer.text for answer in question.answers.values()}
+
+    def question(self, question_id):
+        """
+        Returns the QuestionContent of the id, or None if it is not in the quiz.
+        """
+        try:
+            return self.questions.get(int(question_id))
+        except (TypeError, ValueError):
+            return None
+
+    def question_set(self, data=b''):
+        return PackedSet.from_bytes(self.question_ids, self.question_positions, data)
+
+    def category_set(self, data=b''):
+        return PackedSet.from_bytes(self.categories, self.category_positions, data)
+
+    def question_set_of(self, items):
+        """
+        The questions of items (ids, or a PackedSet of another snapshot) still in the quiz.
+        """
+        return PackedSet.from_items(self.question_ids, self.question_positions, items)
+
+    def category_set_of(self, items):
+        return PackedSet.from_items(self.categories, self.category_positions, items)
+
+    def payload(self, question_id):
+        """
+        Returns the QuestionPayload of the id, or None if it is not in the quiz.
+        """
+        try:
+            return self.payloads.get(int(question_id))
+        except (TypeError, ValueError):
+            return None
+
+
+def universes(questions):
+    """
+    The question ids and the categories of (id, category) pairs ordered by
+    id, in the order of their PackedSet positions.
+    """
+    question_ids = []
+    categories = []
+    for question_id, category in questions:
+        question_ids.append(question_id)
+        if category not in categories:
+            categories.append(category)
+    return tuple(question_ids), tuple(categories)
+
+
+def quiz_questions(quiz_id):
+    """
+    The (id, category) of the questions of the quiz as the database has
+    them, in id order (one query).
+    """
+    return tuple(Question.objects.filter(quiz_id=quiz_id).order_by('id').values_list('id', 'category'))
+
+
+class ContentCache:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshots = {}
+        # quiz id -> its questions before the uncommitted changes to them
+        self.changing = {}
+
+    def snapshot(self, quiz_id):
+        snapshot = self.snapshots.get(quiz_id)
+        if snapshot is None:
+            with self.lock:
+                snapshot = self.snapshots.get(quiz_id)
+                if snapshot is None:
+                    snapshot = QuizSnapshot(
+                        quiz_id,
+                        Question.objects.filter(quiz_id=quiz_id).order_by('id'),
+                        Answer.objects.filter(question__quiz_id=quiz_id).order_by('id')
+                    )
+                    self.snapshots[quiz_id] = snapshot
+        return snapshot
+
+    def invalidate(self, quiz_id=None):
+        with self.lock:
+            if quiz_id is None:
+                self.snapshots = {}
+            else:
+                self.snapshots.pop(quiz_id, None)
+
+    def changed(self, quiz_id=None):
+        """
+        Drops the snapshot of a quiz whose content changed (every snapshot
+        without quiz_id), here and, once the change commits, in the game
+        workers.
+        """
+        self.invalidate(quiz_id)
+        if workers():
+            transaction.on_commit(lambda: send_to_workers({'type': 'quiz.content_changed', 'quiz': quiz_id}))
+
+    def questions_changing(self, quiz_id):
+        """
+        Called before a question of the quiz is saved or deleted, and
+        questions_changed() after: the sets and decks of its sessions are
+        rebuilt once the change commits, if its questions moved.
+        """
+        before = quiz_questions(quiz_id)
+        with self.lock:
+            # The first change of a transaction knows what the sets were built on
+            self.changing.setdefault(quiz_id, before)
+
+    def questions_changed(self, quiz_id):
+        self.changed(quiz_id)
+        transaction.on_commit(lambda: self.rebuild_sets(quiz_id))
+
+    def rebuild_sets(self, quiz_id):
+        with self.lock:
+            before = self.changing.pop(quiz_id, None)
+        self.invalidate(quiz_id)
+        if before is None or before == quiz_questions(quiz_id):
+            return
+        question_ids, categories = universes(before)
+        if workers():
+            # The sessions are played, and their rows written, by their workers
+            send_to_workers({'type': 'quiz.questions_changed', 'quiz': quiz_id,
+                             'question_ids': list(question_ids), 'categories': list(categories)})
+        else:
+            # Imports this module
+            from contest.engine import engine
+            engine.rebuild_sets(quiz_id, question_ids, categories)
+
+
+content = ContentCache()
+
+
+@receiver([post_save, post_delete], sender=Quiz)
+def quiz_changed(sender, instance, **kwargs):
+    content.changed(instance.id)
+
+
+@receiver([pre_save, pre_delete], sender=Question)
+def question_changing(sender, instance, **kwargs):
+    quiz_ids = {instance.quiz_id}
+    if instance.pk is not None:
+        # Moved from another quiz
+        quiz_ids.update(Question.objects.filter(id=instance.pk).values_list('quiz_id', flat=True))
+    for quiz_id in quiz_ids:
+        content.questions_changing(quiz_id)
+    instance.changing_quiz_ids = quiz_ids
+
+
+@receiver([post_save, post_delete], sender=Question)
+def question_changed(sender, instance, **kwargs):
+    for quiz_id in getattr(instance, 'changing_quiz_ids', {instance.quiz_id}):
+        content.questions_changed(quiz_id)
+
+
+@receiver([post_save, post_delete], sender=Answer)
+def answer_changed(sender, instance, **kwargs):
+    quiz_id = Question.objects.filter(id=instance.question_id).values_list('quiz_id', flat=True).first()
+    # When the whole question is being deleted it is gone already and we
+    # don't know the quiz, so every snapshot is dropped (quiz_id is None)
+    content.changed(quiz_id)
@@ -0,0 +1,94 @@
+import json
+import random
+
+
+class QuestionDeck:
+    """
+    The questions of a session, shuffled once per category when the session
+    starts. Drawing the next question of a category is a list lookup, and the
+    deck only changes by how far each category has been drawn, which is what
+    gets saved as the game goes on.
+    """
+
+    def __init__(self, cards, drawn=None):
+        # category -> shuffled question ids, in the quiz's category order
+        self.cards = cards
+        # category -> how many of its cards were drawn
+        self.drawn = drawn or {}
+
+    @classmethod
+    def build(cls, questions, seed, exclude=()):
+        """
+        questions is an iterable of (question id, category), in quiz order.
+        """
+        cards = {}
+        for question_id, category in questions:
+            cards.setdefault(category, [])
+            if question_id not in exclude:
+                cards[category].append(question_id)
+        shuffler = random.Random(seed)
+        for category in cards:
+            cards[category].sort()
+            shuffler.shuffle(cards[category])
+        return cls(cards)
+
+    @classmethod
+    def from_json(cls, cards, drawn):
+        return cls(json.loads(cards or '{}'), json.loads(drawn or '{}'))
+
+    def cards_json(self):
+        return json.dumps(self.cards)
+
+    def drawn_json(self):
+        return json.dumps(self.drawn)
+
+    def rebuilt(self, questions, exclude=()):
+        """
+        The deck on the questions of the quiz as they are now (questions as
+        in build), after some were added, deleted or moved to another
+        category. The cards drawn stay drawn. The cards left in a category
+        are the ones still in it, and the new ones are shuffled in with
+        them. Categories without questions anymore are dropped.
+        """
+        by_category = {}
+        for question_id, category in questions:
+            by_category.setdefault(category, set()).add(question_id)
+        known = set(exclude)
+        for category, cards in self.cards.items():
+            known.update(cards[:self.drawn.get(category, 0)])
+        cards, drawn = {}, {}
+        for category, question_ids in by_category.items():
+            position = self.drawn.get(category, 0)
+            left = [question_id for question_id in self.cards.get(category, [])[position:]
+                    if question_id in question_ids]
+            added = sorted(question_ids - known - set(left))
+            if added:
+                left += added
+                random.shuffle(left)
+            cards[category] = self.cards.get(category, [])[:position] + left
+            if position:
+                drawn[category] = position
+        return QuestionDeck(cards, drawn)
+
+    def categories(self):
+        return list(self.cards)
+
+    def draw(self, category):
+        """
+        Returns the next question id of the category, None when it ran out.
+        """
+        position = self.drawn.get(category, 0)
+        cards = self.cards.get(category, [])
+        if position >= len(cards):
+            return None
+        self.drawn[category] = position + 1
+        return cards[position]
+
+    def remaining(self, category=None):
+        if category is not None:
+            return len(self.cards.get(category, [])) - self.drawn.get(category, 0)
+        return sum(self.remaining(category) for category in self.cards)
+
+    def untouched_categories(self):
+        return [category for category, cards in self.cards.items()
+                if cards and not self.drawn.get(category)]
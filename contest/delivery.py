@@ -0,0 +1,151 @@
+"""
+Ordered delivery of the game master / players frame pairs.
+
+Category and question pushes go to the game master screen first and to the
+devices second. Both frames get a per-game sequence number and the player
+frame is held back, by the process that played the push, until the game
+master frame is out:
+
+* by default the first game master consumer that wrote the frame to its
+  socket releases the held player frame, through the channel of the
+  consumer or game worker holding it ("owner") when it is held by another
+  process;
+* game master clients that connect with ?ack=1 acknowledge the frames
+  they rendered ({"type": "ack", "game": .., "seq": ..}); while one is
+  connected the player frame is released by its ack.
+
+Either way the player frame is released after DELIVERY_ACK_TIMEOUT seconds
+if nothing released it before: no game master is connected, or its
+consumer's release or ack is lost. The sequences and frames of a game are
+dropped once it ends.
+
+Frames to the devices of a session are lost while a device's socket is
+down, so every session also keeps its last DEVICE_REPLAY_FRAMES device
+frames in a SentFrames ring, numbered by a "session_seq" field. A device
+reconnecting with the last session_seq it saw gets only the frames it
+missed, if they are all still there (see QuizHandler.connected). A player
+frame is numbered and kept when it is held back, so it is left out of the
+replays until its release sends it to the devices anyway.
+"""
+import asyncio
+import itertools
+import threading
+import time
+import uuid
+from collections import deque
+
+from django.conf import settings
+
+
+class DeliveryTracker:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sequences = {}
+        self.held = {}
+        self.ack_channels = set()
+        # Tells the frames held by this process from the others'
+        self.holder = uuid.uuid4().hex
+
+    def next_seq(self, game_id):
+        with self.lock:
+            if game_id not in self.sequences:
+                self.sequences[game_id] = itertools.count(1)
+            return next(self.sequences[game_id])
+
+    def hold(self, game_id, seq, group, event):
+        with self.lock:
+            self.held[(game_id, seq)] = (group, event)
+
+    def held_frames(self):
+        """
+        The (group, session_seq) of the held frames kept by a SentFrames.
+        """
+        with self.lock:
+            return {(group, event['session_seq']) for group, event in self.held.values() if 'session_seq' in event}
+
+    def release(self, game_id, seq):
+        """
+        Returns the held (group, event) once; None if already released.
+        """
+        with self.lock:
+            return self.held.pop((game_id, seq), None)
+
+    def forget(self, game_id):
+        """
+        Drops the sequence and the held frames of a game that ended.
+        """
+        with self.lock:
+            self.sequences.pop(game_id, None)
+            for key in [key for key in self.held if key[0] == game_id]:
+                del self.held[key]
+
+    def add_ack_channel(self, channel_name):
+        with self.lock:
+            self.ack_channels.add(channel_name)
+
+    def discard_ack_channel(self, channel_name):
+        with self.lock:
+            self.ack_channels.discard(channel_name)
+
+    def waits_for_ack(self):
+        return bool(self.ack_channels)
+
+
+tracker = DeliveryTracker()
+
+
+def ack_timeout():
+    return getattr(settings, 'DELIVERY_ACK_TIMEOUT', 1.0)
+
+
+async def release_after(channel_layer, game_id, seq, delay):
+    """
+    Sends the held frame anyway if no game master consumer or client
+    released it in time.
+    """
+    await asyncio.sleep(delay)
+    held = tracker.release(game_id, seq)
+    if held is not None:
+        await channel_layer.group_send(*held)
+
+
+class SentFrames:
+    """
+    The latest frames sent to the team and session groups of a session's
+    devices, changed under the session lock.
+    """
+
+    def __init__(self, size):
+        self.frames = deque(maxlen=size)
+        # Numbered from the time the session was loaded, in ms, so that the
+        # numbers keep growing across restarts
+        self.seq = int(time.time() * 1000)
+
+    def stamp(self, group, event):
+        """
+        Numbers a frame about to be sent to group, and keeps it.
+        """
+        self.seq += 1
+        event = dict(event, session_seq=self.seq)
+        # Replays are not traced as deliveries
+        self.frames.append((self.seq, group, {key: value for key, value in event.items() if key != 'trace'}))
+        return event
+
+    def since(self, seq, groups):
+        """
+        Returns the frames sent to groups after seq, or None if some of them
+        are no longer kept (or seq is from another run). Frames still held
+        back are left out.
+        """
+        if seq == self.seq:
+            return []
+        if seq > self.seq or not self.frames or self.frames[0][0] > seq + 1:
+            return None
+        held = tracker.held_frames()
+        return [event for frame_seq, group, event in self.frames
+                if frame_seq > seq and group in groups and (group, frame_seq) not in held]
+
+
+def replay_frames():
+    return getattr(settings, 'DEVICE_REPLAY_FRAMES', 50)
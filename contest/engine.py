@@ -0,0 +1,571 @@
+"""
+In-memory game state.
+
+The live state of every session played by this process (its DuelGame rows
+and the GameSession progress) is kept here and changed in memory. Changed
+states are written back to the database by a background thread every
+GAME_STATE_FLUSH_INTERVAL seconds, so a crash loses at most that much of
+the game, and the ORM stays the durable copy instead of the hot path.
+Every state remembers what the database holds, and only the fields that
+changed since are written: all of the changes of an interval, whatever
+handlers made them, go out in one transaction. With an interval of 0 they
+are written at the end of every handler turn instead, still in one
+transaction. So is the event log of every session (contest.events), which
+also restores the state only kept in memory when a session is loaded. The
+device registrations of the teams are written right away instead: the
+consumers of every process route a reconnecting device by its GameTeam row
+(see contest.sharding).
+
+A session must only be played by one process at a time, since each one
+keeps its own copy of the state.
+"""
+import atexit
+import json
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from operator import attrgetter
+
+from django.conf import settings
+from django.db import transaction, close_old_connections
+
+from contest import events
+from contest.bitset import PackedSet, bits_to_bytes, positions
+from contest.content import content
+from contest.deck import QuestionDeck
+from contest.delivery import SentFrames, replay_frames, tracker
+from contest.metrics import state_saves, state_commits, state_fields_written
+from contest.models import DuelGame, GameEvent, GameSession, GameSnapshot, GameTeam
+from contest.sqlite import writer
+from contest.utils import build_question_deck
+
+
+logger = logging.getLogger(__name__)
+
+# Events per INSERT, within SQLite's limit of 999 parameters
+EVENT_BATCH = 100
+
+
+class PersistentState(ABC):
+    """
+    In-memory copy of a row, written back by the engine.
+    """
+
+    @abstractmethod
+    def fields(self):
+        """
+        The fields of the row as they are in memory, as written to the
+        database.
+        """
+
+    def changes(self):
+        """
+        The fields that differ from what the database holds.
+        """
+        return {field: value for field, value in self.fields().items() if self.written.get(field) != value}
+
+    @abstractmethod
+    def log_values(self):
+        """
+        The fields recorded in the event log as immutable values, cheap to
+        take at every event (see log_fields).
+        """
+
+    @abstractmethod
+    def log_fields(self, values=None):
+        """
+        The fields recorded in the event log, from log_values (the current
+        ones by default), compared as they are and only made JSON values
+        when written (see contest.events.encode).
+        """
+
+    def save(self, kind=None, team_id=None, **data):
+        """
+        Marks the state for writing back, and records the transition of the
+        given kind (see contest.models.GAME_EVENT_KINDS) in the event log.
+        """
+        state_saves.inc()
+        events.record(self, kind, team_id, data)
+        self.engine.mark_dirty(self)
+
+
+class SessionState(PersistentState):
+    model = GameSession
+
+    def __init__(self, engine, session, teams):
+        self.engine = engine
+        self.id = session.id
+        self.quiz_id = session.quiz_id
+        self.games_order = session.games_order
+        self.used_questions = content.snapshot(session.quiz_id).question_set(session.used_questions)
+        if session.question_deck == '{}':
+            # Session started before decks existed
+            build_question_deck(session, exclude=set(self.used_questions))
+            writer.run(session.save, update_fields=['deck_seed', 'question_deck', 'deck_drawn'])
+        self.deck = QuestionDeck.from_json(session.question_deck, session.deck_drawn)
+        self.question_deck = session.question_deck
+        # gameteam id -> team name (and back), for every team of the session
+        self.teams = {gt.id: gt.team.name for gt in teams}
+        self.teams_by_name = {name: gameteam_id for gameteam_id, name in self.teams.items()}
+        # gameteam id -> id of its registered device, or None
+        self.devices = {gt.id: gt.device_unique_id if gt.device_registered else None for gt in teams}
+        self.written = self.fields()
+        # game_order -> GameState
+        self.games = {}
+        self.lock = threading.RLock()
+        # Event log: the states saved since the last event, the events and
+        # snapshots not written yet
+        self.event_seq = 0
+        self.next_snapshot = 0
+        self.unlogged = set()
+        self.pending_events = []
+        self.pending_snapshots = []
+        # The latest frames to the devices, for those that missed them
+        self.sent = SentFrames(replay_frames())
+
+    def team_name(self, gameteam_id):
+        return self.teams.get(gameteam_id)
+
+    def current_game(self):
+        return self.games.get(self.games_order)
+
+    def fields(self):
+        return {
+            'games_order': self.games_order,
+            'used_questions': self.used_questions.to_bytes(),
+            'deck_drawn': self.deck.drawn_json(),
+            'question_deck': self.question_deck,
+        }
+
+    def rebuild_deck(self, snapshot):
+        """
+        Rebuilds the deck on the questions of the quiz snapshot.
+        """
+        deck = self.deck.rebuilt(snapshot.question_categories, exclude=self.used_questions)
+        if deck.cards != self.deck.cards:
+            self.deck = deck
+            self.question_deck = deck.cards_json()
+
+    def log_values(self):
+        return (self.games_order, self.used_questions.bits, tuple(self.deck.drawn.items()),
+                tuple(self.devices.items()))
+
+    def log_fields(self, values=None):
+        games_order, used_questions, deck_drawn, devices = values or self.log_values()
+        return {
+            'games_order': games_order,
+            'used_questions': bits_to_bytes(used_questions),
+            'deck_drawn': json.dumps(dict(deck_drawn)),
+            'devices': dict(devices),
+        }
+
+
+class GameState(PersistentState):
+    model = DuelGame
+
+    FIELDS = ['state', 'first_team_id', 'second_team_id', 'third_team_id',
+              'first_team_score', 'second_team_score', 'third_team_score',
+              'first_player_turn', 'selected_category', 'answer_count',
+              'round_winner', 'winner_id', 'correct_answer']
+    row_values = attrgetter(*FIELDS)
+
+    def __init__(self, engine, session, game):
+        self.engine = engine
+        self.session = session
+        self.id = game.id
+        self.session_id = game.session_id
+        self.is_final = game.is_final
+        self.game_order = game.game_order
+        for field in self.FIELDS:
+            setattr(self, field, getattr(game, field))
+        self.used_categories = content.snapshot(session.quiz_id).category_set(game.used_categories)
+        # The question being answered, the teams that answered it and what
+        # happened in the round, only kept in memory (and in the event log)
+        self.question_id = None
+        self.answered = set()
+        self.round_log = []
+        self.written = self.fields()
+        # What a reconnecting device is sent, built on first use after a save
+        # or once the quiz content changed
+        self.cached_view = None
+        self.view_snapshot = None
+
+    @property
+    def team_ids(self):
+        return [self.first_team_id, self.second_team_id, self.third_team_id]
+
+    def fields(self):
+        fields = {field: getattr(self, field) for field in self.FIELDS}
+        fields['used_categories'] = self.used_categories.to_bytes()
+        return fields
+
+    def log_values(self):
+        return (self.row_values(self), self.used_categories.bits, self.question_id, frozenset(self.answered),
+                tuple(self.round_log))
+
+    def log_fields(self, values=None):
+        row, used_categories, question_id, answered, round_log = values or self.log_values()
+        fields = dict(zip(self.FIELDS, row))
+        fields['used_categories'] = bits_to_bytes(used_categories)
+        fields['question_id'] = question_id
+        fields['answered'] = answered
+        fields['round_log'] = round_log
+        return fields
+
+    def restore(self, logged):
+        self.question_id = logged.get('question_id')
+        self.answered = set(logged.get('answered', ()))
+        self.round_log = list(logged.get('round_log', ()))
+
+    def save(self, kind=None, team_id=None, **data):
+        self.cached_view = None
+        if kind == 'game_end':
+            # No more pushes are ordered for it
+            tracker.forget(self.id)
+        super().save(kind, team_id, **data)
+
+    def turn_team_id(self):
+        """
+        The team choosing or answering in a duel, None in the final and on a tie.
+        """
+        if self.is_final or self.state == 3:
+            return None
+        return self.first_team_id if self.first_player_turn else self.second_team_id
+
+    def view(self):
+        """
+        The whole state of the game as sent to a device, along with the
+        team the current question was pushed to ("all" for every team), if
+        one is being answered. Read under the session lock; the same dict
+        is returned until the next save or content change, and must not be
+        modified.
+        """
+        snapshot = content.snapshot(self.session.quiz_id)
+        if self.cached_view is None or self.view_snapshot is not snapshot:
+            session = self.session
+            view = {
+                'game': self.id,
+                'state': self.state,
+                'is_final': self.is_final,
+                'selected_category': self.selected_category,
+                'turn': session.team_name(self.turn_team_id()),
+                'scores': [{'team': session.team_name(team_id), 'score': score}
+                           for team_id, score in zip(self.team_ids, [self.first_team_score, self.second_team_score,
+                                                                     self.third_team_score])
+                           if team_id is not None],
+                'question': None,
+            }
+            question = None
+            if self.state in (2, 3) and self.question_id is not None:
+                question = snapshot.question(self.question_id)
+            if question is not None:
+                view['question'] = {
+                    'question': question.text,
+                    'questionID': question.id,
+                    'answers': {answer.number: answer.text for answer in question.answers.values()},
+                }
+            turn = self.turn_team_id()
+            self.cached_view = (view, session.team_name(turn) if turn is not None else 'all')
+            self.view_snapshot = snapshot
+        return self.cached_view
+
+
+class GameEngine:
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.sessions = {}
+        self.games = {}
+        self.dirty = set()
+        self.flusher = None
+        # One flush at a time: one that read older values must not commit
+        # after a newer one
+        self.flush_lock = threading.Lock()
+        # device id -> (session id, gameteam id) of its latest registration,
+        # or None once it was unregistered
+        self.devices = {}
+
+    def _load_session(self, session_id):
+        session = GameSession.objects.get(id=session_id)
+        teams = GameTeam.objects.filter(game_session_id=session_id).select_related('team')
+        session_state = SessionState(self, session, teams)
+        for game in DuelGame.objects.filter(session_id=session_id):
+            game_state = GameState(self, session_state, game)
+            session_state.games[game.game_order] = game_state
+            self.games[game.id] = game_state
+        replayed = events.replay(session_id)
+        if replayed is not None:
+            session_state.event_seq = replayed['seq']
+            session_state.next_snapshot = replayed['snapshot'] + events.snapshot_every()
+            for game_state in session_state.games.values():
+                game_state.restore(replayed['games'].get(str(game_state.id), {}))
+        events.start(session_state)
+        self.sessions[session_id] = session_state
+        if replayed is None:
+            # The log starts here
+            events.snapshot(session_state)
+            self.mark_dirty(session_state)
+        for gameteam_id, device_id in session_state.devices.items():
+            known = self.devices.get(device_id)
+            # Like the database lookup, the latest registration wins
+            if device_id is not None and (known is None or known[1] < gameteam_id):
+                self.devices[device_id] = (session_id, gameteam_id)
+        return session_state
+
+    def session(self, session_id):
+        with self.lock:
+            if session_id not in self.sessions:
+                try:
+                    self._load_session(session_id)
+                except GameSession.DoesNotExist:
+                    return None
+            return self.sessions[session_id]
+
+    def game(self, game_id):
+        """
+        Returns the GameState of a DuelGame id, or None if there is no such game.
+        """
+        try:
+            game_id = int(game_id)
+        except (TypeError, ValueError):
+            return None
+        with self.lock:
+            if game_id not in self.games:
+                session_id = DuelGame.objects.filter(id=game_id).values_list('session_id', flat=True).first()
+                if session_id is None or self.session(session_id) is None:
+                    return None
+            return self.games.get(game_id)
+
+    def device(self, device_id):
+        """
+        Returns the (SessionState, gameteam id) the device is registered
+        to, or None. Costs one indexed query the first time a registered
+        device is looked up (plus loading its session, if needed), none
+        afterwards. Devices never registered cost the query every time:
+        any id can be sent, so remembering them would grow without bound.
+        """
+        with self.lock:
+            if device_id not in self.devices:
+                registration = GameTeam.objects.filter(
+                    device_unique_id=device_id, device_registered=True
+                ).order_by('id').values_list('game_session_id', 'id').last()
+                if registration is None:
+                    return None
+                self.devices[device_id] = registration
+            registration = self.devices[device_id]
+            if registration is None:
+                return None
+            session = self.session(registration[0])
+            if session is None:
+                return None
+            return session, registration[1]
+
+    def register_device(self, session, gameteam_id, device_id):
+        """
+        Registers the device for the team, and returns the device it
+        replaces (None if there was none).
+        """
+        with session.lock:
+            writer.run(self.write, [(GameTeam, {'id': gameteam_id},
+                                     {'device_registered': True, 'device_unique_id': device_id})])
+            with self.lock:
+                previous = session.devices.get(gameteam_id)
+                if previous is not None and self.devices.get(previous) == (session.id, gameteam_id):
+                    self.devices[previous] = None
+                session.devices[gameteam_id] = device_id
+                self.devices[device_id] = (session.id, gameteam_id)
+            session.save('device_registered', gameteam_id, device=device_id)
+        return previous
+
+    def reset_devices(self, session):
+        """
+        Unregisters every device of the session, at the end of a duel.
+        """
+        with session.lock:
+            writer.run(self.write, [(GameTeam, {'game_session_id': session.id},
+                                     {'device_registered': False, 'device_unique_id': None})])
+            with self.lock:
+                for gameteam_id, device_id in session.devices.items():
+                    if device_id is not None and self.devices.get(device_id) == (session.id, gameteam_id):
+                        self.devices[device_id] = None
+                    session.devices[gameteam_id] = None
+            session.save('devices_reset')
+
+    def rebuild_sets(self, quiz_id, question_ids, categories, owns=None):
+        """
+        Rebuilds the questions and categories used by the sessions of the
+        quiz on its current snapshot, after its questions changed (see
+        contest.content): question_ids and categories are the universes the
+        sets were built on. Their question decks are rebuilt too. The rows
+        of the sessions not loaded are rewritten while none can be loaded,
+        the loaded ones are saved. With owns, a game worker only rewrites
+        the rows of the sessions owns(session id) is true for, the others
+        are its peers' (see contest.sharding).
+        """
+        snapshot = content.snapshot(quiz_id)
+        question_positions, category_positions = positions(question_ids), positions(categories)
+        with self.lock:
+            loaded = [session for session in self.sessions.values() if session.quiz_id == quiz_id]
+            not_loaded = GameSession.objects.filter(quiz_id=quiz_id).exclude(id__in=[session.id for session in loaded])
+            # session id -> {game id or "session": changed fields}
+            changes = {}
+            # session id -> its rebuilt deck, not in the event log
+            decks = {}
+            for session_id, data, cards, drawn in not_loaded.values_list('id', 'used_questions', 'question_deck',
+                                                                         'deck_drawn'):
+                if owns is not None and not owns(session_id):
+                    continue
+                used = snapshot.question_set_of(PackedSet.from_bytes(question_ids, question_positions, data))
+                session_changes = {}
+                if used.to_bytes() != bytes(data):
+                    session_changes['used_questions'] = used.to_bytes()
+                deck = QuestionDeck.from_json(cards, drawn)
+                rebuilt = deck.rebuilt(snapshot.question_categories, exclude=used)
+                # Sessions started before decks existed get one when loaded
+                if deck.cards and rebuilt.cards != deck.cards:
+                    decks[session_id] = {'question_deck': rebuilt.cards_json()}
+                    if rebuilt.drawn != deck.drawn:
+                        session_changes['deck_drawn'] = rebuilt.drawn_json()
+                if session_changes:
+                    changes.setdefault(session_id, {})['session'] = session_changes
+            games = DuelGame.objects.filter(session__in=not_loaded)
+            for game_id, session_id, data in games.values_list('id', 'session_id', 'used_categories'):
+                if owns is not None and not owns(session_id):
+                    continue
+                used = PackedSet.from_bytes(categories, category_positions, data)
+                rebuilt = snapshot.category_set_of(used).to_bytes()
+                if rebuilt != bytes(data):
+                    changes.setdefault(session_id, {})[str(game_id)] = {'used_categories': rebuilt}
+            writes = []
+            for session_id, session_changes in changes.items():
+                for key, fields in session_changes.items():
+                    if key == 'session':
+                        writes.append((GameSession, {'id': session_id}, dict(fields, **decks.pop(session_id, {}))))
+                    else:
+                        writes.append((DuelGame, {'id': int(key)}, fields))
+            writes += [(GameSession, {'id': session_id}, fields) for session_id, fields in decks.items()]
+            if writes:
+                writer.run(self.write, writes, events.logged_apart(changes))
+        for session in loaded:
+            with session.lock:
+                session.used_questions = snapshot.question_set_of(session.used_questions)
+                session.rebuild_deck(snapshot)
+                session.save()
+                for game in session.games.values():
+                    game.used_categories = snapshot.category_set_of(game.used_categories)
+                    game.save()
+
+    @contextmanager
+    def locked(self, game_id):
+        """
+        Serializes the transitions of the session the game belongs to.
+        """
+        game = self.game(game_id)
+        if game is None:
+            yield
+            return
+        with game.session.lock:
+            yield
+        if flush_interval() <= 0:
+            # The handler turn is the unit of work
+            self.flush()
+
+    def mark_dirty(self, state):
+        with self.lock:
+            self.dirty.add(state)
+            if self.flusher is None and flush_interval() > 0:
+                self.flusher = threading.Thread(target=self._flush_forever, name='game-state-flusher',
+                                                daemon=True)
+                self.flusher.start()
+
+    def flush(self):
+        with self.flush_lock:
+            self._flush()
+
+    def _flush(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+        sessions = {}
+        for state in dirty:
+            sessions.setdefault(state if isinstance(state, SessionState) else state.session, []).append(state)
+        # (state, changed fields)
+        changes = []
+        # (session, events, snapshots)
+        logs = []
+        for session, states in sessions.items():
+            # Read under the session lock, so a half applied transition is
+            # never written, along with the events up to there
+            with session.lock:
+                events.settle(session)
+                logs.append((session,) + events.take(session))
+                for state in states:
+                    changes.append((state, state.changes()))
+        writes = [(state.model, {'id': state.id}, fields) for state, fields in changes if fields]
+        new_events, new_snapshots = [], []
+        # session -> what its log holds once written
+        logged = {}
+        for session, session_events, snapshots in logs:
+            event_rows, snapshot_rows, logged[session] = events.rows(session, session_events, snapshots)
+            new_events += event_rows
+            new_snapshots += snapshot_rows
+        if not writes and not new_events and not new_snapshots:
+            return
+        try:
+            writer.run(self.write, writes, new_events, new_snapshots)
+        except Exception:
+            for session, session_events, snapshots in logs:
+                with session.lock:
+                    events.put_back(session, session_events, snapshots)
+            with self.lock:
+                self.dirty.update(dirty)
+            raise
+        state_commits.inc()
+        state_fields_written.inc(sum(len(fields) for model, lookup, fields in writes))
+        for state, fields in changes:
+            session = state if isinstance(state, SessionState) else state.session
+            with session.lock:
+                state.written.update(fields)
+        for session, session_logged in logged.items():
+            session.logged = session_logged
+
+    def write(self, writes, new_events=(), new_snapshots=()):
+        # Joins the writer's transaction in the SQLite production mode
+        with transaction.atomic(savepoint=False):
+            for model, lookup, fields in writes:
+                model.objects.filter(**lookup).update(**fields)
+            if new_events:
+                GameEvent.objects.bulk_create(new_events, batch_size=EVENT_BATCH)
+            if new_snapshots:
+                GameSnapshot.objects.bulk_create(new_snapshots)
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(flush_interval())
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Flushing game state failed')
+            finally:
+                close_old_connections()
+
+    def reset(self):
+        """
+        Forgets every cached state; the next access reloads from the database.
+        """
+        with self.lock:
+            for game_id in self.games:
+                tracker.forget(game_id)
+            self.sessions = {}
+            self.games = {}
+            self.dirty = set()
+            self.devices = {}
+
+
+def flush_interval():
+    return getattr(settings, 'GAME_STATE_FLUSH_INTERVAL', 0.5)
+
+
+engine = GameEngine()
+atexit.register(engine.flush)
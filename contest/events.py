@@ -0,0 +1,264 @@
+"""
+Event log of the game transitions.
+
+Every transition of a session (a device registered, a category chosen, a
+question sent, an answer, a score change, the end of a round or game) is
+appended to its log as a GameEvent, numbered by seq within the session,
+along with the fields it changed in the session and its games. The events
+are kept with the session (contest.engine), as plain tuples, and turned
+into rows and inserted in bulk by the flush that writes the changed rows,
+in the same transaction, so the log and the rows never disagree. An event
+only takes the values of the states saved since the previous one (see
+PersistentState.log_values), which is cheap enough for every transition:
+the fields they changed are worked out by the flush, against what the
+events before them recorded.
+
+Every GAME_SNAPSHOT_EVERY events, and when a session without a snapshot
+is loaded, the whole state is written as a GameSnapshot: replay() rebuilds
+the state at any seq from the latest snapshot before it and the events
+since. The engine replays the log when it loads a session, for the state
+only kept in memory (the question being answered, the teams that answered
+it, the round log), and the replay_session command prints it for audits.
+
+A save without a kind is not an event by itself: its changes go with the
+next event of the session, or with a "state" event at the next flush.
+"""
+import json
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Max
+from django.utils import timezone
+
+from contest.models import GAME_EVENT_KINDS, DuelGame, GameEvent, GameSession, GameSnapshot, GameTeam
+
+
+KINDS = {name: kind for kind, name in GAME_EVENT_KINDS}
+
+# Changed apart from the event that changed them, as a "score" event
+SCORE_FIELDS = ('first_team_score', 'second_team_score', 'third_team_score')
+
+
+def snapshot_every():
+    return getattr(settings, 'GAME_SNAPSHOT_EVERY', 100)
+
+
+def dumps(value):
+    return json.dumps(value, separators=(',', ':'))
+
+
+def encode(fields):
+    """
+    The log fields of a state (see PersistentState.log_fields) as JSON values.
+    """
+    return {field: value.hex() if isinstance(value, bytes) else
+            sorted(value) if isinstance(value, frozenset) else value
+            for field, value in fields.items()}
+
+
+def log_key(state):
+    return 'session' if state is state_session(state) else str(state.id)
+
+
+def state_session(state):
+    return getattr(state, 'session', state)
+
+
+def record(state, kind=None, team_id=None, data=None):
+    """
+    Records a save of the state (a SessionState or GameState), under the
+    lock of its session, as an event of the given kind.
+    """
+    session = state_session(state)
+    session.unlogged.add(state)
+    if kind is not None:
+        append(session, kind, None if state is session else state.id, team_id, data or {})
+
+
+def settle(session):
+    """
+    Records the changes not part of an event yet, before a flush.
+    """
+    if session.unlogged:
+        append(session, 'state', None, None, {})
+
+
+def start(session):
+    """
+    Takes the state of a loaded session as what its log holds.
+    """
+    session.logged = {'session': session.log_fields()}
+    for game in session.games.values():
+        session.logged[log_key(game)] = game.log_fields()
+        game.logged_scores = scores(game)
+
+
+def scores(game):
+    return game.first_team_score, game.second_team_score, game.third_team_score
+
+
+def append(session, kind, game_id, team_id, data):
+    taken = [(state, state.log_values()) for state in session.unlogged]
+    session.unlogged = set()
+    for state, values in taken:
+        if state is session:
+            continue
+        game_scores = scores(state)
+        if game_scores != state.logged_scores:
+            state.logged_scores = game_scores
+            # A score change is an event of its own, before the one that made it
+            if state.id == game_id and kind != 'score':
+                add_event(session, 'score', game_id, team_id, {}, [(state, values)], SCORE_FIELDS)
+    add_event(session, kind, game_id, team_id, data, taken)
+    if session.event_seq >= session.next_snapshot:
+        snapshot(session)
+
+
+def add_event(session, kind, game_id, team_id, data, taken, only=None):
+    session.event_seq += 1
+    session.pending_events.append(
+        (session.event_seq, KINDS[kind], game_id, team_id, data, taken, only, time.time()))
+
+
+def full_state(session):
+    return {
+        'session': session.log_fields(),
+        'games': {str(game.id): game.log_fields() for game in session.games.values()},
+    }
+
+
+def snapshot(session):
+    session.next_snapshot = session.event_seq + snapshot_every()
+    session.pending_snapshots.append((session.event_seq, full_state(session)))
+
+
+def take(session):
+    """
+    Returns the events and snapshots of the session to insert, under its lock.
+    """
+    events, session.pending_events = session.pending_events, []
+    snapshots, session.pending_snapshots = session.pending_snapshots, []
+    return events, snapshots
+
+
+def put_back(session, events, snapshots):
+    session.pending_events[:0] = events
+    session.pending_snapshots[:0] = snapshots
+
+
+def rows(session, events, snapshots):
+    """
+    The GameEvent and GameSnapshot rows of the events and snapshots taken
+    from the session, and what its log holds once they are written.
+    """
+    tz = timezone.utc if settings.USE_TZ else None
+    logged = dict(session.logged)
+    event_rows = []
+    for seq, kind, game_id, team_id, data, taken, only, created in events:
+        changes = {}
+        for state, values in taken:
+            key = log_key(state)
+            before = logged.get(key, {})
+            changed = {field: value for field, value in state.log_fields(values).items()
+                       if (only is None or field in only) and before.get(field) != value}
+            if changed:
+                changes[key] = changed
+                logged[key] = dict(before, **changed)
+        event_rows.append(GameEvent(session_id=session.id, seq=seq, kind=kind, game_id=game_id, team_id=team_id,
+                                    data=dumps(data),
+                                    changes=dumps({key: encode(fields) for key, fields in changes.items()}),
+                                    created=datetime.fromtimestamp(created, tz)))
+    snapshot_rows = [GameSnapshot(session_id=session.id, seq=seq, state=dumps({
+        'session': encode(state['session']),
+        'games': {key: encode(fields) for key, fields in state['games'].items()},
+    })) for seq, state in snapshots]
+    return event_rows, snapshot_rows, logged
+
+
+def logged_apart(changes):
+    """
+    The "state" GameEvent rows of changes made to the rows of sessions that
+    are not loaded, {session id: {game id or "session": changed fields}},
+    each after the latest seq of its session. Sessions without a log are
+    left out.
+    """
+    latest = {}
+    for model in (GameEvent, GameSnapshot):
+        found = model.objects.filter(session_id__in=changes).values('session_id').annotate(seq=Max('seq'))
+        for session_id, seq in found.values_list('session_id', 'seq'):
+            latest[session_id] = max(seq, latest.get(session_id, seq))
+    created = timezone.now()
+    return [GameEvent(session_id=session_id, seq=latest[session_id] + 1, kind=KINDS['state'], data=dumps({}),
+                      changes=dumps({key: encode(fields) for key, fields in session_changes.items()}),
+                      created=created)
+            for session_id, session_changes in changes.items() if session_id in latest]
+
+
+def apply(state, event):
+    for key, changed in json.loads(event.changes).items():
+        if key == 'session':
+            state['session'].update(changed)
+        else:
+            state['games'].setdefault(key, {}).update(changed)
+
+
+def replay(session_id, upto=None):
+    """
+    Returns the state of the session once the events up to seq upto (the
+    last one by default) were applied, as {'seq', 'snapshot', 'session',
+    'games'}, or None when there is no snapshot to start from.
+    """
+    snapshots = GameSnapshot.objects.filter(session_id=session_id)
+    if upto is not None:
+        snapshots = snapshots.filter(seq__lte=upto)
+    snapshot = snapshots.order_by('-seq').first()
+    if snapshot is None:
+        return None
+    state = json.loads(snapshot.state)
+    state['seq'] = state['snapshot'] = snapshot.seq
+    events = GameEvent.objects.filter(session_id=session_id, seq__gt=snapshot.seq)
+    if upto is not None:
+        events = events.filter(seq__lte=upto)
+    for event in events.order_by('seq').only('seq', 'changes'):
+        apply(state, event)
+        state['seq'] = event.seq
+    return state
+
+
+def history(session_id):
+    """
+    The events of the session, in order.
+    """
+    return GameEvent.objects.filter(session_id=session_id).order_by('seq')
+
+
+def mismatches(session_id):
+    """
+    Compares the replayed state of the session with its rows, and returns
+    the differences as (game id or "session", field, replayed, row), or
+    None when the session has no log. Only meaningful once flushed.
+    """
+    state = replay(session_id)
+    if state is None:
+        return None
+    rows = {'session': GameSession.objects.get(id=session_id)}
+    rows.update((str(game.id), game) for game in DuelGame.objects.filter(session_id=session_id))
+    devices = {str(gameteam.id): gameteam.device_unique_id if gameteam.device_registered else None
+               for gameteam in GameTeam.objects.filter(game_session_id=session_id)}
+    found = []
+    for key, fields in [('session', state['session'])] + sorted(state['games'].items()):
+        for field, value in sorted(fields.items()):
+            if field == 'devices':
+                row_value = devices
+            elif hasattr(rows[key], field):
+                row_value = getattr(rows[key], field)
+                if isinstance(row_value, memoryview):
+                    row_value = bytes(row_value)
+                row_value = encode({field: row_value})[field]
+            else:
+                # Only kept in memory
+                continue
+            if value != row_value:
+                found.append((key, field, value, row_value))
+    return found
@@ -0,0 +1,806 @@
+import json
+import logging
+from collections import namedtuple
+from random import randint
+
+from contest.content import content
+from contest.delivery import tracker
+from contest.engine import engine
+from contest.tracing import tracer
+
+
+logger = logging.getLogger(__name__)
+
+
+def session_group(session_id):
+    # Every registered device of the session; only one duel of a session is
+    # played at a time, so this is also "every device of the current game"
+    return 'session-{}'.format(session_id)
+
+
+def gameteam_group(gameteam_id):
+    return 'gameteam-{}'.format(gameteam_id)
+
+
+class Outbox:
+    """
+    Ordered list of the messages a handler wants delivered. The consumers
+    run the handler (and all of its DB work) in one go and then deliver the
+    messages, so the same game logic serves the sync and async consumers.
+
+    The notifications for the game master ("info", "error", "answer.receive"
+    ...) are held back and go out as one "game_master.batch" event, in a
+    single channel layer call, when the handler is done or right before the
+    next ordered push to the game master.
+
+    Frames to the devices of a session are given its SentFrames (sent), to
+    be numbered and kept for the devices that missed them.
+    """
+
+    def __init__(self):
+        self._messages = []
+        self._game_master = []
+
+    @property
+    def messages(self):
+        self._flush_game_master()
+        return self._messages
+
+    def _flush_game_master(self):
+        if len(self._game_master) == 1:
+            self._messages.append(('group_send', 'game_master', self._game_master[0]))
+        elif self._game_master:
+            self._messages.append(('group_send', 'game_master',
+                                   {'type': 'game_master.batch', 'events': self._game_master}))
+        self._game_master = []
+
+    def group_send(self, group, event, sent=None):
+        if group == 'game_master':
+            self._game_master.append(event)
+        else:
+            if sent is not None:
+                event = sent.stamp(group, event)
+            self._messages.append(('group_send', group, event))
+
+    def group_add(self, group):
+        # Adds the consumer's own channel to the group
+        self._messages.append(('group_add', group))
+
+    def group_discard(self, group):
+        self._messages.append(('group_discard', group))
+
+    def reply(self, payload):
+        # payload is a dict (sent as JSON) or a plain string (sent as is)
+        self._messages.append(('reply', payload))
+
+    def replay(self, event):
+        # A frame the connection's device missed, sent again right away
+        self._messages.append(('replay', event))
+
+    def ordered_send(self, game_id, group, event, then_group, then_event, sent=None):
+        """
+        Sends event to group, and then_event to then_group only once the
+        first one reached a game master socket (see contest.delivery).
+        """
+        if group == 'game_master':
+            self._flush_game_master()
+        seq = tracker.next_seq(game_id)
+        then_event = dict(then_event, game=game_id, seq=tracker.next_seq(game_id))
+        if sent is not None:
+            then_event = sent.stamp(then_group, then_event)
+        tracker.hold(game_id, seq, then_group, then_event)
+        self._messages.append(('ordered_send', group, dict(event, game=game_id, seq=seq)))
+
+
+# The team a connection's device registered for
+DeviceTeam = namedtuple('DeviceTeam', ['session_id', 'gameteam_id', 'name'])
+
+
+class QuizHandler:
+    role = 'device'
+
+    def __init__(self):
+        self.outbox = Outbox()
+        self.device_id = None
+        # Bound by register/connected, dropped when the device is unregistered
+        self.team = None
+        # Session and team groups the device is in. Unregistered devices
+        # only listen to "players", where the register requests go out.
+        self.groups = []
+
+    def state(self):
+        """
+        What the handler knows of its connection, for a handler in another
+        process to pick up (see contest.sharding).
+        """
+        return {'device_id': self.device_id, 'team': list(self.team) if self.team else None,
+                'groups': list(self.groups)}
+
+    def restore(self, state):
+        self.device_id = state['device_id']
+        self.team = DeviceTeam(*state['team']) if state['team'] else None
+        self.groups = list(state['groups'])
+
+    def _bind_team(self, session, gameteam_id):
+        self.team = DeviceTeam(session.id, gameteam_id, session.team_name(gameteam_id))
+        self._join_team_groups(session.id, gameteam_id)
+
+    def _team_of(self, game, team_name):
+        """
+        Returns the gameteam id a message comes from, or None. Once the
+        device registered, it is the team bound to the connection, and the
+        message's game and team name only need to agree with it.
+        """
+        if self.team is None:
+            return game.session.teams_by_name.get(team_name)
+        if game.session.id != self.team.session_id or team_name not in (None, self.team.name):
+            return None
+        return self.team.gameteam_id
+
+    def _join_team_groups(self, session_id, gameteam_id):
+        groups = [session_group(session_id), gameteam_group(gameteam_id)]
+        for group in self.groups:
+            if group not in groups:
+                self.outbox.group_discard(group)
+        for group in groups:
+            if group not in self.groups:
+                self.outbox.group_add(group)
+        if not self.groups:
+            self.outbox.group_discard('players')
+        self.groups = groups
+
+    def leave_team_groups(self):
+        outbox = Outbox()
+        for group in self.groups:
+            outbox.group_discard(group)
+        if self.groups:
+            outbox.group_add('players')
+        self.groups = []
+        self.team = None
+        return outbox.messages
+
+    def _send_error(self, message):
+        self.outbox.group_send(
+            'game_master',
+            {
+                'type': 'error',
+                'message': message
+            }
+        )
+
+        self.outbox.reply({"type": "info",
+                           "message": message})
+
+    def _send_info(self, message):
+        self.outbox.group_send(
+            'game_master',
+            {
+                'type': 'info',
+                'message': message
+            }
+        )
+
+    def invalid_json(self, text_data, exc):
+        self.outbox = Outbox()
+        self.outbox.reply("message received: \"{}\" is not valid json".format(text_data))
+        self._send_error('Invalid request {}'.format(exc))
+        return self.outbox.messages
+
+    def receive(self, data):
+        self.outbox = Outbox()
+
+        request_type = data.get('type')
+
+        with engine.locked(data.get('game')):
+            if request_type == 'category':
+                self.category(data)
+            elif request_type == 'answer':
+                self.answer(data)
+            elif request_type == 'register':
+                self.register(data)
+            elif request_type == 'connected':
+                self.connected(data)
+
+        return self.outbox.messages
+
+    def category(self, data):
+        category = data.get('category')
+        game_id = data.get('game')
+        team_name = data.get('team')
+        game = engine.game(game_id)
+        if game is None:
+            self._send_error('Category selected for wrong game id {}'.format(game_id))
+            return
+        team_id = self._team_of(game, team_name)
+        if team_id is None:
+            self._send_error('Category selected by non existing team')
+            return
+        team_name = game.session.team_name(team_id)
+        if category in game.used_categories:
+            self.outbox.reply({'type': 'error', 'message': 'category not available'})
+            self._send_error('Category no longer available for this game {}'.format(category))
+            return
+        if category not in game.session.deck.categories():
+            self.outbox.reply({'type': 'error', 'message': 'category not available'})
+            self._send_error('Category not found: {}'.format(category))
+            return
+        if ((game.first_player_turn and (team_id != game.first_team_id))
+           or (not game.first_player_turn and (team_id != game.second_team_id))):
+            self.outbox.reply({'type': 'error', 'message': 'Wrong team selected category'})
+            self._send_error('Wrong team selected category')
+            return
+
+        game.used_categories.add(category)
+        game.selected_category = category
+        game.state = 2
+        game.save('category', team_id, category=category)
+        self.outbox.group_send(
+            'game_master',
+            {
+                'type': 'category.receive',
+                'team': team_name,
+                'category': category,
+                'game': game.id
+            }
+        )
+
+    def answer(self, data):
+        answer_number = data.get('answer')  # is 1,2,3,4 corresponding to a,b,c,d
+        question_id = data.get('question')
+        game_id = data.get('game')
+        team_name = data.get('team')
+
+        try:
+            game = engine.game(game_id)
+            session = game.session
+            team_id = self._team_of(game, team_name)
+            team_name = session.team_name(team_id)
+            question = content.snapshot(session.quiz_id).questions[int(question_id)]
+            if answer_number:
+                the_answer = question.answers[int(answer_number)]
+            else:
+                the_answer = None
+            if team_id is None:
+                raise ValueError('unknown team')
+        except Exception:
+            self.outbox.reply("Error reading answer data from {}".format(data))
+            self._send_error("Error reading answer data from {}".format(data))
+            return
+
+        # See if the player who guessed is on his turn
+        if game.state == 5:
+            # If the game is finished, answers will not work
+            self._send_error("Game finished, cannot get any more answers")
+            return
+        if game.is_final is False:
+            if game.first_player_turn and (game.state != 3):
+                if team_id != game.first_team_id:
+                    self._send_error("Wrong team ({}) answered for game{}".format(team_name, str(game_id)))
+                    return
+            elif team_id != game.second_team_id and (game.state != 3):
+                self._send_error("Wrong team ({}) answered for game{}".format(team_name, str(game_id)))
+                return
+
+            self._answer_received(session, team_name, answer_number, data)
+
+            # First, update score
+            if the_answer is None:
+                pass
+            elif the_answer.is_correct:
+                if game.first_player_turn:
+                    game.first_team_score = game.first_team_score + 1
+                else:
+                    game.second_team_score = game.second_team_score + 1
+            else:
+                if game.state == 3:
+                    # Someone rushed and answered incorrectly
+                    # He will lose
+                    if team_id == game.first_team_id:
+                        game.second_team_score += 1
+                    else:
+                        game.first_team_score += 1
+
+            if the_answer is None:
+                self._send_info('Answer was null')
+            else:
+                self._send_info('Team {} answered "{}. {}" and {} correct'.format(
+                    team_name,
+                    answer_number,
+                    the_answer.text if the_answer else "did not answer",
+                    "is" if the_answer.is_correct else "isn't"
+                ))
+            game.correct_answer = question.correct_answer
+            game.question_id = None
+            game.save('answer', team_id, question=question.id, answer=answer_number,
+                      correct=the_answer.is_correct if the_answer else None)
+            # See if next question
+            categories_left_count = game.used_categories.remaining()
+            if categories_left_count > 1:
+                # We continue the game as categories are available
+                game.state = 1
+                game.first_player_turn = not game.first_player_turn
+                game.save('round_end')
+                self._send_info('Game {} continues'.format(game_id))
+
+            else:
+                # See if we have a tie
+                if game.first_team_score == game.second_team_score:
+                    # We have a tie, we need to send another question
+                    game.state = 3
+                    game.save('tie')
+                    self._send_info('Game {} is a tie, sending last question'.format(game_id))
+                    return
+
+                winner_id = game.first_team_id if game.first_team_score > game.second_team_score else game.second_team_id
+                game.winner_id = winner_id
+                game.state = 5
+                # Go to next game
+                session.games_order = session.games_order + 1
+                session.save()
+                game.save('game_end', winner_id)
+
+                event = {"type": "unregistered",
+                         "device_id": "all"}
+
+                self.outbox.group_send(session_group(session.id), event, session.sent)
+
+                # Reset device status
+                engine.reset_devices(session)
+
+                # See if we are starting the final, to select the players
+                if session.current_game().is_final:
+                    # We have a final, let's find the winners of the previous rounds
+                    # First let's get the games
+                    normal_games = [g for g in session.games.values() if not g.is_final]
+                    winners = [g.winner_id for g in normal_games]
+                    logger.debug('Winners of the duels: %s', winners)
+                    if len(winners) != 3:
+                        self._send_error("Winners are not 3! (It's {})".format(len(winners)))
+                        return
+                    final = session.current_game()
+                    final.first_team_id = winners[0]
+                    final.second_team_id = winners[1]
+                    final.third_team_id = winners[2]
+                    final.save('finalists')
+
+                self._send_info('Game {} finished, winner is {}'.format(game_id, session.team_name(winner_id)))
+
+        else:
+            if team_id not in game.team_ids:
+                self._send_error("Wrong team answered: {}".format(team_name))
+                return
+            # The three teams answer at once: count one answer per team, and
+            # only for the question being asked
+            if game.state != 2 or (game.question_id is not None and question.id != game.question_id):
+                self._send_error("Answer of {} is not for the current question of game {}".format(
+                    team_name, game_id))
+                return
+            if team_id in game.answered:
+                self._send_error("Team {} already answered".format(team_name))
+                return
+            game.answered.add(team_id)
+
+            self._answer_received(session, team_name, answer_number, data)
+
+            game.answer_count = game.answer_count + 1
+
+            if the_answer is None:
+                game.round_log.append('Team {} ran out of time'.format(team_name))
+            elif the_answer.is_correct:
+                if team_id == game.first_team_id:
+                    game.first_team_score = game.first_team_score + 1
+                elif team_id == game.second_team_id:
+                    game.second_team_score = game.second_team_score + 1
+                else:
+                    game.third_team_score = game.third_team_score + 1
+
+                # Set the round winner so we can
+                game.round_log.append('Team {} answered correctly!'.format(team_name))
+                game.correct_answer = the_answer.number
+                if not game.round_winner:
+                    game.round_winner = team_name
+            game.save('answer', team_id, question=question.id, answer=answer_number,
+                      correct=the_answer.is_correct if the_answer else None)
+            logger.debug('Number of answers: %s', game.answer_count)
+            if game.answer_count >= 3:
+                game.correct_answer = question.correct_answer
+                # Next round
+                if game.used_categories.remaining():
+                    # We continue the game as categories are available
+                    game.state = 1
+                    self._send_info("Round won by {}".format(game.round_winner))
+                    self._send_info(json.dumps(game.round_log))
+                    self._send_info("Starting next round")
+                    round_winner = game.round_winner
+                    game.answer_count = 0
+                    game.round_winner = None
+                    game.round_log = []
+                    game.selected_category = None
+                    game.save('round_end', winner=round_winner)
+                else:
+                    # Game finished announce the winner
+                    ranking = [{'team': session.team_name(game.first_team_id),
+                                'score': game.first_team_score},
+                               {'team': session.team_name(game.second_team_id),
+                                'score': game.second_team_score},
+                               {'team': session.team_name(game.third_team_id),
+                                'score': game.third_team_score}]
+
+                    ranking_final = sorted(ranking, key=lambda k: k['score'], reverse=True)
+                    self.outbox.reply(
+                        {"type": "game_over",
+                         "ranking": ranking_final}
+                    )
+
+                    self.outbox.group_send(
+                        'game_master',
+                        {'type': 'game.over',
+                         'ranking': ranking_final}
+                    )
+                    game.save('game_end', ranking=ranking_final)
+
+    def _answer_received(self, session, team_name, answer_number, data):
+        event = {
+            "type": "answer.receive",
+            "team": team_name,
+            "answer": answer_number
+        }
+        trace = tracer.answered(data.get('trace'), session.id, self.device_id or team_name)
+        if trace is not None:
+            event['trace'] = trace
+        self.outbox.group_send("game_master", event)
+
+    def register(self, data):
+        name = data.get('team')
+        game_id = data.get('game')
+        device_id = data.get('device')
+
+        game = engine.game(game_id)
+        team_id = game.session.teams_by_name.get(name) if game else None
+        if team_id is None:
+            self.outbox.group_send(
+                'game_master',
+                {
+                    'type': 'error',
+                    'message': 'Team or game not found (team {}, game {})'.format(name, game_id)
+                }
+            )
+            self.outbox.reply('Team or game not found')
+            return
+        session = game.session
+
+        if team_id in game.team_ids:
+            previous_device = engine.register_device(session, team_id, device_id)
+            if previous_device not in (None, device_id):
+                event = {"type": "unregistered",
+                         "device_id": previous_device}
+                self.outbox.group_send(
+                    'game_master',
+                    {
+                        'type': 'device.unregistered',
+                        'message': 'Device {} removed from game {}'.format(previous_device,
+                                                                           game_id)
+                    }
+                )
+                self.outbox.group_send(
+                    gameteam_group(team_id),
+                    event,
+                    session.sent
+                )
+            self.device_id = device_id
+            self._bind_team(session, team_id)
+            self.outbox.reply({
+                'type': 'device_registered',
+                'team': name,
+                'device': device_id
+            })
+            self.outbox.group_send(
+                'game_master',
+                {
+                    'type': 'info',
+                    'message': 'Device {} registered for team {}'.format(device_id, name)
+                }
+            )
+            registered = {gameteam_id for gameteam_id, device in session.devices.items() if device is not None}
+            if game.first_team_id in registered and game.second_team_id in registered and not game.is_final:
+                game.state = 1
+                game.save('ready')
+                self.outbox.group_send(
+                    'game_master',
+                    {
+                        'type': 'info',
+                        'message': 'All devices registered, proceed to game start'
+                    }
+                )
+            elif all(team_id in registered for team_id in game.team_ids):
+                game.state = 1
+                game.save('ready')
+                self.outbox.group_send(
+                    'game_master',
+                    {
+                        'type': 'info',
+                        'message': 'All devices registered, proceed to game start'
+                    }
+                )
+        else:
+            self.outbox.group_send(
+                'game_master',
+                {
+                    'type': 'error',
+                    'message': 'Unknown team attemped register'
+                }
+            )
+
+    def connected(self, data):
+        device_id = data.get('device')
+
+        registration = engine.device(device_id)
+        if registration is None:
+            return  # This means no game is started
+
+        # Restore the game state of the device: the frames it missed since
+        # the last one it got (last_seq, a session_seq), if they are all
+        # still kept, or else the cached state of its game, with the
+        # question only if it was pushed to its team
+        session, team_id = registration
+        last_seq = data.get('last_seq')
+        with session.lock:
+            game = session.current_game()
+            if game is None:
+                return  # Something might've changed
+            missed = None
+            if isinstance(last_seq, int):
+                missed = session.sent.since(last_seq, [session_group(session.id), gameteam_group(team_id)])
+            if missed is None:
+                view, question_team = game.view()
+                answered = team_id in game.answered
+        team_name = session.team_name(team_id)
+        reply = {
+            'type': 'device_reconnect',
+            'device': device_id,
+            'team': team_name,
+            'game': game.id
+        }
+        if missed is None:
+            reply['game_state'] = dict(view)
+            if question_team not in ('all', team_name) or answered:
+                reply['game_state']['question'] = None
+        else:
+            reply['missed'] = len(missed)
+        self.outbox.reply(reply)
+        for event in missed or ():
+            self.outbox.replay(event)
+        self.device_id = device_id
+        self._bind_team(session, team_id)
+
+
+class GameMasterHandler:
+    role = 'game_master'
+    team = None
+
+    def __init__(self):
+        self.outbox = Outbox()
+
+    def state(self):
+        return None
+
+    def restore(self, state):
+        pass
+
+    def invalid_json(self, text_data, exc):
+        self.outbox = Outbox()
+        self.outbox.reply("message received: \"{}\" is not valid json. Error: {}".format(
+            text_data, exc))
+        return self.outbox.messages
+
+    def receive(self, data):
+        self.outbox = Outbox()
+
+        action_type = data.get('type')
+
+        if action_type == 'ack':
+            self.ack(data)
+            return self.outbox.messages
+
+        with engine.locked(data.get('game')):
+            if action_type == 'reveal_answer':
+                self.reveal_answer(data)
+            elif action_type == 'duel_game_continue':
+                self.duel_game_continue(data)
+
+        return self.outbox.messages
+
+    def _get_game(self, game_id):
+        game = engine.game(game_id)
+        if game is None:
+            self.outbox.reply({
+                'error': 'Game with id {} does not exist'.format(game_id)
+            })
+        return game
+
+    def ack(self, data):
+        try:
+            held = tracker.release(int(data.get('game')), int(data.get('seq')))
+        except (TypeError, ValueError):
+            return
+        if held is not None:
+            self.outbox.group_send(*held)
+
+    def reveal_answer(self, data):
+        game = self._get_game(data.get('game'))
+        if game is None:
+            return
+
+        self.outbox.group_send(
+            'game_master',
+            {
+                'type': 'answer.reveal',
+                'answer': game.correct_answer,
+            }
+        )
+
+    def duel_game_continue(self, data):
+        game = self._get_game(data.get('game'))
+        if game is None:
+            return
+        logger.debug('Game %s continues from state %s', game.id, game.state)
+        # See the state of the game
+        game_state = game.state
+        if game_state == 0:
+            self._register_devices(game)
+        elif game.state == 1:
+            self._send_categories(game)
+        elif game.state == 2:
+            self._send_question(game)
+        elif game.state == 3:
+            self._send_tie_question(game)
+        elif game.state == 5:
+            self._send_ranking(game)
+
+    def _register_devices(self, game):
+        session = game.session
+        if game.is_final:
+            teams = [session.team_name(g.winner_id) for g in session.games.values() if not g.is_final]
+        else:
+            teams = [session.team_name(game.first_team_id), session.team_name(game.second_team_id)]
+        self.outbox.group_send(
+            'players',
+            {
+                'type': 'register.devices',
+                'teams': teams,
+                'game': game.id
+            }
+        )
+
+    def _send_categories(self, game):
+        session = game.session
+        used_categories = game.used_categories
+        categories = dict()
+
+        if game.is_final is False:
+            for category in session.deck.categories():
+                categories[category] = category not in used_categories
+            send_team = session.team_name(game.first_team_id if game.first_player_turn else game.second_team_id)
+            send_team_id = game.first_team_id if game.first_player_turn else game.second_team_id
+            self.outbox.ordered_send(
+                game.id,
+                'game_master',
+                {
+                    'type': 'send.categories',
+                    'categories': categories,
+                    'team': send_team,
+                    'first_team_score': game.first_team_score,
+                    'first_team_name': session.team_name(game.first_team_id),
+                    'second_team_score': game.second_team_score,
+                    'second_team_name': session.team_name(game.second_team_id)
+                },
+                gameteam_group(send_team_id),
+                {
+                    'type': 'category.send',
+                    'categories': categories,
+                    'to': send_team
+                },
+                session.sent
+            )
+        else:
+            logger.debug('Used categories: %s', used_categories)
+            if game.selected_category is None:
+                categories = used_categories.missing()
+
+                category_idx = randint(0, len(categories) - 1)
+                game.selected_category = categories[category_idx]
+                game.state = 2
+                game.save('category', category=game.selected_category)
+
+            self.outbox.reply({'type': "category.chosen",
+                               'category': game.selected_category})
+
+    def _send_question(self, game):
+        # Must send the question
+        # First get the available questions
+        session = game.session
+        selected_question = self._draw_question(session, game.selected_category)
+        if selected_question is None:
+            self.outbox.reply({'type': 'error',
+                               'message': 'no questions'})
+            return
+        session.used_questions.add(selected_question.id)
+        session.save()
+        # Send the data
+        if game.is_final:
+            self._push_question(game, selected_question, session_group(game.session_id), 'all')
+            logger.debug('Sending question to all (final)')
+            return
+
+        team_id = game.first_team_id if game.first_player_turn else game.second_team_id
+        self._push_question(game, selected_question, gameteam_group(team_id), session.team_name(team_id))
+
+    def _send_tie_question(self, game):
+        # Must send the question
+        # It comes from a category no question was used from yet, if any
+        session = game.session
+        categories = (session.deck.untouched_categories() or
+                      [category for category in session.deck.categories() if session.deck.remaining(category)])
+        selected_question = None
+        for category in categories:
+            selected_question = self._draw_question(session, category)
+            if selected_question is not None:
+                break
+        if selected_question is None:
+            self.outbox.reply({'type': 'error',
+                               'message': 'no questions'})
+            return
+        session.used_questions.add(selected_question.id)
+        session.save()
+        # Send the data
+        self._push_question(game, selected_question, session_group(game.session_id), 'all')
+
+    def _draw_question(self, session, category):
+        # Next question of the category from the session's shuffled deck,
+        # skipping the ones deleted since the deck was built
+        snapshot = content.snapshot(session.quiz_id)
+        while True:
+            question_id = session.deck.draw(category)
+            if question_id is None:
+                return None
+            question = snapshot.question(question_id)
+            if question is not None:
+                return question
+
+    def _push_question(self, game, question, team_group, team):
+        # The question itself is encoded once per quiz snapshot, the events
+        # only carry it along
+        payload = content.snapshot(game.session.quiz_id).payload(question.id)
+        game.question_id = question.id
+        game.answered = set()
+        game.save('question', question=question.id)
+        self.outbox.ordered_send(
+            game.id,
+            'game_master',
+            {
+                'type': 'send.question',
+                'payload': payload.game_master,
+                'team': team
+            },
+            team_group,
+            {
+                'type': 'question.send',
+                'payload': payload.player,
+                'team': team,
+                'trace': tracer.dispatched(game.session_id)
+            },
+            game.session.sent
+        )
+
+    def _send_ranking(self, game):
+        event = {"type": "unregistered",
+                 "device_id": "all"}
+
+        self.outbox.group_send(session_group(game.session_id), event, game.session.sent)
+
+        event2 = {"type": "ranking",
+                  "first_team_score": game.first_team_score,
+                  "first_team_name": game.session.team_name(game.first_team_id),
+                  "second_team_score": game.second_team_score,
+                  "second_team_name": game.session.team_name(game.second_team_id)}
+        self.outbox.group_send('game_master', event2)
@@ -0,0 +1,128 @@
+"""
+Per-message instrumentation of the websocket consumers.
+
+Every message a consumer dispatches gets a MessageTrace: the frames
+received from the client are recorded under "receive" and the type of
+their decoded payload, the channel layer events under "event" and their
+type. The trace collects the handler latency, the queries made by the game
+handler (with their SQL, through an execute wrapper, so DEBUG is not
+needed), the channel layer calls and the bytes of the frames in and out.
+
+Finished traces feed the message histograms of contest.metrics, served
+with the other metrics and also returned by `stats.snapshot()`. Messages
+slower than INSTRUMENTATION_SLOW_MESSAGE seconds are logged and kept,
+query log included, in `stats.slow_messages`.
+"""
+import logging
+import time
+from collections import deque
+
+from django.conf import settings
+from django.db import connection
+
+from contest.metrics import message_histograms
+
+
+logger = logging.getLogger(__name__)
+
+
+class Stats:
+
+    def __init__(self):
+        self.slow_messages = deque(maxlen=50)
+
+    def record(self, trace):
+        values = {
+            'latency_seconds': trace.elapsed,
+            'queries': len(trace.queries),
+            'query_seconds': sum(query[1] for query in trace.queries),
+            'channel_calls': trace.channel_calls,
+            'channel_seconds': trace.channel_seconds,
+            'bytes_in': trace.bytes_in,
+            'bytes_out': trace.bytes_out,
+        }
+        for name, value in values.items():
+            message_histograms[name].labels(trace.kind, trace.type).observe(value)
+        if trace.elapsed >= slow_message_threshold():
+            self.slow_messages.append(trace.sample())
+            logger.warning('Slow %s %s: %.1f ms, %d queries, %d channel layer calls',
+                           trace.kind, trace.type, trace.elapsed * 1000, len(trace.queries), trace.channel_calls)
+
+    def snapshot(self):
+        messages = {}
+        for name, family in message_histograms.items():
+            for key, histogram in family.items():
+                messages.setdefault(key, {})[name] = histogram.snapshot()
+        return {'messages': messages, 'slow_messages': list(self.slow_messages)}
+
+
+stats = Stats()
+
+
+def slow_message_threshold():
+    return getattr(settings, 'INSTRUMENTATION_SLOW_MESSAGE', 0.25)
+
+
+class MessageTrace:
+
+    def __init__(self, message):
+        if message['type'] == 'websocket.receive':
+            self.kind = 'receive'
+            # Named after the decoded payload once the consumer read it
+            self.type = 'invalid'
+        else:
+            self.kind = 'event'
+            self.type = message['type']
+        self.start = time.perf_counter()
+        self.elapsed = 0.0
+        self.queries = []
+        self.channel_calls = 0
+        self.channel_seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def received(self, data, text_data=None, bytes_data=None):
+        if isinstance(data, dict) and isinstance(data.get('type'), str):
+            self.type = data['type']
+        self.bytes_in = len(text_data.encode()) if text_data is not None else len(bytes_data or b'')
+
+    def __call__(self, execute, sql, params, many, context):
+        # Execute wrapper of the handler's queries
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, time.perf_counter() - start))
+
+    def run(self, func, *args):
+        """
+        Calls func, recording the queries it makes. Call it in the thread
+        the queries are made in.
+        """
+        with connection.execute_wrapper(self):
+            return func(*args)
+
+    def channel_call(self, start):
+        self.channel_calls += 1
+        self.channel_seconds += time.perf_counter() - start
+
+    def frame_sent(self, frame):
+        text_data = frame.get('text_data')
+        self.bytes_out += len(text_data.encode()) if text_data is not None else len(frame.get('bytes_data') or b'')
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.start
+        stats.record(self)
+
+    def sample(self):
+        return {
+            'kind': self.kind,
+            'type': self.type,
+            'at': time.time(),
+            'latency_seconds': self.elapsed,
+            'channel_calls': self.channel_calls,
+            'channel_seconds': self.channel_seconds,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'queries': [{'sql': sql, 'seconds': seconds} for sql, seconds in self.queries],
+        }
@@ -0,0 +1,85 @@
+"""
+Channel layers, picked with CONTEST_CHANNEL_LAYER (see settings).
+
+Both layers add a "batch" extension: send_batch(calls) runs a list of
+(method, *args) layer calls ("send", "group_send", "group_add",
+"group_discard") in order, the way the consumers deliver the outbox of one
+handler turn.
+
+* PipelinedRedisChannelLayer (contest.redis_layer) does a batch in two
+  round trips per Redis server instead of two to four per call: the group
+  changes and member lookups go in one pipeline, then every message of the
+  batch is pushed by one script. It has a module of its own, so that only
+  the processes using it need channels_redis.
+* InProcessChannelLayer, for a single daphne process without game
+  workers, keeps the channels and groups in memory: no Redis at all.
+"""
+import asyncio
+import time
+from copy import deepcopy
+
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer
+
+
+def batches(channel_layer):
+    return 'batch' in getattr(channel_layer, 'extensions', ())
+
+
+class InProcessChannelLayer(InMemoryChannelLayer):
+    """
+    The in-memory layer of channels, made to carry a live tournament: the
+    expired messages are looked for once a second rather than on every
+    send and receive, the per-channel capacities are honoured, and a group
+    send copies the message once for all of the members (the consumers do
+    not modify the events they get).
+    """
+    extensions = ['groups', 'flush', 'batch']
+
+    clean_interval = 1.0
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.cleaned_at = 0
+
+    def clean(self):
+        now = time.time()
+        if now - self.cleaned_at >= self.clean_interval:
+            self.cleaned_at = now
+            self._clean_expired()
+
+    def put(self, channel, message):
+        queue = self.channels.setdefault(channel, asyncio.Queue())
+        if queue.qsize() >= self.get_capacity(channel):
+            raise ChannelFull(channel)
+        queue.put_nowait((time.time() + self.expiry, message))
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        self.put(channel, deepcopy(message))
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        self.clean()
+        queue = self.channels.setdefault(channel, asyncio.Queue())
+        _, message = await queue.get()
+        if queue.empty() and self.channels.get(channel) is queue:
+            del self.channels[channel]
+        return message
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        assert self.valid_group_name(group), 'Invalid group name'
+        self.clean()
+        message = deepcopy(message)
+        for channel in list(self.groups.get(group, ())):
+            try:
+                self.put(channel, message)
+            except ChannelFull:
+                pass
+
+    async def send_batch(self, calls):
+        for method, *args in calls:
+            await getattr(self, method)(*args)
@@ -0,0 +1,77 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from contest.codec import CODECS, pre_encode, decode
+
+
+QUESTION_TEXT = 'Which of these films won the Palme d\'Or at the Cannes Film Festival in the same year it premiered?'
+ANSWERS = {number: 'Answer number {} of the question, about as long as the real ones'.format(number)
+           for number in range(1, 5)}
+CATEGORIES = ['Category {}'.format(number) for number in range(7)]
+
+# Frame type -> (pre-encoded members or None, fields sent with it)
+FRAMES = {
+    'question_send': (
+        pre_encode(question=QUESTION_TEXT, questionID=1234, answers=ANSWERS),
+        {'type': 'question_send', 'team': 'The Quizzards', 'game': 12, 'seq': 31,
+         'trace': {'id': '9f86d081884c7d65', 'session': 3, 'dispatched_at': 1539851122.5012417,
+                   'delivered_at': 1539851122.5093104}},
+    ),
+    'send.question': (
+        pre_encode(question_text=QUESTION_TEXT, question_id=1234, answers=ANSWERS),
+        {'type': 'send.question', 'team': 'The Quizzards', 'game': 12, 'seq': 30},
+    ),
+    'send.categories': (None, {
+        'type': 'send.categories', 'categories': {category: number % 2 == 0 for number, category in
+                                                  enumerate(CATEGORIES)},
+        'team': 'The Quizzards', 'first_team_score': 3, 'first_team_name': 'The Quizzards',
+        'second_team_score': 2, 'second_team_name': 'Trivia Newton John', 'game': 12, 'seq': 28,
+    }),
+    'category.send': (None, {
+        'type': 'category.send', 'categories': {category: True for category in CATEGORIES},
+        'to': 'The Quizzards', 'game': 12, 'seq': 29,
+    }),
+    'answer.receive': (None, {'type': 'answer.receive', 'team': 'The Quizzards', 'answer': 3}),
+    'info': (None, {'info': 'Team The Quizzards answered "3. Answer number 3" and is correct'}),
+    'ranking': (None, {
+        'type': 'ranking', 'first_team_score': 4, 'first_team_name': 'The Quizzards',
+        'second_team_score': 2, 'second_team_name': 'Trivia Newton John',
+    }),
+}
+
+
+class Command(BaseCommand):
+    help = 'Reports the size and the encode/decode time of each frame type for every websocket encoding'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20000)
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        self.stdout.write('{:<16} {:<8} {:>7} {:>11} {:>11}'.format(
+            'frame', 'encoding', 'bytes', 'encode us', 'decode us'))
+        for frame_type, (pre_encoded, fields) in FRAMES.items():
+            for name, codec in CODECS.items():
+                if pre_encoded is None:
+                    def encode():
+                        return codec.encode(fields)
+                else:
+                    def encode():
+                        return codec.encode_with(pre_encoded, **fields)
+                frame = encode()
+                data = frame.get('text_data') or frame.get('bytes_data')
+
+                start = time.perf_counter()
+                for _ in range(iterations):
+                    encode()
+                encode_time = (time.perf_counter() - start) / iterations
+
+                start = time.perf_counter()
+                for _ in range(iterations):
+                    decode(**frame)
+                decode_time = (time.perf_counter() - start) / iterations
+
+                self.stdout.write('{:<16} {:<8} {:>7} {:>11.2f} {:>11.2f}'.format(
+                    frame_type, name, len(data.encode() if isinstance(data, str) else data),
+                    encode_time * 1e6, decode_time * 1e6))
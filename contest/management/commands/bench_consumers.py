@@ -0,0 +1,72 @@
+import asyncio
+import time
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf.urls import url
+from django.core.management.base import BaseCommand
+
+from contest import consumers
+from contest.bench import test_database, in_memory_layer, seed_quiz, start_session
+from contest.models import GameTeam
+
+
+VARIANTS = {
+    'sync': (consumers.QuizConsumer, consumers.GameMasterConsumer),
+    'async': (consumers.AsyncQuizConsumer, consumers.AsyncGameMasterConsumer),
+}
+
+
+class Command(BaseCommand):
+    help = 'Compares handler throughput of the sync and async websocket consumers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--devices', type=int, default=200)
+        parser.add_argument('--messages', type=int, default=10,
+                            help='Messages sent by every connection')
+
+    def handle(self, *args, **options):
+        with test_database(), in_memory_layer():
+            quiz = seed_quiz()
+            session, game = start_session(quiz, ['Team {}'.format(i) for i in range(6)])
+            # Every simulated device reconnects as the first team of the session
+            GameTeam.objects.filter(id=game.first_team_id).update(
+                device_registered=True, device_unique_id='bench-device')
+
+            for name, (quiz_consumer, master_consumer) in VARIANTS.items():
+                application = URLRouter([
+                    url(r'^ws/game/$', quiz_consumer),
+                    url(r'^ws/gamemaster/$', master_consumer),
+                ])
+                devices = asyncio.get_event_loop().run_until_complete(
+                    self.run_devices(application, options['devices'], options['messages']))
+                masters = asyncio.get_event_loop().run_until_complete(
+                    self.run_masters(application, game.id, options['messages']))
+                self.stdout.write('{:>5}: connected {:8.1f} msg/s   reveal_answer {:8.1f} msg/s'.format(
+                    name, devices, masters))
+
+    async def run_devices(self, application, count, messages):
+        communicators = [WebsocketCommunicator(application, '/ws/game/') for _ in range(count)]
+        await asyncio.gather(*[c.connect(timeout=30) for c in communicators])
+
+        async def reconnect(communicator):
+            for _ in range(messages):
+                await communicator.send_json_to({'type': 'connected', 'device': 'bench-device'})
+                await communicator.receive_json_from(timeout=60)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[reconnect(c) for c in communicators])
+        elapsed = time.perf_counter() - start
+        await asyncio.gather(*[c.disconnect(timeout=30) for c in communicators])
+        return count * messages / elapsed
+
+    async def run_masters(self, application, game_id, messages):
+        communicator = WebsocketCommunicator(application, '/ws/gamemaster/')
+        await communicator.connect(timeout=30)
+        start = time.perf_counter()
+        for _ in range(messages * 10):
+            await communicator.send_json_to({'type': 'reveal_answer', 'game': game_id})
+            await communicator.receive_json_from(timeout=30)
+        elapsed = time.perf_counter() - start
+        await communicator.disconnect(timeout=30)
+        return messages * 10 / elapsed
@@ -0,0 +1,323 @@
+import io
+import json
+import os
+import time
+from contextlib import redirect_stdout
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from contest.bench import test_database, in_memory_layer, seed_quiz, start_session, skip_to_final, percentile
+from contest.content import content
+from contest.delivery import tracker
+from contest.engine import engine
+from contest.game import QuizHandler, GameMasterHandler
+
+
+# Times are gated relative to this branch's time in the same run, which
+# takes the speed and load of the machine out of the comparison: it only
+# decodes and dispatches a message. The microseconds are only reported.
+BASELINE = 'unknown type'
+
+# Times within this many baselines of their budget pass, whatever the tolerance
+RELATIVE_SLACK = 1.0
+
+BUDGETS = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'bench_budgets.json')
+
+
+class Command(BaseCommand):
+    help = ('Times every branch of the device and game master handlers on a quiz of realistic size, and '
+            'fails when one makes more queries, or takes more times the "{}" branch, than its budget in '
+            'contest/bench_budgets.json'.format(BASELINE))
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=100)
+        parser.add_argument('--categories', type=int, default=50)
+        parser.add_argument('--questions', type=int, default=200, help='Questions per category')
+        parser.add_argument('--rounds', type=int, default=3)
+        parser.add_argument('--tolerance', type=float, default=1.5,
+                            help='How much slower than its relative time budget a branch may get')
+        parser.add_argument('--update', nargs='+', default=[], metavar='BRANCH',
+                            help='Write the measured numbers as the budgets of these branches, the ones a change '
+                                 'is expected to move')
+
+    def handle(self, *args, **options):
+        unknown = set(options['update']) - {label for label, prepare in self.cases()}
+        if unknown:
+            raise CommandError('Unknown branches: {}'.format(', '.join(sorted(unknown))))
+        results = {}
+        # The background flusher would write the games while they are measured
+        with test_database(), in_memory_layer(), override_settings(GAME_STATE_FLUSH_INTERVAL=3600), \
+                redirect_stdout(io.StringIO()):
+            quiz = seed_quiz(categories=options['categories'], questions_per_category=options['questions'])
+            self.snapshot = content.snapshot(quiz.id)
+            session, first_game = start_session(quiz, ['Team {}'.format(i) for i in range(6)])
+            self.session = engine.session(session.id)
+            self.duel = engine.game(first_game.id)
+            self.final = [game for game in self.session.games.values() if game.is_final][0]
+            self.names = {team_id: self.session.team_name(team_id) for team_id in self.session.teams}
+            self.iteration = 0
+
+            # The fastest of a few rounds, timings of single runs are too noisy to compare
+            for _ in range(options['rounds']):
+                for label, prepare in self.cases():
+                    samples = []
+                    for self.iteration in range(options['iterations']):
+                        run, data = prepare()
+                        with CaptureQueriesContext(connection) as queries:
+                            start = time.perf_counter()
+                            run(data)
+                            elapsed = time.perf_counter() - start
+                        samples.append((elapsed, len(queries)))
+                    result = {
+                        'us': round(percentile([sample[0] for sample in samples], 50) * 1e6, 1),
+                        'queries': max(sample[1] for sample in samples),
+                    }
+                    if label in results:
+                        result['us'] = min(result['us'], results[label]['us'])
+                        result['queries'] = max(result['queries'], results[label]['queries'])
+                    results[label] = result
+        self.report(results, options)
+
+    def cases(self):
+        return [
+            ('category', self.category),
+            ('answer (duel, continues)', self.answer_duel),
+            ('answer (duel, tie)', self.answer_tie),
+            ('answer (duel, steal)', self.answer_steal),
+            ('answer (duel, ends)', self.answer_duel_ends),
+            ('answer (final)', self.answer_final),
+            ('answer (final, last of round)', self.answer_final_last),
+            ('register (first team)', self.register_first),
+            ('register (second team)', self.register_second),
+            ('connected (registered)', self.connected_registered),
+            ('connected (question, after a save)', self.connected_question),
+            ('connected (unknown)', self.connected_unknown),
+            ('connected (cold engine)', self.connected_cold),
+            ('unknown type', self.unknown_type),
+            ('ack', self.ack),
+            ('reveal_answer', self.reveal_answer),
+            ('continue (state 0)', self.continue_state_0),
+            ('continue (state 1, duel)', self.continue_state_1),
+            ('continue (state 1, final)', self.continue_state_1_final),
+            ('continue (state 2, duel)', self.continue_state_2),
+            ('continue (state 2, final)', self.continue_state_2_final),
+            ('continue (state 3)', self.continue_state_3),
+            ('continue (state 4)', self.continue_state_4),
+            ('continue (state 5)', self.continue_state_5),
+            ('engine flush (game and session)', self.engine_flush),
+        ]
+
+    # Game states the cases start from. They are set on the in-memory
+    # state, outside of the measured call.
+
+    def reset_duel(self, state, first_player_turn=True, used_categories=0):
+        game = self.duel
+        with self.session.lock:
+            self.session.games_order = game.game_order
+            game.state = state
+            game.first_player_turn = first_player_turn
+            game.first_team_score = game.second_team_score = 0
+            game.winner_id = None
+            game.used_categories = self.snapshot.category_set()
+            for category in self.snapshot.categories[:used_categories]:
+                game.used_categories.add(category)
+            game.selected_category = self.category_name()
+            game.question_id = self.snapshot.question_ids[self.iteration]
+        return game
+
+    def reset_final(self, state, answered=()):
+        final = skip_to_final(self.session.id)
+        with self.session.lock:
+            final.state = state
+            final.answer_count = len(answered)
+            final.answered = set(answered)
+            final.round_winner = None
+            final.round_log = []
+            final.used_categories = self.snapshot.category_set()
+            final.selected_category = self.category_name()
+            final.question_id = self.snapshot.question_ids[self.iteration]
+        return final
+
+    def category_name(self):
+        # A different category every iteration, so the deck never runs out
+        categories = self.snapshot.categories
+        return categories[self.iteration % len(categories)]
+
+    def device(self, **data):
+        return QuizHandler().receive, data
+
+    def game_master(self, **data):
+        return GameMasterHandler().receive, data
+
+    def answer(self, game, team_id, answer=1):
+        return self.device(type='answer', answer=answer, question=game.question_id, team=self.names[team_id],
+                           game=game.id)
+
+    def unregister_all(self):
+        engine.reset_devices(self.session)
+
+    # Device messages
+
+    def category(self):
+        game = self.reset_duel(1)
+        return self.device(type='category', category=self.category_name(), team=self.names[game.first_team_id],
+                           game=game.id)
+
+    def answer_duel(self):
+        game = self.reset_duel(2)
+        return self.answer(game, game.first_team_id)
+
+    def answer_tie(self):
+        game = self.reset_duel(2, used_categories=len(self.snapshot.categories) - 1)
+        return self.answer(game, game.first_team_id, answer=2)
+
+    def answer_steal(self):
+        game = self.reset_duel(3, used_categories=len(self.snapshot.categories) - 1)
+        return self.answer(game, game.second_team_id)
+
+    def answer_duel_ends(self):
+        game = self.reset_duel(2, used_categories=len(self.snapshot.categories) - 1)
+        return self.answer(game, game.first_team_id)
+
+    def answer_final(self):
+        final = self.reset_final(2)
+        return self.answer(final, final.first_team_id)
+
+    def answer_final_last(self):
+        final = self.reset_final(2, answered=[self.final.first_team_id, self.final.second_team_id])
+        return self.answer(final, final.third_team_id)
+
+    def register(self, team_id):
+        return self.device(type='register', team=self.names[team_id], game=self.duel.id,
+                           device='device-{}-{}'.format(team_id, self.iteration))
+
+    def register_first(self):
+        self.unregister_all()
+        game = self.reset_duel(0)
+        return self.register(game.first_team_id)
+
+    def register_second(self):
+        self.unregister_all()
+        game = self.reset_duel(0)
+        engine.register_device(self.session, game.first_team_id, 'device-first')
+        return self.register(game.second_team_id)
+
+    def connected_registered(self):
+        self.reset_duel(1)
+        engine.register_device(self.session, self.duel.first_team_id, 'device-registered')
+        return self.device(type='connected', device='device-registered')
+
+    def connected_question(self):
+        # The game state sent back is rebuilt once after every save
+        game = self.reset_duel(2)
+        engine.register_device(self.session, game.first_team_id, 'device-registered')
+        with self.session.lock:
+            game.save()
+        return self.device(type='connected', device='device-registered')
+
+    def connected_unknown(self):
+        return self.device(type='connected', device='device-unknown-{}'.format(self.iteration))
+
+    def connected_cold(self):
+        self.reset_duel(1)
+        engine.register_device(self.session, self.duel.first_team_id, 'device-registered')
+        # After a restart: the device is looked up and its session loaded
+        engine.flush()
+        engine.reset()
+        run, data = self.device(type='connected', device='device-registered')
+
+        def connected(data):
+            run(data)
+            self.reload()
+        return connected, data
+
+    def reload(self):
+        self.session = engine.session(self.session.id)
+        self.duel = engine.game(self.duel.id)
+        self.final = engine.game(self.final.id)
+
+    def unknown_type(self):
+        return self.device(type='unknown', game=self.duel.id)
+
+    # Game master messages
+
+    def ack(self):
+        game = self.reset_duel(1)
+        seq = tracker.next_seq(game.id)
+        tracker.hold(game.id, seq, 'players', {'type': 'category.send'})
+        return self.game_master(type='ack', game=game.id, seq=seq)
+
+    def reveal_answer(self):
+        return self.game_master(type='reveal_answer', game=self.reset_duel(2).id)
+
+    def continue_state_0(self):
+        return self.game_master(type='duel_game_continue', game=self.reset_duel(0).id)
+
+    def continue_state_1(self):
+        return self.game_master(type='duel_game_continue', game=self.reset_duel(1).id)
+
+    def continue_state_1_final(self):
+        final = self.reset_final(1)
+        final.selected_category = None
+        return self.game_master(type='duel_game_continue', game=final.id)
+
+    def continue_state_2(self):
+        return self.game_master(type='duel_game_continue', game=self.reset_duel(2).id)
+
+    def continue_state_2_final(self):
+        return self.game_master(type='duel_game_continue', game=self.reset_final(2).id)
+
+    def continue_state_3(self):
+        return self.game_master(type='duel_game_continue', game=self.reset_duel(3).id)
+
+    def continue_state_4(self):
+        return self.game_master(type='duel_game_continue', game=self.reset_duel(4).id)
+
+    def continue_state_5(self):
+        return self.game_master(type='duel_game_continue', game=self.reset_duel(5).id)
+
+    def engine_flush(self):
+        engine.flush()
+        self.reset_duel(2)
+        self.duel.save()
+        self.session.save()
+        return lambda data: engine.flush(), None
+
+    def report(self, results, options):
+        budgets = {}
+        if os.path.exists(BUDGETS):
+            with open(BUDGETS) as budget_file:
+                budgets = json.load(budget_file)
+
+        baseline_us = results[BASELINE]['us']
+        relative = {label: round(result['us'] / baseline_us, 2) for label, result in results.items()}
+        self.stdout.write('{:<34} {:>9} {:>9} {:>9} {:>8} {:>8}'.format(
+            'branch', 'p50 us', 'x base', 'budget', 'queries', 'budget'))
+        regressions = []
+        for label, result in results.items():
+            budget = budgets.get(label)
+            self.stdout.write('{:<34} {:>9.1f} {:>9.2f} {:>9} {:>8} {:>8}'.format(
+                label, result['us'], relative[label], budget['relative'] if budget else '-', result['queries'],
+                budget['queries'] if budget else '-'))
+            if budget is None:
+                continue
+            if label in options['update']:
+                continue
+            if result['queries'] > budget['queries']:
+                regressions.append('{}: {} queries, budget {}'.format(label, result['queries'], budget['queries']))
+            if relative[label] > budget['relative'] * options['tolerance'] + RELATIVE_SLACK:
+                regressions.append('{}: {} times "{}", budget {} (x{})'.format(
+                    label, relative[label], BASELINE, budget['relative'], options['tolerance']))
+        self.stdout.write('"{}" took {:.1f} us'.format(BASELINE, baseline_us))
+
+        if options['update']:
+            for label in options['update']:
+                budgets[label] = {'relative': relative[label], 'queries': results[label]['queries']}
+            with open(BUDGETS, 'w') as budget_file:
+                json.dump({label: budgets[label] for label in results if label in budgets}, budget_file, indent=4)
+                budget_file.write('\n')
+            self.stdout.write('Budgets of {} written to {}'.format(', '.join(options['update']), BUDGETS))
+        if regressions:
+            raise CommandError('Over budget:\n{}'.format('\n'.join(regressions)))
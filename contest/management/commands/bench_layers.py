@@ -0,0 +1,61 @@
+import asyncio
+import io
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from contest.bench import percentile
+from contest.management.commands import load_tournaments
+
+
+LAYERS = ['redis', 'pipelined', 'inprocess']
+
+
+def redis_reachable(backend):
+    async def connect(host, port):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), 1)
+        writer.close()
+
+    loop = asyncio.get_event_loop()
+    try:
+        for host, port in backend['CONFIG']['hosts']:
+            loop.run_until_complete(connect(host, port))
+    except (OSError, asyncio.TimeoutError):
+        return False
+    return True
+
+
+class Command(BaseCommand):
+    help = ('Plays the same tournaments (load_tournaments) over each channel layer of '
+            'settings.CHANNEL_LAYER_BACKENDS and compares them')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--layers', nargs='+', choices=['memory'] + sorted(settings.CHANNEL_LAYER_BACKENDS),
+                            default=LAYERS)
+        parser.add_argument('--sessions', type=int, default=4)
+        parser.add_argument('--variant', choices=sorted(load_tournaments.VARIANTS), default='sync')
+
+    def handle(self, *args, **options):
+        self.stdout.write('{:<10} {:>8} {:>9} {:>8} {:>13} {:>13} {:>13}'.format(
+            'layer', 'seconds', 'frames/s', 'stalled', 'answer p95', 'delivery p95', 'master p95'))
+        for name in options['layers']:
+            backend = settings.CHANNEL_LAYER_BACKENDS.get(name, {})
+            if 'hosts' in backend.get('CONFIG', {}) and not redis_reachable(backend):
+                self.stdout.write('{:<10} Redis is not reachable at {}'.format(name, backend['CONFIG']['hosts']))
+                continue
+            run = load_tournaments.Command(stdout=io.StringIO())
+            call_command(run, sessions=options['sessions'], variant=options['variant'], layer=name)
+            answers = [sample[0] for sample in run.stats.samples.get('answer', [])]
+            self.stdout.write('{:<10} {:>8.2f} {:>9.0f} {:>8} {:>13} {:>13} {:>13}'.format(
+                name, run.elapsed, run.frames / run.elapsed, run.stalled,
+                milliseconds(percentile(answers, 95)), milliseconds(hop_p95(run, 'dispatch_to_delivery')),
+                milliseconds(hop_p95(run, 'answer_to_master'))))
+
+
+def hop_p95(run, hop):
+    return run.hops[hop][2] if hop in run.hops else None
+
+
+def milliseconds(seconds):
+    return '{:.2f} ms'.format(seconds * 1000) if seconds is not None else '-'
@@ -0,0 +1,114 @@
+import io
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+
+from django.core.management.base import BaseCommand
+from django.db import connection, OperationalError
+from django.test.utils import override_settings
+
+from contest.bench import test_database, in_memory_layer, seed_quiz, start_session, percentile
+from contest.engine import engine
+from contest.models import GameTeam
+
+
+MODES = {
+    'default': False,
+    'production': True,
+}
+
+
+class Command(BaseCommand):
+    help = ('Registers devices and changes games from many threads while others read, with and without the '
+            'SQLite production mode, and reports latencies and "database is locked" errors')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--modes', nargs='+', choices=sorted(MODES), default=sorted(MODES))
+        parser.add_argument('--sessions', type=int, default=8)
+        parser.add_argument('--threads', type=int, default=12, help='Writing threads')
+        parser.add_argument('--readers', type=int, default=4, help='Reading threads')
+        parser.add_argument('--writes', type=int, default=200, help='Writes per writing thread')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.stdout.write('{:<11} {:>9} {:>8} {:>13} {:>13} {:>13} {:>13}'.format(
+            'mode', 'writes/s', 'locked', 'write p50', 'write p95', 'read p50', 'read p95'))
+        for mode in options['modes']:
+            with override_settings(SQLITE_PRODUCTION=MODES[mode], GAME_STATE_FLUSH_INTERVAL=0.05), \
+                    test_database(), in_memory_layer(), redirect_stdout(io.StringIO()):
+                result = self.run()
+            self.stdout.write('{:<11} {:>9.0f} {:>8} {:>10.2f} ms {:>10.2f} ms {:>10.2f} ms {:>10.2f} ms'.format(
+                mode, result['writes'] / result['elapsed'], result['locked'],
+                percentile(result['write_latencies'], 50) * 1000, percentile(result['write_latencies'], 95) * 1000,
+                percentile(result['read_latencies'], 50) * 1000, percentile(result['read_latencies'], 95) * 1000))
+
+    def run(self):
+        quiz = seed_quiz()
+        sessions = []
+        for number in range(self.options['sessions']):
+            session, first_game = start_session(quiz, ['S{} team {}'.format(number, team) for team in range(6)])
+            sessions.append(engine.session(session.id))
+        result = {'writes': 0, 'locked': 0, 'write_latencies': [], 'read_latencies': []}
+        lock = threading.Lock()
+        writing = threading.Event()
+        writing.set()
+
+        def record(key, latency):
+            with lock:
+                result[key].append(latency)
+
+        def locked():
+            with lock:
+                result['locked'] += 1
+
+        def write(number):
+            shuffler = random.Random(self.options['seed'] + number)
+            try:
+                for index in range(self.options['writes']):
+                    session = shuffler.choice(sessions)
+                    start = time.perf_counter()
+                    try:
+                        # A device registering, and the game it plays changing (written by the flusher)
+                        engine.register_device(session, shuffler.choice(list(session.teams)),
+                                               'device-{}-{}'.format(number, index))
+                        with session.lock:
+                            session.current_game().answer_count += 1
+                            session.current_game().save()
+                    except OperationalError:
+                        locked()
+                        continue
+                    record('write_latencies', time.perf_counter() - start)
+            finally:
+                connection.close()
+
+        def read(number):
+            shuffler = random.Random(-self.options['seed'] - number)
+            try:
+                while writing.is_set():
+                    start = time.perf_counter()
+                    try:
+                        list(GameTeam.objects.filter(game_session_id=shuffler.choice(sessions).id,
+                                                     device_registered=True))
+                    except OperationalError:
+                        locked()
+                        continue
+                    record('read_latencies', time.perf_counter() - start)
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=self.options['threads'] + self.options['readers']) as executor:
+            readers = [executor.submit(read, number) for number in range(self.options['readers'])]
+            start = time.perf_counter()
+            writers = [executor.submit(write, number) for number in range(self.options['threads'])]
+            for future in writers:
+                future.result()
+            engine.flush()
+            result['elapsed'] = time.perf_counter() - start
+            writing.clear()
+            for future in readers:
+                future.result()
+        result['writes'] = len(result['write_latencies'])
+        return result
@@ -0,0 +1,47 @@
+import io
+from collections import Counter
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from contest.bench import percentile
+from contest.management.commands import load_tournaments
+from contest.management.commands.bench_layers import hop_p95, milliseconds
+from contest.sharding import HashRing
+
+
+class Command(BaseCommand):
+    help = ('Plays the same tournaments (load_tournaments) with no game workers and with 1, 2 and 4 of them, '
+            'and compares throughput and how the sessions spread. The workers run in this process, so this '
+            'measures the cost of routing through them and their balance, not scaling over processes')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', nargs='+', type=int, default=[0, 1, 2, 4])
+        parser.add_argument('--sessions', type=int, default=8)
+        parser.add_argument('--variant', choices=sorted(load_tournaments.VARIANTS), default='sync')
+        parser.add_argument('--layer', choices=['memory'] + sorted(settings.CHANNEL_LAYER_BACKENDS),
+                            default='memory')
+
+    def handle(self, *args, **options):
+        self.stdout.write('{:<8} {:>8} {:>10} {:>9} {:>8} {:>13} {:>13} {:>18}'.format(
+            'workers', 'seconds', 'messages/s', 'frames/s', 'stalled', 'answer p95', 'master p95',
+            'sessions/worker'))
+        for workers in options['workers']:
+            run = load_tournaments.Command(stdout=io.StringIO())
+            call_command(run, sessions=options['sessions'], variant=options['variant'], layer=options['layer'],
+                         workers=workers)
+            handled = sum(len(samples) for message_type, samples in run.stats.samples.items())
+            answers = [sample[0] for sample in run.stats.samples.get('answer', [])]
+            self.stdout.write('{:<8} {:>8.2f} {:>10.0f} {:>9.0f} {:>8} {:>13} {:>13} {:>18}'.format(
+                workers, run.elapsed, handled / run.elapsed, run.frames / run.elapsed, run.stalled,
+                milliseconds(percentile(answers, 95)), milliseconds(hop_p95(run, 'answer_to_master')),
+                spread(run.session_ids, workers)))
+
+
+def spread(session_ids, workers):
+    if not workers:
+        return '-'
+    ring = HashRing([str(number) for number in range(workers)])
+    owners = Counter(ring.owner(session_id) for session_id in session_ids)
+    return '/'.join(str(owners[str(number)]) for number in range(workers))
@@ -0,0 +1,103 @@
+import io
+from collections import defaultdict
+from contextlib import redirect_stdout
+
+from django.core.management.base import BaseCommand
+
+from contest.bench import test_database, in_memory_layer, seed_quiz, start_session, skip_to_final
+from contest.engine import engine
+from contest.game import QuizHandler, GameMasterHandler
+
+
+# Channel layer calls made to deliver each kind of outbox message. An
+# ordered send also releases the held half to the players.
+ROUND_TRIPS = {
+    'group_send': 1,
+    'group_add': 1,
+    'group_discard': 1,
+    'ordered_send': 2,
+    'reply': 0,
+    'replay': 0,
+}
+
+
+def batched_round_trips(messages):
+    # With a batching layer: one call per run of layer calls between two
+    # replies, plus the release of every ordered send
+    trips = 0
+    pending = False
+    for message in messages:
+        if message[0] in ('reply', 'replay'):
+            trips += pending
+            pending = False
+        else:
+            pending = True
+            trips += message[0] == 'ordered_send'
+    return trips + pending
+
+
+class Command(BaseCommand):
+    help = 'Plays a duel and the final through the game handlers and counts channel layer calls per message'
+
+    def handle(self, *args, **options):
+        self.calls = defaultdict(list)
+        with test_database(), in_memory_layer(), redirect_stdout(io.StringIO()):
+            quiz = seed_quiz()
+            session, first_game = start_session(quiz, ['Team {}'.format(i) for i in range(6)])
+            self.play_duel(engine.game(first_game.id))
+            self.play_final(skip_to_final(session.id))
+
+        self.stdout.write('{:<32} {:>9} {:>12} {:>12}'.format('message', 'handled', 'calls/msg', 'batched/msg'))
+        for label, counts in sorted(self.calls.items()):
+            self.stdout.write('{:<32} {:>9} {:>12.2f} {:>12.2f}'.format(
+                label, len(counts), sum(count[0] for count in counts) / len(counts),
+                sum(count[1] for count in counts) / len(counts)))
+
+    def count(self, label, messages):
+        self.calls[label].append((sum(ROUND_TRIPS[message[0]] for message in messages),
+                                  batched_round_trips(messages)))
+
+    def game_master(self, game, message_type='duel_game_continue'):
+        state = game.state
+        messages = GameMasterHandler().receive({'type': message_type, 'game': game.id})
+        self.count('{} (state {})'.format(message_type, state), messages)
+
+    def device(self, label, data):
+        self.count(label, QuizHandler().receive(data))
+
+    def play_duel(self, game):
+        session = game.session
+        self.game_master(game)
+        for team_id in game.team_ids[:2]:
+            self.device('register', {'type': 'register', 'team': session.team_name(team_id),
+                                     'game': game.id, 'device': 'device-{}'.format(team_id)})
+        while game.state != 5:
+            team_id = game.first_team_id if game.first_player_turn else game.second_team_id
+            state = game.state
+            last_seq = session.sent.seq
+            self.game_master(game)
+            if state == 1:
+                category = game.used_categories.missing()[0]
+                self.device('category', {'type': 'category', 'category': category,
+                                         'team': session.team_name(team_id), 'game': game.id})
+            elif state in (2, 3):
+                self.game_master(game, 'reveal_answer')
+                # The device reconnects, with and without the frames it missed
+                device = 'device-{}'.format(team_id)
+                self.device('connected (missed frames)', {'type': 'connected', 'device': device,
+                                                          'last_seq': last_seq})
+                self.device('connected (full state)', {'type': 'connected', 'device': device})
+                # The first team always gets it right, so the duel ends
+                answer = 1 if team_id == game.first_team_id else 2
+                self.device('answer', {'type': 'answer', 'answer': answer, 'question': game.question_id,
+                                       'team': session.team_name(team_id), 'game': game.id})
+        self.game_master(game)
+
+    def play_final(self, final):
+        session = final.session
+        for _ in range(3):
+            self.game_master(final)
+            self.game_master(final)
+            for team_id in final.team_ids:
+                self.device('answer (final)', {'type': 'answer', 'answer': 1, 'question': final.question_id,
+                                               'team': session.team_name(team_id), 'game': final.id})
@@ -0,0 +1,306 @@
+import asyncio
+import io
+import json
+import random
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter, ChannelNameRouter
+from channels.testing import WebsocketCommunicator
+from channels.worker import Worker
+from django.conf import settings
+from django.conf.urls import url
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from rest_framework.test import APIRequestFactory
+
+from contest import consumers, events
+from contest.api_views import start_game_session
+from contest.bench import test_database, channel_layer, seed_quiz, percentile
+from contest.engine import engine
+from contest.metrics import state_saves, state_commits
+from contest.models import GameEvent, Team
+from contest.sharding import worker_channel
+from contest.tracing import tracer, HOPS
+
+
+VARIANTS = {
+    'sync': (consumers.QuizConsumer, consumers.GameMasterConsumer),
+    'async': (consumers.AsyncQuizConsumer, consumers.AsyncGameMasterConsumer),
+}
+
+TEAMS_PER_SESSION = 6
+REGISTER_RESEND = 0.5
+
+
+class HandlerStats:
+    """
+    Handler latency and queries of every message, by message type. The
+    handlers run in the consumers' database threads, where the queries of
+    the message are the ones made on that thread's connection.
+    """
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    def wrap(self, handler):
+        receive = handler.receive
+
+        def measured_receive(data):
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                messages = receive(data)
+                elapsed = time.perf_counter() - start
+            self.samples[data.get('type')].append((elapsed, len(queries)))
+            return messages
+
+        handler.receive = measured_receive
+
+
+def measured(consumer_class, stats):
+    if consumer_class is consumers.GameWorkerConsumer:
+        class MeasuredConsumer(consumer_class):
+            def game_handler(self, role):
+                handler = super().game_handler(role)
+                stats.wrap(handler)
+                return handler
+    elif asyncio.iscoroutinefunction(consumer_class.connect):
+        class MeasuredConsumer(consumer_class):
+            async def connect(self):
+                await super().connect()
+                stats.wrap(self.handler)
+    else:
+        class MeasuredConsumer(consumer_class):
+            def connect(self):
+                super().connect()
+                stats.wrap(self.handler)
+    return MeasuredConsumer
+
+
+class Command(BaseCommand):
+    help = ('Plays whole tournaments with simulated devices and game masters over websockets, and reports '
+            'handler latency percentiles, frames per second and queries per message')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sessions', type=int, default=4)
+        parser.add_argument('--variant', choices=sorted(VARIANTS), default='sync')
+        parser.add_argument('--final-rounds', type=int, default=3,
+                            help='Rounds of the final to play (it has no end of its own)')
+        parser.add_argument('--layer', choices=['memory'] + sorted(settings.CHANNEL_LAYER_BACKENDS),
+                            default='memory', help='"memory" is the in-memory layer of channels, the others are '
+                            'the layers of settings.CHANNEL_LAYER_BACKENDS')
+        parser.add_argument('--workers', type=int, default=0,
+                            help='Play the sessions on this many game workers, run in this process')
+        parser.add_argument('--flush-interval', type=float,
+                            help='GAME_STATE_FLUSH_INTERVAL to play with, 0 writing back after every handler turn')
+        parser.add_argument('--step-timeout', type=float, default=10.0)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.random = random.Random(options['seed'])
+        self.stats = HandlerStats()
+        self.frames = 0
+        quiz_consumer, master_consumer = VARIANTS[options['variant']]
+        self.application = URLRouter([
+            url(r'^ws/game/$', measured(quiz_consumer, self.stats)),
+            url(r'^ws/gamemaster/$', measured(master_consumer, self.stats)),
+        ])
+
+        layer = channel_layer(options['layer'])
+        overrides = {'GAME_WORKERS': [str(number) for number in range(options['workers'])]}
+        if options['flush_interval'] is not None:
+            overrides['GAME_STATE_FLUSH_INTERVAL'] = options['flush_interval']
+        with test_database(), layer, override_settings(**overrides), redirect_stdout(io.StringIO()):
+            quiz = seed_quiz(categories=7, questions_per_category=20)
+            sessions = [self.start_session(quiz.id, number) for number in range(options['sessions'])]
+            engine.flush()
+            saves, commits = state_saves.value(), state_commits.value()
+            start = time.perf_counter()
+            stalled = asyncio.get_event_loop().run_until_complete(self.play(sessions))
+            engine.flush()
+            self.elapsed = time.perf_counter() - start
+            self.saves, self.commits = state_saves.value() - saves, state_commits.value() - commits
+            # Read before the test database goes, along with the traces
+            self.session_ids = [session.id for session, teams in sessions]
+            self.hops = self.hop_summaries()
+            self.events = GameEvent.objects.filter(session_id__in=self.session_ids).count()
+            self.replayed = sum(events.mismatches(session_id) == [] for session_id in self.session_ids)
+        self.stalled = stalled
+        self.report()
+
+    def start_session(self, quiz_id, number):
+        teams = ['S{} team {}'.format(number, team) for team in range(TEAMS_PER_SESSION)]
+        Team.objects.bulk_create([Team(name=name) for name in teams])
+        request = APIRequestFactory().post(reverse('start-game'), {'quiz_id': quiz_id, 'teams': teams},
+                                           format='json')
+        response = start_game_session(request)
+        if response.status_code != 200:
+            raise CommandError('start-game failed: {}'.format(response.data))
+        return engine.game(response.data['first_game']).session, teams
+
+    async def play(self, sessions):
+        executor = ThreadPoolExecutor()
+        asyncio.get_event_loop().set_default_executor(executor)
+        workers = self.start_workers()
+        devices = []
+        communicators = []
+        for session, teams in sessions:
+            for team in teams:
+                communicator = WebsocketCommunicator(self.application, '/ws/game/')
+                await communicator.connect(timeout=30)
+                communicators.append(communicator)
+                devices.append(asyncio.ensure_future(self.device(communicator, team)))
+        masters = []
+        for _ in sessions:
+            communicator = WebsocketCommunicator(self.application, '/ws/gamemaster/')
+            await communicator.connect(timeout=30)
+            masters.append(communicator)
+        readers = [asyncio.ensure_future(self.read_frames(master)) for master in masters]
+
+        results = await asyncio.gather(*[self.game_master(master, session)
+                                         for master, (session, teams) in zip(masters, sessions)])
+        for task in devices + readers:
+            task.cancel()
+        # While the loop still runs, so the consumer threads are not left
+        # waiting on their last sends
+        await asyncio.gather(*[communicator.disconnect(timeout=30) for communicator in communicators + masters])
+        await self.stop_workers(*workers)
+        # The handlers of the cancelled worker consumers may still run in the
+        # executor, and send through this loop: they must be done before it
+        # stops (asgiref would leave the loop set in their threads, for the
+        # next runs) and the test database goes
+        await asyncio.get_event_loop().run_in_executor(ThreadPoolExecutor(max_workers=1), executor.shutdown)
+        return sum(results)
+
+    def start_workers(self):
+        channels = [worker_channel(str(number)) for number in range(self.options['workers'])]
+        application = ChannelNameRouter({channel: measured(consumers.GameWorkerConsumer, self.stats)
+                                         for channel in channels})
+        worker = Worker(application, channels, get_channel_layer())
+        return worker, [asyncio.ensure_future(worker.listener(channel)) for channel in channels]
+
+    async def stop_workers(self, worker, listeners):
+        instances = [details['future'] for details in worker.application_instances.values()]
+        for task in listeners + instances:
+            task.cancel()
+        await asyncio.gather(*listeners + instances, return_exceptions=True)
+
+    async def read_frames(self, communicator):
+        while True:
+            await communicator.output_queue.get()
+            self.frames += 1
+
+    async def device(self, communicator, team):
+        """
+        Plays a team: registers when asked, and picks a category or answers
+        whenever it is sent one.
+        """
+        device_id = 'device of {}'.format(team)
+        while True:
+            output = await communicator.output_queue.get()
+            self.frames += 1
+            if output.get('type') != 'websocket.send' or output.get('text') is None:
+                continue
+            try:
+                frame = json.loads(output['text'])
+            except ValueError:
+                continue
+            frame_type = frame.get('type') if isinstance(frame, dict) else None
+            if frame_type == 'register_device' and team in frame['teams']:
+                await communicator.send_json_to({'type': 'register', 'team': team, 'game': frame['game'],
+                                                 'device': device_id})
+            elif frame_type == 'category.send' and frame.get('to') == team:
+                available = [category for category, free in frame['categories'].items() if free]
+                await communicator.send_json_to({'type': 'category', 'category': self.random.choice(available),
+                                                 'team': team, 'game': frame['game']})
+            elif frame_type == 'question_send' and frame.get('team') in (team, 'all'):
+                await communicator.send_json_to({'type': 'answer', 'answer': self.random.choice([1, 2]),
+                                                 'question': frame['questionID'], 'team': team,
+                                                 'game': frame['game'], 'trace': frame.get('trace')})
+
+    def progress(self, session):
+        game = session.current_game()
+        if game is None:
+            return None
+        # A pushed question is not progress yet, its answers are
+        return session.games_order, game.state, game.answer_count, game.first_player_turn
+
+    async def game_master(self, communicator, session):
+        """
+        Presses "continue" whenever the previous step is done. The harness
+        peeks at the in-memory game state to know when that is. Returns how
+        many steps stalled.
+        """
+        stalled = 0
+        final_rounds = 0
+        while True:
+            game = session.current_game()
+            if game is None:
+                break
+            if game.is_final and game.state == 2:
+                final_rounds += 1
+                if final_rounds > self.options['final_rounds']:
+                    break
+            before = self.progress(session)
+            await communicator.send_json_to({'type': 'duel_game_continue', 'game': game.id})
+            deadline = time.perf_counter() + self.options['step_timeout']
+            resend = time.perf_counter() + REGISTER_RESEND
+            while self.progress(session) == before:
+                now = time.perf_counter()
+                if now > deadline:
+                    stalled += 1
+                    self.stderr.write('Session {} stalled at {}'.format(session.id, before))
+                    return stalled
+                if game.state == 0 and now > resend:
+                    # Devices of the previous duel only listen for register
+                    # requests again once they handled its end, like a game
+                    # master would, ask again
+                    resend = now + REGISTER_RESEND
+                    await communicator.send_json_to({'type': 'duel_game_continue', 'game': game.id})
+                await asyncio.sleep(0.002)
+        return stalled
+
+    def hop_summaries(self):
+        """
+        hop -> (count, mean, p95 of the worst session, max), in seconds.
+        """
+        summaries = {}
+        reports = [tracer.session_report(session_id) for session_id in self.session_ids]
+        for hop in HOPS:
+            hops = [report['hops'][hop] for report in reports if report]
+            count = sum(summary['count'] for summary in hops)
+            if count:
+                summaries[hop] = (count, sum(summary['mean'] * summary['count'] for summary in hops) / count,
+                                  max(summary['p95'] for summary in hops), max(summary['max'] for summary in hops))
+        return summaries
+
+    def report(self):
+        self.stdout.write('{} sessions ({}, {} layer, {} game workers) in {:.2f}s, {} stalled'.format(
+            self.options['sessions'], self.options['variant'],
+            self.options['layer'], self.options['workers'], self.elapsed, self.stalled))
+        self.stdout.write('{:<20} {:>7} {:>9} {:>9} {:>9} {:>12}'.format(
+            'message', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'queries/msg'))
+        handled = 0
+        for message_type, samples in sorted(self.stats.samples.items()):
+            latencies = [sample[0] * 1000 for sample in samples]
+            handled += len(samples)
+            self.stdout.write('{:<20} {:>7} {:>9.2f} {:>9.2f} {:>9.2f} {:>12.2f}'.format(
+                message_type, len(samples), percentile(latencies, 50), percentile(latencies, 95),
+                percentile(latencies, 99), sum(sample[1] for sample in samples) / len(samples)))
+        self.stdout.write('{} messages handled, {} frames received: {:.0f} frames/s'.format(
+            handled, self.frames, self.frames / self.elapsed))
+        self.stdout.write('{} game state saves written back in {} commits: {:.0f} commits/s saved'.format(
+            self.saves, self.commits, (self.saves - self.commits) / self.elapsed))
+        self.stdout.write('{} game events logged, replay matches the rows of {} of {} sessions'.format(
+            self.events, self.replayed, len(self.session_ids)))
+
+        self.stdout.write('{:<22} {:>7} {:>9} {:>9} {:>9}'.format('question hop', 'count', 'mean ms', 'p95 ms', 'max ms'))
+        for hop, (count, mean, p95, longest) in self.hops.items():
+            self.stdout.write('{:<22} {:>7} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+                hop, count, mean * 1000, p95 * 1000, longest * 1000))
@@ -0,0 +1,42 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from contest import events
+from contest.models import GameSession
+
+
+class Command(BaseCommand):
+    help = ('Prints the event log of a session and its state replayed from the latest snapshot, and checks '
+            'the replayed state against the rows of the session')
+
+    def add_arguments(self, parser):
+        parser.add_argument('session', type=int)
+        parser.add_argument('--upto', type=int, help='Replay up to this event seq only')
+        parser.add_argument('--quiet', action='store_true', help='Only check, without printing the log')
+
+    def handle(self, *args, **options):
+        session_id = options['session']
+        if not GameSession.objects.filter(id=session_id).exists():
+            raise CommandError('No session {}'.format(session_id))
+        upto = options['upto']
+        if not options['quiet']:
+            history = events.history(session_id)
+            if upto is not None:
+                history = history.filter(seq__lte=upto)
+            for event in history:
+                self.stdout.write('{:>6} {:%H:%M:%S.%f} {:<17} game {:<6} team {:<6} {} {}'.format(
+                    event.seq, event.created, event.get_kind_display(), str(event.game_id), str(event.team_id),
+                    event.data, event.changes))
+        state = events.replay(session_id, upto)
+        if state is None:
+            raise CommandError('Session {} has no snapshot to replay from'.format(session_id))
+        if not options['quiet']:
+            self.stdout.write(json.dumps(state, indent=2, sort_keys=True))
+        if upto is not None:
+            return
+        found = events.mismatches(session_id)
+        for key, field, replayed, row in found:
+            self.stdout.write('{} {}: replayed {!r}, row {!r}'.format(key, field, replayed, row))
+        self.stdout.write('Replayed up to event {} (snapshot {}): {}'.format(
+            state['seq'], state['snapshot'], '{} mismatches'.format(len(found)) if found else 'matches the rows'))
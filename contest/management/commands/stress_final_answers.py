@@ -0,0 +1,69 @@
+import io
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+
+from django.core.management.base import BaseCommand, CommandError
+
+from contest.bench import test_database, in_memory_layer, seed_quiz, start_session, skip_to_final
+from contest.content import content
+from contest.game import QuizHandler, GameMasterHandler
+
+
+class Command(BaseCommand):
+    help = ('Plays rounds of the three team final with every answer sent concurrently (and repeated), '
+            'and checks that answer counts and scores come out exact')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rounds', type=int, default=200)
+        parser.add_argument('--copies', type=int, default=3,
+                            help='How many times every team sends its answer')
+        parser.add_argument('--threads', type=int, default=12)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        shuffler = random.Random(options['seed'])
+        with test_database(), in_memory_layer():
+            # The final picks its categories at random, any of them may serve every round
+            quiz = seed_quiz(categories=4, questions_per_category=options['rounds'])
+            session, first_game = start_session(quiz, ['Team {}'.format(i) for i in range(6)])
+            final = skip_to_final(session.id)
+            teams = [(team_id, final.session.team_name(team_id)) for team_id in final.team_ids]
+            expected = {team_id: 0 for team_id, _ in teams}
+            questions = content.snapshot(quiz.id).questions
+
+            answers = 0
+            elapsed = 0.0
+            with ThreadPoolExecutor(max_workers=options['threads']) as executor, redirect_stdout(io.StringIO()):
+                for round_number in range(options['rounds']):
+                    # Category, then question
+                    previous_question = final.question_id
+                    GameMasterHandler().receive({'type': 'duel_game_continue', 'game': final.id})
+                    GameMasterHandler().receive({'type': 'duel_game_continue', 'game': final.id})
+                    if final.state != 2 or final.question_id in (None, previous_question):
+                        raise CommandError('Round {} did not start (state {})'.format(round_number, final.state))
+                    messages = []
+                    for team_id, team_name in teams:
+                        answer = shuffler.choice([1, 2])
+                        if answer == questions[final.question_id].correct_answer:
+                            expected[team_id] += 1
+                        messages += [{'type': 'answer', 'answer': answer, 'question': final.question_id,
+                                      'team': team_name, 'game': final.id}] * options['copies']
+                    shuffler.shuffle(messages)
+
+                    start = time.perf_counter()
+                    list(executor.map(lambda data: QuizHandler().receive(data), messages))
+                    elapsed += time.perf_counter() - start
+                    answers += len(messages)
+
+                    scores = dict(zip(final.team_ids, [final.first_team_score, final.second_team_score,
+                                                       final.third_team_score]))
+                    if final.state != 1 or final.answer_count != 0 or scores != expected:
+                        raise CommandError(
+                            'Round {}: state {}, {} answers counted, scores {} instead of {}'.format(
+                                round_number, final.state, final.answer_count, scores, expected))
+
+            self.stdout.write('{} rounds, {} answers ({} per team and question) in {:.3f}s: {:.0f} answers/s'.format(
+                options['rounds'], answers, options['copies'], elapsed, answers / elapsed))
+            self.stdout.write('Final scores {} match'.format(sorted(expected.values(), reverse=True)))
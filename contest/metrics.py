@@ -0,0 +1,319 @@
+"""
+Process metrics in the Prometheus text format, served at /api/v1/metrics/.
+
+Counters and histograms are updated on the hot path, so every thread adds
+to its own shard of them, without locking; a scrape sums the shards. The
+live game state (sessions, games by state) and the channel capacities
+are read when scraped.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+from django.db import connection
+
+from contest.models import DUEL_GAME_STATES
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+SIZE_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 16384, 65536)
+
+# Label values past this many per metric are counted under "other"
+MAX_LABEL_VALUES = 100
+
+
+class Shards:
+    """
+    One value per thread, created by factory on first use.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []
+
+    def get(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = self.factory()
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def all(self):
+        with self.lock:
+            return list(self.shards)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self):
+        self.shards = Shards(lambda: [0])
+
+    def inc(self, amount=1):
+        self.shards.get()[0] += amount
+
+    def value(self):
+        return sum(shard[0] for shard in self.shards.all())
+
+    def samples(self, name, labels):
+        yield name, labels, self.value()
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1):
+        self.shards.get()[0] -= amount
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # Count per bucket (the last one is +Inf), then the sum
+        self.shards = Shards(lambda: [0] * (len(buckets) + 2))
+
+    def observe(self, value):
+        shard = self.shards.get()
+        shard[bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def totals(self):
+        totals = [0] * (len(self.buckets) + 2)
+        for shard in self.shards.all():
+            for index, value in enumerate(shard):
+                totals[index] += value
+        return totals
+
+    def snapshot(self):
+        """
+        Cumulative counts per upper bound, the last one being +Inf.
+        """
+        totals = self.totals()
+        cumulative = []
+        running = 0
+        for bound, bucket_count in zip(list(self.buckets) + ['+Inf'], totals[:-1]):
+            running += bucket_count
+            cumulative.append((bound, running))
+        return {'buckets': cumulative, 'sum': totals[-1], 'count': running}
+
+    def samples(self, name, labels):
+        snapshot = self.snapshot()
+        for bound, count in snapshot['buckets']:
+            yield name + '_bucket', labels + (('le', format_value(bound)),), count
+        yield name + '_sum', labels, snapshot['sum']
+        yield name + '_count', labels, snapshot['count']
+
+
+class Family:
+    """
+    A metric and its children, one per combination of label values.
+    """
+
+    def __init__(self, name, help_text, labelnames, factory):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.factory = factory
+        self.kind = factory().kind
+        self.lock = threading.Lock()
+        self.children = {}
+        registry.append(self)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                if values not in self.children and len(self.children) >= MAX_LABEL_VALUES:
+                    values = ('other',) * len(values)
+                child = self.children.get(values)
+                if child is None:
+                    child = self.children[values] = self.factory()
+        return child
+
+    def items(self):
+        with self.lock:
+            return list(self.children.items())
+
+    def render(self):
+        lines = header(self.name, self.help, self.kind)
+        for values, child in sorted(self.items()):
+            for name, labels, value in child.samples(self.name, tuple(zip(self.labelnames, values))):
+                lines.append(sample(name, labels, value))
+        return lines
+
+
+registry = []
+
+
+def header(name, help_text, kind):
+    return ['# HELP {} {}'.format(name, help_text), '# TYPE {} {}'.format(name, kind)]
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def sample(name, labels, value):
+    if labels:
+        name = '{}{{{}}}'.format(name, ','.join('{}="{}"'.format(label, escape(label_value))
+                                                for label, label_value in labels))
+    return '{} {}'.format(name, format_value(value))
+
+
+# Kinds of group the channel layer metrics are labelled with, by prefix
+GROUP_KINDS = {'players': 'players', 'game_master': 'game_master', 'session': 'session', 'gameteam': 'team'}
+
+
+def group_kind(method, target):
+    """
+    The label of a channel layer call: the kind of its group, or for a
+    send, "worker" (a game worker channel, see contest.sharding) or
+    "direct" (a connection). Never a name, there is one per connection.
+    """
+    if method == 'send_batch':
+        return 'batch'
+    if method == 'send':
+        return 'worker' if target.startswith('gameworker.') else 'direct'
+    return GROUP_KINDS.get(target.split('-', 1)[0], 'other')
+
+
+# Websocket messages, fed by contest.instrumentation
+
+MESSAGE_HISTOGRAMS = {
+    'latency_seconds': (LATENCY_BUCKETS, 'Time to handle a websocket message or channel layer event'),
+    'queries': (COUNT_BUCKETS, 'Database queries made handling a message'),
+    'query_seconds': (LATENCY_BUCKETS, 'Time spent in database queries handling a message'),
+    'channel_calls': (COUNT_BUCKETS, 'Channel layer calls made handling a message'),
+    'channel_seconds': (LATENCY_BUCKETS, 'Time spent in channel layer calls handling a message'),
+    'bytes_in': (SIZE_BUCKETS, 'Size of the websocket frame received'),
+    'bytes_out': (SIZE_BUCKETS, 'Size of the websocket frames sent handling a message'),
+}
+
+message_histograms = {
+    name: Family('contest_message_' + name, help_text, ('kind', 'type'),
+                 lambda buckets=buckets: Histogram(buckets))
+    for name, (buckets, help_text) in MESSAGE_HISTOGRAMS.items()
+}
+
+# Channel layer, fed by the consumers
+
+group_members = Family('contest_group_members', 'Connections in the channel layer groups of this process, by kind '
+                       'of group', ('group',), Gauge)
+channel_full = Family('contest_channel_full_total', 'Channel layer calls that failed with ChannelFull',
+                      ('group',), Counter)
+channel_failures = Family('contest_channel_failures_total', 'Channel layer calls that failed otherwise',
+                          ('group',), Counter)
+
+# Questions, fed by contest.tracing
+
+question_hops = Family('contest_question_hop_seconds', 'Latency of each hop of a question, from its push to the '
+                       'answer on the game master screen', ('hop',), lambda: Histogram(LATENCY_BUCKETS))
+
+# Game state written back, fed by contest.engine: every save would be a
+# commit of its own without the write-behind
+
+state_saves = Counter()
+state_commits = Counter()
+state_fields_written = Counter()
+
+# HTTP requests, fed by DatabaseTimeMiddleware
+
+request_db_seconds = Family('contest_http_request_db_seconds', 'Time spent in database queries per HTTP request',
+                            ('view',), lambda: Histogram(LATENCY_BUCKETS))
+request_queries = Family('contest_http_request_queries', 'Database queries per HTTP request',
+                         ('view',), lambda: Histogram(COUNT_BUCKETS))
+
+
+class DatabaseTimeMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timer = QueryTimer()
+        with connection.execute_wrapper(timer):
+            response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        view = (match.url_name or match.view_name) if match else 'unresolved'
+        request_db_seconds.labels(view).observe(timer.seconds)
+        request_queries.labels(view).observe(timer.count)
+        return response
+
+
+class QueryTimer:
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - start
+
+
+def live_state():
+    from contest.engine import engine
+
+    state_names = dict(DUEL_GAME_STATES)
+    games = {name: 0 for name in state_names.values()}
+    with engine.lock:
+        sessions = list(engine.sessions.values())
+        game_states = list(engine.games.values())
+    for game in game_states:
+        name = state_names.get(game.state, str(game.state))
+        games[name] = games.get(name, 0) + 1
+    active = sum(1 for session in sessions
+                 if session.current_game() is not None and session.current_game().state != 5)
+
+    lines = header('contest_sessions', 'Game sessions loaded in this process', 'gauge')
+    lines.append(sample('contest_sessions', (), len(sessions)))
+    lines += header('contest_active_sessions', 'Loaded sessions with a game still being played', 'gauge')
+    lines.append(sample('contest_active_sessions', (), active))
+    lines += header('contest_games', 'Games of the loaded sessions, by state', 'gauge')
+    for name, count in sorted(games.items()):
+        lines.append(sample('contest_games', (('state', name),), count))
+    return lines
+
+
+def channel_capacities():
+    config = settings.CHANNEL_LAYERS.get('default', {}).get('CONFIG', {})
+    lines = header('contest_channel_capacity', 'Configured channel layer capacity, by channel or group', 'gauge')
+    lines.append(sample('contest_channel_capacity', (('group', 'default'),), config.get('capacity', 100)))
+    for group, capacity in sorted(config.get('channel_capacity', {}).items()):
+        lines.append(sample('contest_channel_capacity', (('group', group),), capacity))
+    return lines
+
+
+def write_behind():
+    lines = header('contest_state_saves_total', 'Game state changes saved by the handlers', 'counter')
+    lines.append(sample('contest_state_saves_total', (), state_saves.value()))
+    lines += header('contest_state_commits_total', 'Transactions that wrote the game state back', 'counter')
+    lines.append(sample('contest_state_commits_total', (), state_commits.value()))
+    lines += header('contest_state_fields_written_total', 'Changed fields written back', 'counter')
+    lines.append(sample('contest_state_fields_written_total', (), state_fields_written.value()))
+    return lines
+
+
+def render():
+    lines = live_state() + channel_capacities() + write_behind()
+    for family in registry:
+        lines += family.render()
+    return '\n'.join(lines) + '\n'
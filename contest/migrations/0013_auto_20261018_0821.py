@@ -0,0 +1,28 @@
+# Generated by Django 2.1.3 on 2026-10-18 08:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contest', '0012_duelgame_correct_answer'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gamesession',
+            name='deck_drawn',
+            field=models.TextField(default='{}'),
+        ),
+        migrations.AddField(
+            model_name='gamesession',
+            name='deck_seed',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='gamesession',
+            name='question_deck',
+            field=models.TextField(default='{}'),
+        ),
+    ]
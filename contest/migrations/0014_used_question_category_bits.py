@@ -0,0 +1,89 @@
+# Generated by Django 2.1.3 on 2026-10-18 08:28
+
+import json
+
+from django.db import migrations, models
+
+
+def quiz_positions(Question, quiz_id):
+    # Same ordering as contest.content.QuizSnapshot
+    question_positions = {}
+    category_positions = {}
+    for question_id, category in Question.objects.filter(quiz_id=quiz_id).order_by('id').values_list('id', 'category'):
+        question_positions[question_id] = len(question_positions)
+        category_positions.setdefault(category, len(category_positions))
+    return question_positions, category_positions
+
+
+def pack(positions, items):
+    bits = 0
+    for item in items:
+        if item in positions:
+            bits |= 1 << positions[item]
+    return bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+
+
+def unpack(positions, data):
+    bits = int.from_bytes(bytes(data or b''), 'little')
+    return [item for item, position in positions.items() if bits >> position & 1]
+
+
+def lists_to_bits(apps, schema_editor):
+    GameSession = apps.get_model('contest', 'GameSession')
+    DuelGame = apps.get_model('contest', 'DuelGame')
+    Question = apps.get_model('contest', 'Question')
+    for session in GameSession.objects.all():
+        question_positions, category_positions = quiz_positions(Question, session.quiz_id)
+        session.used_questions = pack(question_positions, json.loads(session.questions_removed or '[]') or [])
+        session.save(update_fields=['used_questions'])
+        for game in DuelGame.objects.filter(session=session):
+            game.used_categories = pack(category_positions, json.loads(game.categories_removed or '[]') or [])
+            game.save(update_fields=['used_categories'])
+
+
+def bits_to_lists(apps, schema_editor):
+    GameSession = apps.get_model('contest', 'GameSession')
+    DuelGame = apps.get_model('contest', 'DuelGame')
+    Question = apps.get_model('contest', 'Question')
+    for session in GameSession.objects.all():
+        question_positions, category_positions = quiz_positions(Question, session.quiz_id)
+        session.questions_removed = json.dumps(unpack(question_positions, session.used_questions))
+        session.save(update_fields=['questions_removed'])
+        for game in DuelGame.objects.filter(session=session):
+            game.categories_removed = json.dumps(unpack(category_positions, game.used_categories))
+            game.save(update_fields=['categories_removed'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contest', '0013_auto_20261018_0821'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='duelgame',
+            name='used_categories',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.AddField(
+            model_name='gamesession',
+            name='used_questions',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.RunPython(lists_to_bits, bits_to_lists),
+        # So that the column can be added back when migrating backwards
+        migrations.AlterField(
+            model_name='gamesession',
+            name='questions_removed',
+            field=models.CharField(default='[]', max_length=300),
+        ),
+        migrations.RemoveField(
+            model_name='duelgame',
+            name='categories_removed',
+        ),
+        migrations.RemoveField(
+            model_name='gamesession',
+            name='questions_removed',
+        ),
+    ]
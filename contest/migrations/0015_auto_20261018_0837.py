@@ -0,0 +1,18 @@
+# Generated by Django 2.1.3 on 2026-10-18 08:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contest', '0014_used_question_category_bits'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='gameteam',
+            name='device_unique_id',
+            field=models.CharField(db_index=True, max_length=50, null=True),
+        ),
+    ]
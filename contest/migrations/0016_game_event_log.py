@@ -0,0 +1,61 @@
+# Generated by Django 2.1.3 on 2026-10-18 09:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contest', '0015_auto_20261018_0837'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GameEvent',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('seq', models.IntegerField()),
+                ('kind', models.PositiveSmallIntegerField(choices=[(1, 'device_registered'), (2, 'devices_reset'), (3, 'ready'), (4, 'category'), (5, 'question'), (6, 'answer'), (7, 'score'), (8, 'round_end'), (9, 'tie'), (10, 'game_end'), (11, 'finalists'), (12, 'state')])),
+                ('data', models.TextField(default='{}')),
+                ('changes', models.TextField(default='{}')),
+                ('created', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GameSnapshot',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('seq', models.IntegerField()),
+                ('state', models.TextField()),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contest.GameSession')),
+            ],
+        ),
+        migrations.RemoveField(
+            model_name='duelgame',
+            name='round_log',
+        ),
+        migrations.AddField(
+            model_name='gameevent',
+            name='game',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='contest.DuelGame'),
+        ),
+        migrations.AddField(
+            model_name='gameevent',
+            name='session',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contest.GameSession'),
+        ),
+        migrations.AddField(
+            model_name='gameevent',
+            name='team',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='contest.GameTeam'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='gamesnapshot',
+            unique_together={('session', 'seq')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='gameevent',
+            unique_together={('session', 'seq')},
+        ),
+    ]
@@ -1,5 +1,3 @@
-import json
-
 from django.db import models
 
 
@@ -20,6 +18,23 @@ DUEL_GAME_STATES = [
 ]
 
 
+# The transitions recorded in the event log of a session (see contest.events)
+GAME_EVENT_KINDS = [
+    (1, 'device_registered'),
+    (2, 'devices_reset'),
+    (3, 'ready'),
+    (4, 'category'),
+    (5, 'question'),
+    (6, 'answer'),
+    (7, 'score'),
+    (8, 'round_end'),
+    (9, 'tie'),
+    (10, 'game_end'),
+    (11, 'finalists'),
+    (12, 'state')
+]
+
+
 class Quiz(models.Model):
     id = models.AutoField(primary_key=True)
     name = models.CharField(max_length=100)
@@ -73,8 +88,14 @@ class GameSession(models.Model):
     id = models.AutoField(primary_key=True)
     quiz = models.ForeignKey(Quiz, on_delete=models.CASCADE)
     winner = models.ForeignKey(Team, on_delete=models.CASCADE, null=True, blank=True)
-    questions_removed = models.CharField(max_length=300)
+    # Bit i is set once the i-th question of the quiz (by id) was asked
+    # (see contest.bitset.PackedSet)
+    used_questions = models.BinaryField(default=b'')
     games_order = models.IntegerField(default=1)
+    # Shuffled question ids per category (see contest.deck.QuestionDeck)
+    deck_seed = models.IntegerField(null=True)
+    question_deck = models.TextField(default='{}')
+    deck_drawn = models.TextField(default='{}')
 
 
 class GameTeam(models.Model):
@@ -82,7 +103,7 @@ class GameTeam(models.Model):
     team = models.ForeignKey(Team, on_delete=models.CASCADE)
     game_session = models.ForeignKey(GameSession, on_delete=models.CASCADE)
     device_registered = models.BooleanField(default=False)
-    device_unique_id = models.CharField(max_length=50, null=True)
+    device_unique_id = models.CharField(max_length=50, null=True, db_index=True)
 
     class Meta:
         unique_together = (('team', 'game_session'),)
@@ -92,7 +113,8 @@ class DuelGame(models.Model):
     id = models.AutoField(primary_key=True)
     session = models.ForeignKey(GameSession, on_delete=models.CASCADE)
     step = models.IntegerField(default=1)
-    categories_removed = models.CharField(max_length=1000, default='[]')
+    # Bit i is set once the i-th category of the quiz was played
+    used_categories = models.BinaryField(default=b'')
     first_team = models.ForeignKey(GameTeam, on_delete=models.CASCADE,
                                    related_name='first_team', null=True)
     first_team_score = models.IntegerField(default=0)
@@ -107,7 +129,6 @@ class DuelGame(models.Model):
     state = models.IntegerField(default=0, choices=DUEL_GAME_STATES)
     answer_count = models.IntegerField(default=0)
     round_winner = models.CharField(null=True, max_length=50)
-    round_log = models.CharField(max_length=300, default=json.dumps([]))
     is_final = models.BooleanField(default=False)
     game_order = models.IntegerField()
     winner = models.ForeignKey(GameTeam, on_delete=models.CASCADE,
@@ -118,4 +139,33 @@ class DuelGame(models.Model):
         return len({q.category for q in self.session.quiz.question_set})
 
     def get_removed_categories_count(self):
-        return len(json.loads(self.categories_removed))
+        return bin(int.from_bytes(bytes(self.used_categories), 'little')).count('1')
+
+
+class GameEvent(models.Model):
+    id = models.AutoField(primary_key=True)
+    session = models.ForeignKey(GameSession, on_delete=models.CASCADE)
+    # Position in the log of the session, from 1
+    seq = models.IntegerField()
+    kind = models.PositiveSmallIntegerField(choices=GAME_EVENT_KINDS)
+    game = models.ForeignKey(DuelGame, on_delete=models.CASCADE, null=True)
+    team = models.ForeignKey(GameTeam, on_delete=models.CASCADE, null=True)
+    # JSON: what happened, then the fields it changed, by game id ("session"
+    # for the session and its devices)
+    data = models.TextField(default='{}')
+    changes = models.TextField(default='{}')
+    created = models.DateTimeField()
+
+    class Meta:
+        unique_together = (('session', 'seq'),)
+
+
+class GameSnapshot(models.Model):
+    id = models.AutoField(primary_key=True)
+    session = models.ForeignKey(GameSession, on_delete=models.CASCADE)
+    # The state once the events up to seq were applied
+    seq = models.IntegerField()
+    state = models.TextField()
+
+    class Meta:
+        unique_together = (('session', 'seq'),)
@@ -0,0 +1,107 @@
+"""
+The Redis channel layer of channels_redis, with the "batch" extension of
+contest.layers: a batch takes two round trips per Redis server.
+"""
+import asyncio
+import collections
+import time
+from contextlib import AsyncExitStack
+
+from channels.exceptions import ChannelFull
+from channels_redis.core import RedisChannelLayer
+
+
+# Pushes the messages of a batch: KEYS are the channel lists, ARGV the
+# messages, then their capacities, then 1 for the plain sends, which count
+# as refused when the channel is full (group sends are dropped silently)
+PUSH_BATCH = """
+    local count = #KEYS
+    local refused = 0
+    for i=1,count do
+        if redis.call('LLEN', KEYS[i]) < tonumber(ARGV[count + i]) then
+            redis.call('LPUSH', KEYS[i], ARGV[i])
+            redis.call('EXPIRE', KEYS[i], %d)
+        elseif ARGV[2 * count + i] == '1' then
+            refused = refused + 1
+        end
+    end
+    return refused
+"""
+
+
+class PipelinedRedisChannelLayer(RedisChannelLayer):
+    """
+    The Redis layer of channels_redis, with batches.
+    """
+    extensions = ['groups', 'flush', 'batch']
+
+    async def send_batch(self, calls):
+        now = time.time()
+        async with AsyncExitStack() as stack:
+            pipelines = {}
+
+            async def pipeline(index):
+                if index not in pipelines:
+                    connection = await stack.enter_async_context(self.connection(index))
+                    pipelines[index] = connection.pipeline()
+                return pipelines[index]
+
+            # Group changes and lookups, in order on the server of each group
+            lookups = []
+            for method, *args in calls:
+                if method == 'send':
+                    lookups.append((method, args, None))
+                    continue
+                group = args[0]
+                assert self.valid_group_name(group), 'Group name not valid'
+                key = self._group_key(group)
+                pipe = await pipeline(self.consistent_hash(group))
+                if method == 'group_add':
+                    assert self.valid_channel_name(args[1]), 'Channel name not valid'
+                    pipe.zadd(key, now, args[1])
+                    pipe.expire(key, self.group_expiry)
+                elif method == 'group_discard':
+                    pipe.zrem(key, args[1])
+                elif method == 'group_send':
+                    pipe.zremrangebyscore(key, min=0, max=int(now) - self.group_expiry)
+                    lookups.append((method, args, pipe.zrange(key, 0, -1)))
+                else:
+                    raise ValueError('Cannot batch {}'.format(method))
+            await asyncio.gather(*[pipe.execute() for pipe in pipelines.values()])
+
+            # server index -> [(channel key, message, capacity, plain send)]
+            pushes = collections.defaultdict(list)
+            for method, args, members in lookups:
+                if method == 'send':
+                    index, push = self.plain_push(*args)
+                    pushes[index].append(push)
+                    continue
+                channel_names = [member.decode('utf8') for member in members.result()]
+                keys_by_index, messages, capacities = self._map_channel_keys_to_connection(channel_names, args[1])
+                for index, channel_keys in keys_by_index.items():
+                    pushes[index].extend((key, messages[key], capacities[key], 0) for key in channel_keys)
+
+            script = PUSH_BATCH % self.expiry
+            connections = {index: await stack.enter_async_context(self.connection(index)) for index in pushes}
+            refused = await asyncio.gather(*[
+                connections[index].eval(script, keys=[push[0] for push in batch],
+                                        args=[push[1] for push in batch] + [push[2] for push in batch] +
+                                        [push[3] for push in batch])
+                for index, batch in pushes.items()
+            ])
+        if any(refused):
+            raise ChannelFull()
+
+    def plain_push(self, channel, message):
+        # Same key, message and server as RedisChannelLayer.send
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        assert '__asgi_channel__' not in message
+        if '!' in channel:
+            message = dict(message, __asgi_channel__=channel)
+            index = self.consistent_hash(channel)
+            channel_key = self.prefix + self.non_local_name(channel)
+        else:
+            index = next(self._send_index_generator)
+            channel_key = self.prefix + channel
+        return index, (channel_key, self.serialize(message), self.get_capacity(channel), 1)
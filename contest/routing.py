@@ -1,9 +1,19 @@
+from django.conf import settings
 from django.conf.urls import url
 
 from . import consumers
+from .sharding import worker_channel
 
 
-websocket_urlpatterns = [
-    url(r'^ws/game/$', consumers.QuizConsumer),
-    url(r'^ws/gamemaster/$', consumers.GameMasterConsumer),
-]
+if settings.ASYNC_CONSUMERS:
+    websocket_urlpatterns = [
+        url(r'^ws/game/$', consumers.AsyncQuizConsumer),
+        url(r'^ws/gamemaster/$', consumers.AsyncGameMasterConsumer),
+    ]
+else:
+    websocket_urlpatterns = [
+        url(r'^ws/game/$', consumers.QuizConsumer),
+        url(r'^ws/gamemaster/$', consumers.GameMasterConsumer),
+    ]
+
+channel_routes = {worker_channel(name): consumers.GameWorkerConsumer for name in settings.GAME_WORKERS}
@@ -0,0 +1,139 @@
+"""
+Session-affine sharding of the games over several processes.
+
+With GAME_WORKERS set to a list of worker names, the live state of every
+session (contest.engine) is owned by a single worker process, picked by
+consistent hashing over the session id. Each worker is run with
+
+    manage.py runworker gameworker.<name>
+
+once per name, and the daphne processes only hold the websockets: their
+consumers forward the game messages to the owner's channel along with the
+state of the connection (the team its device registered for, its groups).
+The worker plays them with the game handlers, delivers their outbox, and
+replies to the connection through its channel.
+
+Adding or removing a worker only moves the sessions hashed next to it, but
+a moved session is reloaded by its new owner from the database, so change
+GAME_WORKERS between games. Without GAME_WORKERS every process plays the
+messages it receives itself.
+
+Only the owner writes the rows of a session, even when it is not loaded:
+when the questions of a quiz change, the process that changed them sends
+the change to every worker, which rebuilds the sets of the sessions it
+owns (see GameEngine.rebuild_sets). Every change to quiz content is sent
+to the workers the same way, for them to drop their snapshot of the quiz
+(see contest.content), so the web processes need GAME_WORKERS too.
+"""
+import hashlib
+import threading
+from bisect import bisect
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from contest.models import DuelGame, GameTeam
+
+
+# Points of every worker on the ring, to even out the sessions they get
+REPLICAS = 100
+
+# game id -> session id, the mapping never changes
+MAX_CACHED_GAMES = 10000
+
+
+def hash_key(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+
+    def __init__(self, nodes, replicas=REPLICAS):
+        points = sorted((hash_key('{}#{}'.format(node, replica)), node)
+                        for node in nodes for replica in range(replicas))
+        self.keys = [point[0] for point in points]
+        self.nodes = [point[1] for point in points]
+
+    def owner(self, key):
+        return self.nodes[bisect(self.keys, hash_key(str(key))) % len(self.keys)]
+
+
+def workers():
+    return getattr(settings, 'GAME_WORKERS', None) or []
+
+
+def worker_channel(name):
+    return 'gameworker.{}'.format(name)
+
+
+def send_to_workers(event):
+    """
+    Sends the event to every game worker, from outside of the event loop.
+    """
+    layer = get_channel_layer()
+    for name in workers():
+        async_to_sync(layer.send)(worker_channel(name), event)
+
+
+class SessionRouter:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ring = None
+        self.ring_workers = None
+        self.game_sessions = {}
+
+    def owner(self, session_id):
+        """
+        Returns the channel of the worker owning the session.
+        """
+        names = tuple(workers())
+        with self.lock:
+            if names != self.ring_workers:
+                self.ring, self.ring_workers = HashRing(names), names
+            ring = self.ring
+        return worker_channel(ring.owner(session_id))
+
+    def reset(self):
+        with self.lock:
+            self.game_sessions = {}
+
+    def session_of_game(self, game_id):
+        try:
+            game_id = int(game_id)
+        except (TypeError, ValueError):
+            return None
+        session_id = self.game_sessions.get(game_id)
+        if session_id is None:
+            session_id = DuelGame.objects.filter(id=game_id).values_list('session_id', flat=True).first()
+            if session_id is not None:
+                with self.lock:
+                    if len(self.game_sessions) >= MAX_CACHED_GAMES:
+                        self.game_sessions.clear()
+                    self.game_sessions[game_id] = session_id
+        return session_id
+
+    def session_of_device(self, device_id):
+        # Same lookup as GameEngine.device: the latest registration wins
+        return (GameTeam.objects.filter(device_unique_id=device_id, device_registered=True)
+                .order_by('-id').values_list('game_session_id', flat=True).first())
+
+    def owner_channel(self, data, team=None):
+        """
+        Returns the channel of the worker that plays the message, or None to
+        play it here: sharding is off, or the message has no session (it is
+        then only answered with an error).
+        """
+        if not workers():
+            return None
+        if data.get('game') is not None:
+            session_id = self.session_of_game(data['game'])
+        elif data.get('type') == 'connected':
+            session_id = self.session_of_device(data.get('device'))
+        else:
+            session_id = team.session_id if team is not None else None
+        return self.owner(session_id) if session_id is not None else None
+
+
+router = SessionRouter()
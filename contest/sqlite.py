@@ -0,0 +1,116 @@
+"""
+SQLite production mode, turned on with SQLITE_PRODUCTION.
+
+Every new SQLite connection gets SQLITE_PRAGMAS (WAL, so readers never wait
+on the writer, synchronous=NORMAL, mmap, a busy timeout), and the game
+state writes of contest.engine go through a single writer thread instead
+of every consumer thread taking the file lock in turn: the writes queued
+while a transaction commits are committed together in the next one, up to
+SQLITE_WRITE_BATCH of them, each in its own savepoint so a failing write
+does not take the others down.
+
+Without SQLITE_PRODUCTION, or on another database, writes run in the
+calling thread as before.
+"""
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.backends.signals import connection_created
+
+
+logger = logging.getLogger(__name__)
+
+
+def production_mode():
+    return getattr(settings, 'SQLITE_PRODUCTION', False) and connection.vendor == 'sqlite'
+
+
+def configure_connection(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite' or not getattr(settings, 'SQLITE_PRODUCTION', False):
+        return
+    with connection.cursor() as cursor:
+        for name, value in getattr(settings, 'SQLITE_PRAGMAS', {}).items():
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+
+
+connection_created.connect(configure_connection)
+
+
+class Writer:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def run(self, func, *args, **kwargs):
+        """
+        Calls func on the writer thread, batched with the other queued
+        writes, and returns its result once committed. Runs it right here
+        outside of the production mode.
+        """
+        if not production_mode() or threading.current_thread() is self.thread:
+            return func(*args, **kwargs)
+        future = Future()
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._write_forever, name='sqlite-writer', daemon=True)
+                self.thread.start()
+            self.queue.put((future, func, args, kwargs))
+        return future.result()
+
+    def stop(self):
+        """
+        Stops the writer thread once the queued writes are done, closing its
+        connection (the database is about to change, in the benchmarks).
+        """
+        with self.lock:
+            thread, self.thread = self.thread, None
+            if thread is not None:
+                self.queue.put(None)
+        if thread is not None:
+            thread.join()
+
+    def _write_forever(self):
+        while True:
+            jobs = [self.queue.get()]
+            while jobs[-1] is not None and len(jobs) < getattr(settings, 'SQLITE_WRITE_BATCH', 100):
+                try:
+                    jobs.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = jobs[-1] is None
+            if stop:
+                jobs.pop()
+            if jobs:
+                self.write(jobs)
+            if stop:
+                connection.close()
+                return
+
+    def write(self, jobs):
+        results = []
+        try:
+            with transaction.atomic():
+                for future, func, args, kwargs in jobs:
+                    try:
+                        with transaction.atomic():
+                            results.append((future, func(*args, **kwargs), None))
+                    except Exception as exc:
+                        results.append((future, None, exc))
+        except Exception as exc:
+            logger.exception('Committing %d queued writes failed', len(jobs))
+            connection.close()
+            results = [(job[0], None, exc) for job in jobs]
+        for future, result, exc in results:
+            if exc is None:
+                future.set_result(result)
+            else:
+                future.set_exception(exc)
+
+
+writer = Writer()
@@ -1,3 +1,1089 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from unittest import mock
 
-# Create your tests here.
+import msgpack
+from asgiref.sync import async_to_sync
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from channels.testing import ApplicationCommunicator, WebsocketCommunicator
+from django.conf import settings
+from django.db import connection, connections
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+
+from contest import events
+from contest.bench import IN_MEMORY_CHANNEL_LAYERS, seed_quiz, start_session, skip_to_final
+from contest.bitset import PackedSet, positions
+from contest.codec import JSON, MSGPACK, pre_encode, negotiate, decode
+from contest.consumers import TracingMixin, QuizConsumer, GameMasterConsumer, GameWorkerConsumer
+from contest.content import content
+from contest.deck import QuestionDeck
+from contest.delivery import SentFrames, tracker
+from contest.engine import engine
+from contest.metrics import channel_full, group_kind
+from contest.game import Outbox, QuizHandler, GameMasterHandler, gameteam_group, session_group
+from contest.models import Answer, GameSession, GameTeam, DuelGame, Question, Team
+from contest.sharding import HashRing, router, worker_channel
+from contest.sqlite import writer
+from contest.tracing import tracer
+
+
+class EngineTestMixin:
+    """
+    Starts every test with no game state, quiz content or traces in memory,
+    and the game state written back at the end of every handler turn.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.engine_settings = override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS,
+                                                 GAME_STATE_FLUSH_INTERVAL=0)
+        self.engine_settings.enable()
+        self.forget()
+
+    def tearDown(self):
+        self.forget()
+        self.engine_settings.disable()
+        super().tearDown()
+
+    def forget(self):
+        engine.reset()
+        content.invalidate()
+        router.reset()
+        tracer.reset()
+
+
+class PackedSetTests(TestCase):
+
+    def setUp(self):
+        self.universe = ('a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i')
+        self.index = positions(self.universe)
+
+    def test_add_and_contains(self):
+        packed = PackedSet(self.universe, self.index)
+        packed.add('b')
+        packed.add('i')
+        packed.add('b')
+        self.assertIn('b', packed)
+        self.assertIn('i', packed)
+        self.assertNotIn('a', packed)
+        self.assertNotIn('unknown', packed)
+        self.assertEqual(len(packed), 2)
+        self.assertEqual(packed.remaining(), 7)
+        self.assertEqual(list(packed), ['b', 'i'])
+        self.assertEqual(packed.missing(), ['a', 'c', 'd', 'e', 'f', 'g', 'h'])
+
+    def test_bytes_round_trip(self):
+        packed = PackedSet.from_items(self.universe, self.index, ['a', 'c', 'i'])
+        data = packed.to_bytes()
+        self.assertEqual(data, bytes([0b101, 0b1]))
+        self.assertEqual(list(PackedSet.from_bytes(self.universe, self.index, data)), ['a', 'c', 'i'])
+        self.assertEqual(PackedSet(self.universe, self.index).to_bytes(), b'')
+        self.assertEqual(len(PackedSet.from_bytes(self.universe, self.index, None)), 0)
+
+    def test_bits_outside_of_the_universe_are_dropped(self):
+        packed = PackedSet.from_bytes(self.universe, self.index, bytes([0xff, 0xff, 0xff]))
+        self.assertEqual(len(packed), len(self.universe))
+        self.assertEqual(packed.remaining(), 0)
+
+    def test_from_items_leaves_out_unknown_items(self):
+        packed = PackedSet.from_items(self.universe, self.index, ['z', 'e'])
+        self.assertEqual(list(packed), ['e'])
+
+
+class RebuildSetsTests(EngineTestMixin, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.quiz = seed_quiz(categories=3, questions_per_category=2)
+        self.questions = list(Question.objects.filter(quiz=self.quiz).order_by('id'))
+        self.played, _ = start_session(self.quiz, ['Team {}'.format(i) for i in range(6)])
+        self.idle, _ = start_session(self.quiz, ['Team {}'.format(i) for i in range(6)])
+
+    def use(self, session_id, question, category):
+        session = engine.session(session_id)
+        with session.lock:
+            session.used_questions.add(question.id)
+            session.save()
+            game = session.current_game()
+            game.used_categories.add(category)
+            game.save()
+        return session, game
+
+    def test_sets_follow_their_items_when_questions_are_deleted(self):
+        last = self.questions[-1]
+        self.use(self.idle.id, last, 'Category 2')
+        engine.flush()
+        engine.reset()
+        session, game = self.use(self.played.id, self.questions[3], 'Category 2')
+        engine.flush()
+
+        # Every position moves: two questions, and the first category, go
+        for question in self.questions[:2]:
+            question.delete()
+
+        self.assertEqual(list(session.used_questions), [self.questions[3].id])
+        self.assertEqual(list(game.used_categories), ['Category 2'])
+        self.assertEqual(session.used_questions.universe, content.snapshot(self.quiz.id).question_ids)
+        engine.flush()
+        for session_id in (self.played.id, self.idle.id):
+            self.assertEqual(events.mismatches(session_id), [])
+
+        engine.reset()
+        content.invalidate()
+        self.assertEqual(list(engine.session(self.played.id).used_questions), [self.questions[3].id])
+        idle = engine.session(self.idle.id)
+        self.assertEqual(list(idle.used_questions), [last.id])
+        self.assertEqual(list(idle.current_game().used_categories), ['Category 2'])
+
+    def test_adding_a_question_keeps_the_rows(self):
+        self.use(self.idle.id, self.questions[-1], 'Category 1')
+        engine.flush()
+        engine.reset()
+        rows = GameSession.objects.filter(id=self.idle.id).values_list('used_questions', flat=True)
+        before = bytes(rows.get())
+
+        session, game = self.use(self.played.id, self.questions[0], 'Category 0')
+        added = Question.objects.create(quiz=self.quiz, category='Category 9', question_text='New?')
+
+        self.assertEqual(bytes(rows.get()), before)
+        # The sets in memory take the new question
+        with session.lock:
+            session.used_questions.add(added.id)
+            game.used_categories.add('Category 9')
+        self.assertEqual(list(session.used_questions), [self.questions[0].id, added.id])
+        self.assertEqual(list(game.used_categories), ['Category 0', 'Category 9'])
+
+    @override_settings(GAME_WORKERS=['a', 'b'])
+    def test_game_workers_rebuild_the_sessions_they_own(self):
+        for session_id, question in ((self.played.id, self.questions[3]), (self.idle.id, self.questions[-1])):
+            self.use(session_id, question, 'Category 2')
+        engine.flush()
+        engine.reset()
+        rows = GameSession.objects.filter(quiz=self.quiz).order_by('id').values_list('used_questions', flat=True)
+        before = [bytes(data) for data in rows.all()]
+        logged = [events.history(session_id).count() for session_id in (self.played.id, self.idle.id)]
+
+        for question in self.questions[:2]:
+            question.delete()
+
+        # The sessions are the workers', this process leaves their rows alone
+        self.assertEqual([bytes(data) for data in rows.all()], before)
+        self.assertEqual([events.history(session_id).count() for session_id in (self.played.id, self.idle.id)],
+                         logged)
+        layer = get_channel_layer()
+        done = set()
+        for name in ('a', 'b'):
+            channel = worker_channel(name)
+            worker = GameWorkerConsumer({'type': 'channel', 'channel': channel})
+            event = {'type': None}
+            while event['type'] != 'quiz.questions_changed':
+                event = async_to_sync(layer.receive)(channel)
+                getattr(worker, event['type'].replace('.', '_'))(event)
+            done.add(channel)
+            # Only rebuilt by its owner
+            self.assertEqual([bytes(data) != old for data, old in zip(rows.all(), before)],
+                             [router.owner(session_id) in done for session_id in (self.played.id, self.idle.id)])
+
+        for session_id in (self.played.id, self.idle.id):
+            self.assertEqual(events.mismatches(session_id), [])
+        engine.reset()
+        self.assertEqual(list(engine.session(self.played.id).used_questions), [self.questions[3].id])
+        self.assertEqual(list(engine.session(self.idle.id).used_questions), [self.questions[-1].id])
+
+
+class QuestionDeckTests(TestCase):
+
+    def setUp(self):
+        self.questions = [(question_id, 'Category {}'.format(question_id % 3)) for question_id in range(1, 13)]
+
+    def test_same_seed_same_deck(self):
+        deck = QuestionDeck.build(self.questions, seed=7)
+        self.assertEqual(deck.cards, QuestionDeck.build(self.questions, seed=7).cards)
+        self.assertNotEqual(deck.cards, QuestionDeck.build(self.questions, seed=8).cards)
+        self.assertEqual(deck.categories(), ['Category 1', 'Category 2', 'Category 0'])
+        self.assertEqual(sorted(deck.cards['Category 0']), [3, 6, 9, 12])
+
+    def test_every_card_is_drawn_once(self):
+        deck = QuestionDeck.build(self.questions, seed=1, exclude={6})
+        self.assertEqual(deck.remaining(), 11)
+        drawn = [deck.draw('Category 0') for _ in range(3)]
+        self.assertEqual(sorted(drawn), [3, 9, 12])
+        self.assertIsNone(deck.draw('Category 0'))
+        self.assertIsNone(deck.draw('Unknown'))
+        self.assertEqual(deck.remaining('Category 0'), 0)
+        self.assertEqual(deck.remaining(), 8)
+        self.assertEqual(deck.untouched_categories(), ['Category 1', 'Category 2'])
+
+    def test_json_round_trip_keeps_the_position(self):
+        deck = QuestionDeck.build(self.questions, seed=3)
+        first = deck.draw('Category 1')
+        restored = QuestionDeck.from_json(deck.cards_json(), deck.drawn_json())
+        self.assertNotEqual(restored.draw('Category 1'), first)
+        self.assertEqual(restored.remaining('Category 1'), 2)
+
+    def test_rebuilt_on_the_questions_left(self):
+        deck = QuestionDeck.build(self.questions, seed=5, exclude={6})
+        first = deck.draw('Category 0')
+        left = deck.cards['Category 0'][1:]
+        # A card left is deleted, so is Category 1, 2 moves to Category 0 and 13 is new
+        questions = [(question_id, category) for question_id, category in self.questions
+                     if question_id not in (left[0], 2) and category != 'Category 1']
+        rebuilt = deck.rebuilt(sorted(questions + [(2, 'Category 0'), (13, 'Category 0')]), exclude={6})
+        self.assertEqual(rebuilt.categories(), ['Category 0', 'Category 2'])
+        self.assertEqual(rebuilt.cards['Category 0'][0], first)
+        self.assertEqual(sorted(rebuilt.cards['Category 0'][1:]), sorted(left[1:] + [2, 13]))
+        self.assertEqual(rebuilt.remaining('Category 0'), 3)
+        self.assertEqual(rebuilt.cards['Category 2'], [card for card in deck.cards['Category 2'] if card != 2])
+        self.assertEqual(deck.rebuilt(self.questions, exclude={6}).cards, deck.cards)
+
+
+class ChangedQuestionsTests(EngineTestMixin, TransactionTestCase):
+    """
+    Questions deleted or added while a session is played.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.quiz = seed_quiz(categories=2, questions_per_category=3)
+        session, first_game = start_session(self.quiz, ['Team {}'.format(i) for i in range(6)])
+        self.session = engine.session(session.id)
+        self.game = engine.game(first_game.id)
+
+    def play_category(self, category):
+        with self.session.lock:
+            self.game.state = 2
+            self.game.selected_category = category
+            self.game.save('category', category=category)
+        return GameMasterHandler().receive({'type': 'duel_game_continue', 'game': self.game.id})
+
+    def test_deleted_questions_are_not_drawn(self):
+        cards = list(self.session.deck.cards['Category 0'])
+        Question.objects.filter(id__in=cards[:2]).delete()
+
+        self.play_category('Category 0')
+        self.assertEqual(self.game.question_id, cards[2])
+        self.assertEqual(self.session.deck.remaining('Category 0'), 0)
+        messages = self.play_category('Category 0')
+        self.assertEqual(messages, [('reply', {'type': 'error', 'message': 'no questions'})])
+
+        engine.reset()
+        session = engine.session(self.session.id)
+        self.assertEqual(session.deck.cards['Category 0'], [cards[2]])
+        self.assertEqual(session.deck.remaining('Category 0'), 0)
+
+    def test_questions_gone_unnoticed_are_skipped(self):
+        cards = list(self.session.deck.cards['Category 1'])
+        # update() sends no signals, the deck keeps the question
+        other = seed_quiz(categories=1, questions_per_category=1, name='Other quiz')
+        Question.objects.filter(id=cards[0]).update(quiz=other)
+        content.invalidate()
+
+        self.play_category('Category 1')
+        self.assertEqual(self.game.question_id, cards[1])
+        self.assertEqual(list(self.session.used_questions), [cards[1]])
+
+    def test_added_questions_are_drawn(self):
+        added = Question.objects.create(quiz=self.quiz, category='Category 9', question_text='New?')
+        self.assertEqual(self.session.deck.cards['Category 9'], [added.id])
+        self.play_category('Category 9')
+        self.assertEqual(self.game.question_id, added.id)
+
+    def test_decks_of_sessions_not_loaded_are_rebuilt(self):
+        self.play_category('Category 0')
+        cards = list(self.session.deck.cards['Category 0'])
+        engine.reset()
+        Question.objects.filter(id=cards[1]).delete()
+        moved = Question.objects.get(id=cards[2])
+        moved.category = 'Category 1'
+        moved.save()
+
+        row = GameSession.objects.get(id=self.session.id)
+        self.assertEqual(json.loads(row.question_deck)['Category 0'], cards[:1])
+        self.assertEqual(events.mismatches(self.session.id), [])
+        session = engine.session(self.session.id)
+        self.assertEqual(session.deck.remaining('Category 0'), 0)
+        self.assertEqual(session.deck.remaining('Category 1'), 4)
+
+
+class CodecTests(TestCase):
+
+    def test_spliced_frames_decode_to_every_member(self):
+        for size in (1, 14, 20):
+            members = {'member_{}'.format(i): [i, 'text {}'.format(i)] for i in range(size)}
+            fields = {'type': 'question.send', 'game': 3, 'seq': 12}
+            pre_encoded = pre_encode(**members)
+            # Through a channel layer event and back
+            pre_encoded = msgpack.unpackb(msgpack.packb(pre_encoded, use_bin_type=True), raw=False)
+            for codec in (JSON, MSGPACK):
+                frame = codec.encode_with(pre_encoded, **fields)
+                self.assertEqual(decode(**frame), dict(fields, **members), (codec.name, size))
+
+    def test_plain_frames(self):
+        self.assertEqual(decode(**JSON.encode({'type': 'info'})), {'type': 'info'})
+        self.assertEqual(JSON.encode('already text'), {'text_data': 'already text'})
+        self.assertEqual(decode(**MSGPACK.encode({'type': 'info', 'data': b'1'})), {'type': 'info', 'data': b'1'})
+
+    def test_negotiate(self):
+        self.assertEqual(negotiate({'subprotocols': ['other', 'msgpack']}), (MSGPACK, 'msgpack'))
+        self.assertEqual(negotiate({'query_string': b'encoding=msgpack'}), (MSGPACK, None))
+        self.assertEqual(negotiate({'query_string': b'encoding=xml'}), (JSON, None))
+        self.assertEqual(negotiate({}), (JSON, None))
+
+
+class HashRingTests(TestCase):
+
+    def test_keys_spread_over_every_node(self):
+        ring = HashRing(['a', 'b', 'c'])
+        owners = Counter(ring.owner(key) for key in range(3000))
+        self.assertEqual(set(owners), {'a', 'b', 'c'})
+        for count in owners.values():
+            self.assertGreater(count, 600)
+        self.assertEqual(ring.owner(42), HashRing(['c', 'b', 'a']).owner(42))
+
+    def test_removing_a_node_only_moves_its_keys(self):
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'b'])
+        for key in range(3000):
+            if before.owner(key) != 'c':
+                self.assertEqual(after.owner(key), before.owner(key))
+            else:
+                self.assertIn(after.owner(key), ('a', 'b'))
+
+
+@override_settings(GAME_WORKERS=['a', 'b'])
+class WorkerContentTests(EngineTestMixin, TransactionTestCase):
+    """
+    Quiz content changed by another process than the game workers.
+    """
+
+    def test_workers_drop_their_snapshot(self):
+        quiz = seed_quiz(categories=1, questions_per_category=2)
+        session, first_game = start_session(quiz, ['Team {}'.format(i) for i in range(6)])
+        game = engine.game(first_game.id)
+        question = Question.objects.filter(quiz=quiz).order_by('id').first()
+        with game.session.lock:
+            game.state = 2
+            game.question_id = question.id
+            game.save()
+        # What a worker has, before the change
+        stale = content.snapshot(quiz.id)
+        self.assertEqual(game.view()[0]['question']['answers'][1], 'Answer 1')
+
+        answer = Answer.objects.get(question=question, number=1)
+        answer.answer_text = 'Changed'
+        answer.save()
+        content.snapshots[quiz.id] = stale
+
+        layer = get_channel_layer()
+        for name in ('a', 'b'):
+            channel = worker_channel(name)
+            event = async_to_sync(layer.receive)(channel)
+            self.assertEqual(event, {'type': 'quiz.content_changed', 'quiz': quiz.id})
+            GameWorkerConsumer({'type': 'channel', 'channel': channel}).quiz_content_changed(event)
+        self.assertEqual(content.snapshot(quiz.id).question(question.id).answers[1].text, 'Changed')
+        frame = JSON.encode_with(content.snapshot(quiz.id).payload(question.id).player, type='question_send')
+        self.assertIn('Changed', decode(**frame)['answers'].values())
+        self.assertEqual(game.view()[0]['question']['answers'][1], 'Changed')
+
+
+class ChannelMetricsTests(TestCase):
+
+    def test_labels_are_kinds_never_names(self):
+        self.assertEqual(group_kind('group_add', 'players'), 'players')
+        self.assertEqual(group_kind('group_send', 'game_master'), 'game_master')
+        self.assertEqual(group_kind('group_send', 'session-12'), 'session')
+        self.assertEqual(group_kind('group_discard', 'gameteam-7'), 'team')
+        self.assertEqual(group_kind('send', 'gameworker.a'), 'worker')
+        self.assertEqual(group_kind('send', 'specific.1a2b!c3d4'), 'direct')
+        self.assertEqual(group_kind('send_batch', 'batch'), 'batch')
+        self.assertEqual(group_kind('group_send', 'unexpected'), 'other')
+
+    def test_failed_sends_to_connections_share_a_label(self):
+        for number in range(3):
+            TracingMixin().channel_layer_failed('send', 'specific.{}!abc'.format(number), ChannelFull())
+        labels = [values for values, child in channel_full.items()]
+        self.assertIn(('direct',), labels)
+        self.assertFalse([values for values in labels if values[0].startswith('specific.')])
+
+
+class ChannelLayerImportTests(TestCase):
+
+    def test_consumers_layers_do_not_need_channels_redis(self):
+        loaded = subprocess.check_output(
+            [sys.executable, '-c', 'import sys, contest.layers; print("channels_redis" in sys.modules)'],
+            cwd=settings.BASE_DIR)
+        self.assertEqual(loaded.strip(), b'False')
+
+
+class SentFramesTests(TestCase):
+
+    def test_held_frames_are_replayed_only_once_released(self):
+        sent = SentFrames(10)
+        last_seq = sent.seq
+        outbox = Outbox()
+        outbox.group_send('gameteam-1', {'type': 'info'}, sent=sent)
+        outbox.ordered_send(99, 'game_master', {'type': 'question.send'}, 'gameteam-1', {'type': 'question_send'},
+                            sent=sent)
+        method, group, event = outbox.messages[-1]
+        missed = sent.since(last_seq, ['gameteam-1'])
+        self.assertEqual([frame['type'] for frame in missed], ['info'])
+
+        group, held = tracker.release(99, event['seq'])
+        missed = sent.since(last_seq, ['gameteam-1'])
+        self.assertEqual([frame['type'] for frame in missed], ['info', 'question_send'])
+        self.assertEqual(missed[-1]['session_seq'], held['session_seq'])
+
+
+@override_settings(DELIVERY_ACK_TIMEOUT=0.1)
+class HeldFramesTests(EngineTestMixin, TransactionTestCase):
+    """
+    Player frames held back until the game master frame is out.
+    """
+
+    def setUp(self):
+        super().setUp()
+        quiz = seed_quiz(categories=3, questions_per_category=2)
+        session, first_game = start_session(quiz, ['Team {}'.format(i) for i in range(6)])
+        self.game = engine.game(first_game.id)
+        self.team = self.game.session.team_name(self.game.first_team_id)
+
+    async def registered_device(self):
+        device = WebsocketCommunicator(QuizConsumer, '/ws/quiz/')
+        self.assertTrue((await device.connect())[0])
+        await device.send_json_to({'type': 'register', 'team': self.team, 'game': self.game.id,
+                                   'device': 'device-1'})
+        self.assertEqual((await device.receive_json_from())['type'], 'device_registered')
+        with self.game.session.lock:
+            self.game.state = 1
+            self.game.first_player_turn = True
+            self.game.save()
+        return device
+
+    def test_released_after_the_timeout_without_a_game_master(self):
+        async_to_sync(self.push_from_a_worker)()
+        self.assertNotIn(self.game.id, self.held_games())
+
+    async def push_from_a_worker(self):
+        device = await self.registered_device()
+        worker = ApplicationCommunicator(GameWorkerConsumer, {'type': 'channel', 'channel': 'gameworker.a'})
+        await worker.send_input({'type': 'game.message', 'role': 'game_master', 'reply_channel': 'master-reply',
+                                 'state': None, 'data': {'type': 'duel_game_continue', 'game': self.game.id}})
+        frame = await device.receive_json_from(timeout=2)
+        self.assertEqual((frame['type'], frame['to']), ('category.send', self.team))
+        await device.disconnect()
+        worker.stop()
+
+    def test_released_by_the_consumer_holding_it(self):
+        async_to_sync(self.write_frame_held_elsewhere)()
+        self.assertNotIn(self.game.id, self.held_games())
+
+    async def write_frame_held_elsewhere(self):
+        screen = WebsocketCommunicator(GameMasterConsumer, '/ws/game_master/')
+        self.assertTrue((await screen.connect())[0])
+        device = await self.registered_device()
+        self.assertIn('info', await screen.receive_json_from())
+        outbox = Outbox()
+        outbox.ordered_send(self.game.id, 'game_master', {'type': 'send.categories'},
+                            gameteam_group(self.game.first_team_id), {'type': 'category.send', 'to': self.team})
+        method, group, event = outbox.messages[0]
+        layer = get_channel_layer()
+        # Held by the device's consumer in another process: only its channel can release it
+        owner = list(layer.groups[gameteam_group(self.game.first_team_id)])[0]
+        await layer.group_send(group, dict(event, owner=owner, holder='another process'))
+        self.assertEqual((await screen.receive_json_from())['type'], 'send.categories')
+        frame = await device.receive_json_from(timeout=0.05)
+        self.assertEqual((frame['type'], frame['seq']), ('category.send', event['seq'] + 1))
+        await screen.disconnect()
+        await device.disconnect()
+
+    def test_ended_games_are_forgotten(self):
+        Outbox().ordered_send(self.game.id, 'game_master', {'type': 'send.categories'}, 'players',
+                              {'type': 'category.send'})
+        self.assertIn(self.game.id, tracker.sequences)
+        self.assertIn(self.game.id, self.held_games())
+        with self.game.session.lock:
+            self.game.state = 5
+            self.game.save('game_end', self.game.first_team_id)
+        self.assertNotIn(self.game.id, tracker.sequences)
+        self.assertNotIn(self.game.id, self.held_games())
+
+    def held_games(self):
+        return [game_id for game_id, seq in tracker.held]
+
+
+class EventReplayTests(EngineTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        quiz = seed_quiz(categories=3, questions_per_category=2)
+        self.question_id = Question.objects.filter(quiz=quiz).order_by('id').values_list('id', flat=True).first()
+        session, first_game = start_session(quiz, ['Team {}'.format(i) for i in range(6)])
+        self.session = engine.session(session.id)
+        self.game = engine.game(first_game.id)
+
+    def play(self):
+        game = self.game
+        with self.session.lock:
+            game.state = 1
+            game.save('ready')
+            game.selected_category = 'Category 0'
+            game.save('category')
+            game.state = 2
+            game.question_id = self.question_id
+            game.save('question', question=self.question_id)
+            game.first_team_score += 1
+            game.answered.add(game.first_team_id)
+            game.round_log.append('Team answered correctly!')
+            game.save('answer', game.first_team_id, question=self.question_id, answer=1)
+        engine.flush()
+
+    def test_transitions_are_logged_with_their_changes(self):
+        self.play()
+        logged = [(event.get_kind_display(), json.loads(event.changes)) for event in events.history(self.session.id)]
+        key = str(self.game.id)
+        self.assertEqual([kind for kind, changes in logged], ['ready', 'category', 'question', 'score', 'answer'])
+        self.assertEqual(logged[1][1], {key: {'selected_category': 'Category 0'}})
+        # The score goes first, on its own
+        self.assertEqual(logged[3][1], {key: {'first_team_score': 1}})
+        self.assertEqual(logged[4][1], {key: {'answered': [self.game.first_team_id],
+                                              'round_log': ['Team answered correctly!']}})
+
+    def test_replay_matches_the_rows_and_any_seq(self):
+        with override_settings(GAME_SNAPSHOT_EVERY=2):
+            # Loaded again with the new interval
+            engine.reset()
+            self.session = engine.session(self.session.id)
+            self.game = engine.game(self.game.id)
+            self.play()
+        self.assertEqual(events.mismatches(self.session.id), [])
+        category = events.history(self.session.id).get(kind=events.KINDS['category'])
+        replayed = events.replay(self.session.id, upto=category.seq)
+        self.assertEqual(replayed['seq'], category.seq)
+        game = replayed['games'][str(self.game.id)]
+        self.assertEqual((game['state'], game['selected_category'], game['question_id']), (1, 'Category 0', None))
+        latest = events.replay(self.session.id)
+        self.assertGreater(latest['snapshot'], 0)
+        self.assertEqual(latest['games'][str(self.game.id)]['first_team_score'], 1)
+
+    def test_loading_restores_the_state_kept_in_memory(self):
+        self.play()
+        engine.reset()
+        game = engine.game(self.game.id)
+        self.assertEqual(game.question_id, self.question_id)
+        self.assertEqual(game.answered, {game.first_team_id})
+        self.assertEqual(game.round_log, ['Team answered correctly!'])
+        # The log goes on after what was replayed
+        with game.session.lock:
+            game.state = 3
+            game.save('tie')
+        engine.flush()
+        tie = events.history(self.session.id).last()
+        self.assertEqual(tie.get_kind_display(), 'tie')
+        # Only what changed since the replayed events
+        self.assertEqual(json.loads(tie.changes), {str(game.id): {'state': 3}})
+        self.assertEqual(events.mismatches(self.session.id), [])
+
+
+class DeviceRegistryTests(EngineTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        quiz = seed_quiz(categories=3, questions_per_category=2)
+        session, _ = start_session(quiz, ['Team {}'.format(i) for i in range(6)])
+        self.session = engine.session(session.id)
+        self.gameteam_id = min(self.session.teams)
+
+    def test_unknown_devices_are_not_remembered(self):
+        for number in range(100):
+            self.assertIsNone(engine.device('unknown-{}'.format(number)))
+        self.assertEqual(engine.devices, {})
+        # Registered by another process: found on the next lookup
+        GameTeam.objects.filter(id=self.gameteam_id).update(device_registered=True, device_unique_id='unknown-1')
+        self.assertEqual(engine.device('unknown-1'), (self.session, self.gameteam_id))
+        with self.assertNumQueries(0):
+            self.assertEqual(engine.device('unknown-1'), (self.session, self.gameteam_id))
+
+    def test_replaced_devices_are_unregistered(self):
+        engine.register_device(self.session, self.gameteam_id, 'first')
+        engine.register_device(self.session, self.gameteam_id, 'second')
+        with self.assertNumQueries(0):
+            self.assertIsNone(engine.device('first'))
+        self.assertEqual(engine.device('second'), (self.session, self.gameteam_id))
+
+    def test_registrations_reach_the_database_before_a_flush(self):
+        # Where the consumers of other processes route the device from
+        engine.register_device(self.session, self.gameteam_id, 'routed')
+        self.assertEqual(router.session_of_device('routed'), self.session.id)
+        engine.reset_devices(self.session)
+        self.assertIsNone(router.session_of_device('routed'))
+        self.assertTrue(engine.dirty)
+
+
+class ReconnectTests(EngineTestMixin, TestCase):
+    """
+    A device connecting again without the frames it missed is sent the
+    state of its game.
+    """
+
+    def setUp(self):
+        super().setUp()
+        quiz = seed_quiz(categories=3, questions_per_category=2)
+        self.question = Question.objects.filter(quiz=quiz).order_by('id').first()
+        session, first_game = start_session(quiz, ['Team {}'.format(i) for i in range(6)])
+        self.game = game = engine.game(first_game.id)
+        for number, team_id in enumerate((game.first_team_id, game.second_team_id)):
+            engine.register_device(game.session, team_id, 'device-{}'.format(number))
+        with game.session.lock:
+            game.state = 2
+            game.first_player_turn = True
+            game.selected_category = self.question.category
+            game.question_id = self.question.id
+            game.save('question', question=self.question.id)
+
+    def reconnect(self, device_id):
+        handler = QuizHandler()
+        handler.connected({'device': device_id})
+        replies = [message[1] for message in handler.outbox.messages if message[0] == 'reply']
+        self.assertEqual(len(replies), 1)
+        return replies[0]
+
+    def test_full_game_state(self):
+        game = self.game
+        team_names = [game.session.team_name(team_id) for team_id in game.team_ids if team_id is not None]
+        self.assertEqual(self.reconnect('device-0'), {
+            'type': 'device_reconnect',
+            'device': 'device-0',
+            'team': team_names[0],
+            'game': game.id,
+            'game_state': {
+                'game': game.id,
+                'state': 2,
+                'is_final': False,
+                'selected_category': self.question.category,
+                'turn': team_names[0],
+                'scores': [{'team': name, 'score': 0} for name in team_names],
+                'question': {
+                    'question': self.question.question_text,
+                    'questionID': self.question.id,
+                    'answers': {answer.number: answer.answer_text for answer in self.question.answer_set.all()},
+                },
+            },
+        })
+
+    def test_question_hidden_from_other_teams_and_once_answered(self):
+        self.assertIsNone(self.reconnect('device-1')['game_state']['question'])
+        with self.game.session.lock:
+            self.game.answered.add(self.game.first_team_id)
+            self.game.save('answer', self.game.first_team_id, question=self.question.id, answer=1)
+        self.assertIsNone(self.reconnect('device-0')['game_state']['question'])
+        # Left alone in the cached view
+        self.assertIsNotNone(self.game.view()[0]['question'])
+
+    def test_cached_view_is_dropped_on_save(self):
+        view = self.game.view()
+        self.assertIs(self.game.view(), view)
+        with self.game.session.lock:
+            self.game.first_team_score += 1
+            self.game.save('score', self.game.first_team_id)
+        self.assertIsNot(self.game.view(), view)
+        self.assertEqual(self.reconnect('device-0')['game_state']['scores'][0]['score'], 1)
+
+
+class DeviceTeamTests(EngineTestMixin, TestCase):
+    """
+    A registered device plays for its own team only, whatever team name
+    its messages carry.
+    """
+
+    def setUp(self):
+        super().setUp()
+        quiz = seed_quiz(categories=3, questions_per_category=2)
+        self.question = Question.objects.filter(quiz=quiz).order_by('id').first()
+        session, first_game = start_session(quiz, ['Team {}'.format(i) for i in range(6)])
+        self.game = game = engine.game(first_game.id)
+        self.first_team, self.second_team = (game.session.team_name(team_id)
+                                             for team_id in (game.first_team_id, game.second_team_id))
+        # The second team's device, while the first team plays
+        self.handler = QuizHandler()
+        self.handler.receive({'type': 'register', 'team': self.second_team, 'game': game.id, 'device': 'device-1'})
+        with game.session.lock:
+            game.state = 1
+            game.first_player_turn = True
+            game.save('ready')
+
+    def test_category_for_another_team_is_rejected(self):
+        messages = self.handler.receive({'type': 'category', 'team': self.first_team, 'game': self.game.id,
+                                         'category': self.question.category})
+        self.assertIn(('reply', {'type': 'info', 'message': 'Category selected by non existing team'}), messages)
+        self.assertEqual((self.game.state, self.game.selected_category), (1, None))
+        self.assertNotIn(self.question.category, self.game.used_categories)
+
+    def test_answer_for_another_team_is_rejected(self):
+        with self.game.session.lock:
+            self.game.state = 2
+            self.game.selected_category = self.question.category
+            self.game.question_id = self.question.id
+            self.game.save('question', question=self.question.id)
+        correct = self.question.answer_set.get(is_correct=True).number
+        data = {'type': 'answer', 'team': self.first_team, 'game': self.game.id, 'question': self.question.id,
+                'answer': correct}
+        messages = self.handler.receive(data)
+        self.assertIn(('reply', {'type': 'info', 'message': 'Error reading answer data from {}'.format(data)}),
+                      messages)
+        self.assertEqual((self.game.state, self.game.first_team_score), (2, 0))
+        self.assertEqual(self.game.question_id, self.question.id)
+
+
+@override_settings(DELIVERY_ACK_TIMEOUT=0.1)
+class PlayerGroupsTests(EngineTestMixin, TransactionTestCase):
+    """
+    Frames for the devices go to the groups of their session and team, not
+    to every connected device.
+    """
+
+    def setUp(self):
+        super().setUp()
+        quiz = seed_quiz(categories=3, questions_per_category=4)
+        self.games = []
+        for prefix in 'AB':
+            session, first_game = start_session(quiz, ['{} {}'.format(prefix, i) for i in range(6)])
+            self.games.append(engine.game(first_game.id))
+        self.game = self.games[0]
+
+    async def listen(self):
+        """
+        A channel per team of both sessions, in the groups its device would
+        join on register, and one for a device not registered yet.
+        """
+        layer = get_channel_layer()
+        channels = {}
+        for game in self.games:
+            for team_id in game.session.teams:
+                channel = await layer.new_channel()
+                await layer.group_add(session_group(game.session_id), channel)
+                await layer.group_add(gameteam_group(team_id), channel)
+                channels[team_id] = channel
+        channels['players'] = await layer.new_channel()
+        await layer.group_add('players', channels['players'])
+        return channels
+
+    async def received(self, channels):
+        layer = get_channel_layer()
+        frames = {}
+        for key, channel in channels.items():
+            try:
+                while True:
+                    event = await asyncio.wait_for(layer.receive(channel), 0.05)
+                    frames.setdefault(key, []).append(event['type'])
+            except asyncio.TimeoutError:
+                pass
+        return frames
+
+    async def continue_game(self, state, channels):
+        game = self.game
+        with game.session.lock:
+            game.state = state
+            game.first_player_turn = True
+            game.selected_category = 'Category 0' if state == 2 else None
+            game.save()
+        screen = WebsocketCommunicator(GameMasterConsumer, '/ws/game_master/')
+        self.assertTrue((await screen.connect())[0])
+        await screen.send_json_to({'type': 'duel_game_continue', 'game': game.id})
+        await screen.receive_json_from()
+        frames = await self.received(channels)
+        await screen.disconnect()
+        return frames
+
+    def play(self, state):
+        async def play():
+            channels = await self.listen()
+            return await self.continue_game(state, channels)
+        return async_to_sync(play)()
+
+    def test_categories_and_questions_reach_the_team_playing(self):
+        self.assertEqual(self.play(1), {self.game.first_team_id: ['category.send']})
+        self.assertEqual(self.play(2), {self.game.first_team_id: ['question.send']})
+
+    def test_tie_questions_and_the_end_reach_the_session(self):
+        session_teams = set(self.game.session.teams)
+        for state, frame in ((3, 'question.send'), (5, 'unregistered')):
+            self.assertEqual(self.play(state), {team_id: [frame] for team_id in session_teams})
+
+
+class GameMasterBatchTests(EngineTestMixin, TransactionTestCase):
+    """
+    The game master notifications of one handler turn go out as a single
+    "game_master.batch" event, unpacked by the game master consumer.
+    """
+
+    def setUp(self):
+        super().setUp()
+        quiz = seed_quiz(categories=3, questions_per_category=2)
+        self.question = Question.objects.filter(quiz=quiz).order_by('id').first()
+        self.correct = self.question.answer_set.get(is_correct=True).number
+        session, first_game = start_session(quiz, ['Team {}'.format(i) for i in range(6)])
+        self.game = engine.game(first_game.id)
+        self.team = self.game.session.team_name(self.game.first_team_id)
+        self.sent = []
+
+    def test_one_event_per_answer(self):
+        frames = async_to_sync(self.answer)()
+        self.assertEqual([group for group, event_type in self.sent if group == 'game_master'], ['game_master'])
+        self.assertIn(('game_master', 'game_master.batch'), self.sent)
+        # Answer received, its result, the game going on
+        self.assertEqual([frame.get('type') for frame in frames], ['answer.receive', None, None])
+        self.assertTrue(all('info' in frame for frame in frames[1:]))
+
+    async def answer(self):
+        screen = WebsocketCommunicator(GameMasterConsumer, '/ws/game_master/')
+        self.assertTrue((await screen.connect())[0])
+        device = WebsocketCommunicator(QuizConsumer, '/ws/quiz/')
+        self.assertTrue((await device.connect())[0])
+        await device.send_json_to({'type': 'register', 'team': self.team, 'game': self.game.id, 'device': 'device-1'})
+        self.assertEqual((await device.receive_json_from())['type'], 'device_registered')
+        self.assertIn('info', await screen.receive_json_from())
+        game = self.game
+        with game.session.lock:
+            game.state = 2
+            game.first_player_turn = True
+            game.selected_category = self.question.category
+            game.question_id = self.question.id
+            game.save('question', question=self.question.id)
+
+        layer = get_channel_layer()
+        group_send = layer.group_send
+
+        async def recording_group_send(group, message):
+            self.sent.append((group, message['type']))
+            await group_send(group, message)
+
+        with mock.patch.object(layer, 'group_send', recording_group_send):
+            await device.send_json_to({'type': 'answer', 'team': self.team, 'game': game.id,
+                                       'question': self.question.id, 'answer': self.correct})
+            frames = [await screen.receive_json_from() for _ in range(3)]
+            self.assertTrue(await screen.receive_nothing())
+        await device.disconnect()
+        await screen.disconnect()
+        return frames
+
+
+class ConcurrentFinalAnswersTests(EngineTestMixin, TransactionTestCase):
+    """
+    Every team sends its answer several times at once: one is counted.
+    """
+
+    def test_one_answer_per_team_and_question(self):
+        rounds = 8
+        # The final picks its categories at random, any of them may serve every round
+        quiz = seed_quiz(categories=4, questions_per_category=rounds)
+        session, _ = start_session(quiz, ['Team {}'.format(i) for i in range(6)])
+        final = skip_to_final(session.id)
+        teams = [(team_id, final.session.team_name(team_id)) for team_id in final.team_ids]
+        questions = content.snapshot(quiz.id).questions
+        expected = {team_id: 0 for team_id, _ in teams}
+        shuffler = random.Random(5)
+        asked = []
+
+        with ThreadPoolExecutor(max_workers=9) as executor, redirect_stdout(io.StringIO()):
+            for _ in range(rounds):
+                GameMasterHandler().receive({'type': 'duel_game_continue', 'game': final.id})
+                GameMasterHandler().receive({'type': 'duel_game_continue', 'game': final.id})
+                self.assertEqual(final.state, 2)
+                self.assertNotIn(final.question_id, asked)
+                asked.append(final.question_id)
+                messages = []
+                for team_id, team_name in teams:
+                    answer = shuffler.choice([1, 2])
+                    if answer == questions[final.question_id].correct_answer:
+                        expected[team_id] += 1
+                    messages += [{'type': 'answer', 'answer': answer, 'question': final.question_id,
+                                  'team': team_name, 'game': final.id}] * 3
+                shuffler.shuffle(messages)
+                list(executor.map(self.receive, messages))
+
+                self.assertEqual((final.state, final.answer_count), (1, 0))
+                self.assertEqual(final.answered, set(final.team_ids))
+                self.assertEqual(dict(zip(final.team_ids, [final.first_team_score, final.second_team_score,
+                                                           final.third_team_score])), expected)
+
+        engine.flush()
+        row = DuelGame.objects.get(id=final.id)
+        self.assertEqual([row.first_team_score, row.second_team_score, row.third_team_score],
+                         [expected[team_id] for team_id in final.team_ids])
+        answers = Counter((event.team_id, json.loads(event.data)['question'])
+                          for event in events.history(session.id).filter(kind=events.KINDS['answer']))
+        self.assertEqual(answers, Counter({(team_id, question_id): 1
+                                           for team_id, _ in teams for question_id in asked}))
+
+    def receive(self, data):
+        try:
+            QuizHandler().receive(data)
+        finally:
+            connection.close()
+
+
+@override_settings(SQLITE_PRODUCTION=True)
+class SqliteProductionTests(TransactionTestCase):
+
+    def tearDown(self):
+        writer.stop()
+        super().tearDown()
+
+    def test_pragmas_set_on_new_connections(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for production in (False, True):
+                with override_settings(SQLITE_PRODUCTION=production):
+                    path = os.path.join(directory, '{}.sqlite3'.format(production))
+                    other = connections['default'].__class__(dict(connection.settings_dict, NAME=path))
+                    try:
+                        with other.cursor() as cursor:
+                            cursor.execute('PRAGMA journal_mode')
+                            journal_mode = cursor.fetchone()[0]
+                            pragmas = {}
+                            for name in ('synchronous', 'mmap_size', 'busy_timeout'):
+                                cursor.execute('PRAGMA {}'.format(name))
+                                pragmas[name] = cursor.fetchone()[0]
+                    finally:
+                        other.close()
+                if production:
+                    self.assertEqual(journal_mode, 'wal')
+                    # synchronous=NORMAL is 1
+                    self.assertEqual(pragmas, {'synchronous': 1, 'mmap_size': settings.SQLITE_PRAGMAS['mmap_size'],
+                                               'busy_timeout': settings.SQLITE_PRAGMAS['busy_timeout']})
+                else:
+                    self.assertEqual(journal_mode, 'delete')
+
+    def test_concurrent_writes_go_through_the_writer(self):
+        lock = threading.Lock()
+        running = []
+        most_running = []
+
+        def write(number):
+            with lock:
+                running.append(number)
+                most_running.append(len(running))
+            try:
+                time.sleep(0.001)
+                if number == 13:
+                    raise ValueError(number)
+                Team.objects.create(name='Writer {}'.format(number))
+                return threading.current_thread().name, connection.in_atomic_block
+            finally:
+                with lock:
+                    running.remove(number)
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            futures = [pool.submit(writer.run, write, number) for number in range(40)]
+        with self.assertRaises(ValueError):
+            futures[13].result()
+        self.assertEqual({futures[number].result() for number in range(40) if number != 13}, {('sqlite-writer', True)})
+        self.assertEqual(max(most_running), 1)
+        # The failed write alone was rolled back
+        self.assertEqual(set(Team.objects.filter(name__startswith='Writer ').values_list('name', flat=True)),
+                         {'Writer {}'.format(number) for number in range(40) if number != 13})
+
+
+class UsedBitsMigrationTests(TransactionTestCase):
+    """
+    0014 turns the JSON lists of used questions and categories into bits.
+    """
+
+    before = [('contest', '0013_auto_20261018_0821')]
+    after = [('contest', '0014_used_question_category_bits')]
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+        super().tearDown()
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def test_lists_become_bits_and_back(self):
+        apps = self.migrate(self.before)
+        Quiz = apps.get_model('contest', 'Quiz')
+        Question = apps.get_model('contest', 'Question')
+        GameSession = apps.get_model('contest', 'GameSession')
+        DuelGame = apps.get_model('contest', 'DuelGame')
+        quiz = Quiz.objects.create(name='Quiz')
+        questions = [Question.objects.create(quiz=quiz, category=category, question_text='?')
+                     for category in ['b', 'a', 'b', 'c', 'a']]
+        session = GameSession.objects.create(quiz=quiz, questions_removed=json.dumps(
+            [questions[1].id, questions[4].id, 12345]))
+        game = DuelGame.objects.create(session=session, game_order=1, categories_removed=json.dumps(['c', 'b']))
+
+        apps = self.migrate(self.after)
+        session = apps.get_model('contest', 'GameSession').objects.get(id=session.id)
+        game = apps.get_model('contest', 'DuelGame').objects.get(id=game.id)
+        # Questions by id, categories by their first question: b, a, c
+        self.assertEqual(bytes(session.used_questions), bytes([0b10010]))
+        self.assertEqual(bytes(game.used_categories), bytes([0b101]))
+
+        apps = self.migrate(self.before)
+        session = apps.get_model('contest', 'GameSession').objects.get(id=session.id)
+        game = apps.get_model('contest', 'DuelGame').objects.get(id=game.id)
+        self.assertEqual(json.loads(session.questions_removed), [questions[1].id, questions[4].id])
+        self.assertEqual(sorted(json.loads(game.categories_removed)), ['b', 'c'])
+
+
+class QuestionTraceTests(EngineTestMixin, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        quiz = seed_quiz(categories=3, questions_per_category=2)
+        self.question_id = Question.objects.filter(quiz=quiz).order_by('id').values_list('id', flat=True).first()
+        self.games = []
+        for _ in range(2):
+            session, first_game = start_session(quiz, ['Team {}'.format(i) for i in range(6)])
+            game = engine.game(first_game.id)
+            with game.session.lock:
+                game.state = 2
+                game.question_id = self.question_id
+                game.save()
+            self.games.append(game)
+
+    def test_one_game_master_sample_per_answer(self):
+        async_to_sync(self.answer_with_two_screens)()
+        for game in self.games:
+            hops = tracer.session_report(game.session_id)['hops']
+            self.assertEqual(hops['delivery_to_answer']['count'], 1)
+            self.assertEqual(hops['answer_to_master']['count'], 1)
+
+    async def answer_with_two_screens(self):
+        screens = [WebsocketCommunicator(GameMasterConsumer, '/ws/game_master/') for _ in range(2)]
+        for screen in screens:
+            self.assertTrue((await screen.connect())[0])
+        for game in self.games:
+            device = WebsocketCommunicator(QuizConsumer, '/ws/quiz/')
+            self.assertTrue((await device.connect())[0])
+            await device.send_json_to({
+                'type': 'answer', 'answer': 1, 'question': self.question_id, 'game': game.id,
+                'team': game.session.team_name(game.first_team_id),
+                'trace': {'id': 'question-{}'.format(game.id), 'delivered_at': time.time()},
+            })
+            await self.drain(device)
+            await device.disconnect()
+        for screen in screens:
+            await self.drain(screen)
+            await screen.disconnect()
+
+    async def drain(self, communicator):
+        # Reads every frame sent, waiting out the consumer's thread
+        while not await communicator.receive_nothing(timeout=0.5):
+            await communicator.receive_output()
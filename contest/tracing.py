@@ -0,0 +1,186 @@
+"""
+Latency of every question, from the game master's click to the answer
+showing on the game master screen.
+
+Each question pushed to the devices (states 2 and 3, and the final) gets a
+trace: {"id", "session", "dispatched_at"}, stamped when the handler pushes
+it. The device consumer adds "delivered_at" as it writes the frame, and
+devices echo the whole trace object back in their answer:
+
+    {"type": "answer", ..., "trace": {"id": .., "dispatched_at": .., "delivered_at": ..}}
+
+The answer handler adds "device" and "answered_at" and passes the trace on
+to the game master with "answer.receive". Every step records one hop:
+
+* dispatch_to_delivery: push to the frame written to the device, the
+  ordered delivery hold included;
+* delivery_to_answer: frame written to the answer received, i.e. the
+  device, its network and the team thinking;
+* answer_to_master: answer received to the game master frame written,
+  recorded by the first game master screen of the process it reaches (the
+  others ignore the answer's trace).
+
+Timestamps are server clock (time.time()), the trace carries them between
+processes. Hops are aggregated per session and per device of the session
+(see session_report), and in the contest_question_hop_seconds histogram.
+"""
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+from contest.metrics import question_hops
+
+
+logger = logging.getLogger(__name__)
+
+HOPS = ('dispatch_to_delivery', 'delivery_to_answer', 'answer_to_master')
+
+# Echoed timestamps outside of this are ignored
+MAX_HOP_SECONDS = 3600
+
+RECENT_SAMPLES = 500
+
+# Sessions kept, the oldest one is dropped past that
+MAX_SESSIONS = 200
+
+# Answers remembered as notified to a game master, the oldest one is
+# forgotten past that
+MAX_NOTIFIED = 10000
+
+
+class HopStats:
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.recent.append(seconds)
+
+    def summary(self):
+        recent = sorted(self.recent)
+
+        def percentile(pct):
+            return recent[min(len(recent) - 1, int(round(pct / 100.0 * (len(recent) - 1))))] if recent else 0.0
+
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': percentile(50),
+            'p95': percentile(95),
+            'max': self.max,
+        }
+
+
+class SessionLatency:
+
+    def __init__(self):
+        self.hops = {hop: HopStats() for hop in HOPS}
+        # device -> hop -> HopStats
+        self.devices = {}
+
+    def add(self, hop, device, seconds):
+        self.hops[hop].add(seconds)
+        if device is not None:
+            device_hops = self.devices.setdefault(device, {})
+            device_hops.setdefault(hop, HopStats()).add(seconds)
+
+
+class QuestionTracer:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # session id -> SessionLatency
+        self.sessions = {}
+        # (trace id, device) of the answers notified, in order
+        self.notified_answers = OrderedDict()
+
+    def dispatched(self, session_id):
+        return {'id': uuid.uuid4().hex[:16], 'session': session_id, 'dispatched_at': time.time()}
+
+    def delivered(self, trace, device):
+        """
+        Returns the trace to send to the device.
+        """
+        trace = dict(trace, delivered_at=time.time())
+        self.record('dispatch_to_delivery', trace, device, trace.get('dispatched_at'), trace['delivered_at'])
+        return trace
+
+    def answered(self, trace, session_id, device):
+        """
+        Takes the trace a device echoed with its answer, and returns the one
+        to send along to the game master (None if it echoed none).
+        """
+        if not isinstance(trace, dict):
+            return None
+        # Only the timestamps come from the device
+        trace = {'id': str(trace.get('id'))[:32], 'session': session_id, 'device': device,
+                 'delivered_at': trace.get('delivered_at'), 'answered_at': time.time()}
+        self.record('delivery_to_answer', trace, device, trace['delivered_at'], trace['answered_at'])
+        return trace
+
+    def notified(self, trace):
+        """
+        Called by every game master screen an answer reaches, only the
+        first one records it.
+        """
+        if not isinstance(trace, dict):
+            return
+        # A question has one trace, each device answers it once
+        answer = (trace.get('id'), trace.get('device'))
+        with self.lock:
+            if answer in self.notified_answers:
+                return
+            self.notified_answers[answer] = True
+            if len(self.notified_answers) > MAX_NOTIFIED:
+                self.notified_answers.popitem(last=False)
+        self.record('answer_to_master', trace, trace.get('device'), trace.get('answered_at'), time.time())
+
+    def record(self, hop, trace, device, start, end):
+        if not isinstance(start, (int, float)) or not 0 <= end - start <= MAX_HOP_SECONDS:
+            return
+        seconds = end - start
+        question_hops.labels(hop).observe(seconds)
+        with self.lock:
+            session = self.sessions.get(trace['session'])
+            if session is None:
+                if len(self.sessions) >= MAX_SESSIONS:
+                    self.sessions.pop(next(iter(self.sessions)))
+                session = self.sessions[trace['session']] = SessionLatency()
+            session.add(hop, device, seconds)
+        if seconds >= slow_hop_threshold():
+            logger.warning('Slow %s of question trace %s (session %s, device %s): %.0f ms',
+                           hop, trace.get('id'), trace['session'], device, seconds * 1000)
+
+    def reset(self):
+        with self.lock:
+            self.sessions = {}
+            self.notified_answers = OrderedDict()
+
+    def session_report(self, session_id):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return None
+            return {
+                'session': session_id,
+                'hops': {hop: stats.summary() for hop, stats in session.hops.items()},
+                'devices': {device: {hop: stats.summary() for hop, stats in hops.items()}
+                            for device, hops in session.devices.items()},
+            }
+
+
+tracer = QuestionTracer()
+
+
+def slow_hop_threshold():
+    return getattr(settings, 'QUESTION_TRACE_SLOW_HOP', 1.0)
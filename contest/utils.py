@@ -1,3 +1,7 @@
+from random import randint
+
+from contest.content import content
+from contest.deck import QuestionDeck
 from contest.models import DuelGame, GameTeam
 
 
@@ -36,3 +40,12 @@ def create_duel_games(teams, game_session):
     games.append(final)
 
     return games[0]
+
+
+def build_question_deck(game_session, exclude=()):
+    questions = content.snapshot(game_session.quiz_id).question_categories
+    game_session.deck_seed = randint(0, 2 ** 31 - 1)
+    deck = QuestionDeck.build(questions, game_session.deck_seed, exclude=exclude)
+    game_session.question_deck = deck.cards_json()
+    game_session.deck_drawn = deck.drawn_json()
+    return deck